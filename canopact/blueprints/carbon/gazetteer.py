@@ -0,0 +1,157 @@
+"""Offline gazetteer of airports for calculating air distances.
+
+The bundled `data/airports.csv` lists airports with their IATA code, name,
+city, country and coordinates. It is loaded once per process into arrays,
+with a dictionary from IATA codes and normalised names to array positions.
+
+Examples:
+    gazetteer = get_gazetteer()
+    gazetteer.distances(pd.Series(['LHR']), pd.Series(['New York']))
+"""
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from lib.util_geo import haversine
+from lib.util_places import place_key, place_keys
+
+AIRPORTS_PATH = os.path.join(os.path.dirname(__file__), 'data',
+                             'airports.csv')
+
+_gazetteer = None
+_lock = threading.Lock()
+
+
+class Gazetteer():
+    """Resolves place names and IATA codes to airport coordinates.
+
+    Args:
+        codes (numpy.ndarray): IATA code of each airport.
+        latitudes (numpy.ndarray): latitude of each airport in degrees.
+        longitudes (numpy.ndarray): longitude of each airport in degrees.
+        index (dict): array position for each normalised place key.
+    """
+
+    def __init__(self, codes, latitudes, longitudes, index):
+        self.codes = codes
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.index = index
+        self.code_index = {c: i for i, c in enumerate(codes)}
+
+    @classmethod
+    def from_csv(cls, path=AIRPORTS_PATH):
+        """Load a gazetteer from a csv of airports.
+
+        Each airport can be found by its IATA code, its name, its city
+        and its name or city with the country, e.g. "Heathrow",
+        "London Heathrow", "Heathrow Airport" or "London, UK". Where several
+        airports share a city the first one listed is used for the city.
+
+        Args:
+            path (str): csv with columns iata, name, city, country, latitude
+                and longitude.
+
+        Returns:
+            Gazetteer: the loaded gazetteer.
+
+        """
+        df = pd.read_csv(path, keep_default_na=False)
+
+        index = {}
+        for i, row in enumerate(df.itertuples(index=False)):
+            names = [row.name, f'{row.name} airport', row.city,
+                     f'{row.city} {row.name}',
+                     f'{row.city} {row.name} airport',
+                     f'{row.name}, {row.country}',
+                     f'{row.city}, {row.country}',
+                     f'{row.city} {row.name}, {row.country}']
+            for name in names:
+                index.setdefault(place_key(name), i)
+
+        return cls(df['iata'].to_numpy(str),
+                   df['latitude'].to_numpy(float),
+                   df['longitude'].to_numpy(float),
+                   index)
+
+    def resolve(self, places):
+        """Find the airport for each place.
+
+        Three letter IATA codes are matched first, then normalised names.
+
+        Args:
+            places (pandas.Series): place names or IATA codes.
+
+        Returns:
+            numpy.ndarray: array position of each place's airport, -1 where
+                it can't be resolved.
+
+        """
+        positions = np.full(len(places), -1, dtype=int)
+
+        is_str = places.map(lambda p: isinstance(p, str)).to_numpy(bool)
+        if not is_str.any():
+            return positions
+
+        strings = places[is_str]
+        codes = strings.str.strip().str.upper().map(self.code_index)
+
+        names = place_keys(strings).map(self.index)
+
+        positions[is_str] = codes.fillna(names).fillna(-1).to_numpy(int)
+
+        return positions
+
+    def coordinates(self, places):
+        """Resolve places to their airport's coordinates.
+
+        Args:
+            places (pandas.Series): place names or IATA codes.
+
+        Returns:
+            tuple: latitude and longitude arrays, NaN where unresolved.
+
+        """
+        positions = self.resolve(places)
+        found = positions >= 0
+
+        lat = np.full(len(positions), np.nan)
+        lon = np.full(len(positions), np.nan)
+        lat[found] = self.latitudes[positions[found]]
+        lon[found] = self.longitudes[positions[found]]
+
+        return lat, lon
+
+    def distances(self, origins, destinations):
+        """Great-circle distance between each origin and destination.
+
+        Args:
+            origins (pandas.Series): origin place names or IATA codes.
+            destinations (pandas.Series): destination names or IATA codes.
+
+        Returns:
+            numpy.ndarray: distance in km, NaN where either place can't be
+                resolved.
+
+        """
+        return haversine(*self.coordinates(origins),
+                         *self.coordinates(destinations))
+
+
+def get_gazetteer():
+    """Get the gazetteer shared by the process, loading it on first use.
+
+    Returns:
+        Gazetteer: loaded from the bundled airports csv.
+
+    """
+    global _gazetteer
+
+    with _lock:
+        if _gazetteer is None:
+            _gazetteer = Gazetteer.from_csv()
+
+    return _gazetteer
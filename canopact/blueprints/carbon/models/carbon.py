@@ -705,6 +705,14 @@ class Carbon(ResourceMixin, db.Model):
         end = Carbon.get_prev_months_date(prev_months=0, first=False, **kwargs)
 
         counts = func.count(Route.id)
+        # Group on place keys so spelling variants of a route count together,
+        # labelled with one of the spellings. Routes saved before the keys
+        # were backfilled fall back to grouping on their own spelling.
+        origin_group = func.coalesce(Route.origin_key, Route.origin)
+        destination_group = func.coalesce(Route.destination_key,
+                                          Route.destination)
+        origin = func.min(Route.origin)
+        destination = func.min(Route.destination)
 
         # Query database.
         if agg == 'company':
@@ -712,26 +720,26 @@ class Carbon(ResourceMixin, db.Model):
                 .filter(User.company_id == user.company_id).all()
 
             routes = \
-                db.session.query(Route.origin, Route.destination, counts) \
+                db.session.query(origin, destination, counts) \
                 .join(Expense, Route.expense_id == Expense.expense_id) \
                 .filter(Route.invalid is not None) \
                 .filter(Route.route_category != 'unit') \
                 .filter(Expense.user_id.in_(users)) \
                 .filter(Expense.expense_created_date >= start) \
                 .filter(Expense.expense_created_date <= end) \
-                .group_by(Route.origin, Route.destination) \
+                .group_by(origin_group, destination_group) \
                 .order_by(counts.desc()) \
                 .all()
         elif agg == 'employee':
             routes = \
-                db.session.query(Route.origin, Route.destination, counts) \
+                db.session.query(origin, destination, counts) \
                 .join(Expense, Route.expense_id == Expense.expense_id) \
                 .filter(Route.invalid is not None) \
                 .filter(Route.route_category != 'unit') \
                 .filter(Expense.user_id == user.id) \
                 .filter(Expense.expense_created_date >= start) \
                 .filter(Expense.expense_created_date <= end) \
-                .group_by(Route.origin, Route.destination) \
+                .group_by(origin_group, destination_group) \
                 .order_by(counts.desc()) \
                 .all()
         else:
@@ -0,0 +1,318 @@
+"""Models for the distance cache
+
+Distances already looked up for an origin/destination pair, so they don't
+need requesting from the distance APIs again.
+
+Lookups go through three tiers: an in-process LRU cache, Redis (shared by
+every Celery worker) and finally the `distance_cache` table. Hits in a
+lower tier are copied into the tiers above it.
+
+"""
+
+import threading
+
+from flask import current_app
+from canopact.extensions import db
+import pandas as pd
+import redis
+from sqlalchemy import tuple_
+from lib.util_cache import LRUCache, TierCounters
+from lib.util_datetime import tzware_datetime
+from lib.util_places import place_keys
+from lib.util_sqlalchemy import ResourceMixin, AwareDateTime
+
+
+# Hit and miss counts for each tier, reset by calculate_carbon per run.
+stats = TierCounters('memory', 'redis', 'database')
+
+_memory = None
+_redis = None
+_lock = threading.Lock()
+
+
+def get_memory_cache():
+    """Get this process's in-memory distance cache, creating it if needed.
+
+    Returns:
+        lib.util_cache.LRUCache: cache sized from DISTANCE_LRU_SIZE and
+            DISTANCE_LRU_TTL.
+
+    """
+    global _memory
+
+    with _lock:
+        if _memory is None:
+            _memory = LRUCache(maxsize=current_app.config['DISTANCE_LRU_SIZE'],
+                               ttl=current_app.config['DISTANCE_LRU_TTL'])
+
+    return _memory
+
+
+def get_redis():
+    """Get the Redis client for the shared tier, creating it if needed.
+
+    Returns:
+        redis.StrictRedis: client for DISTANCE_REDIS_URL, None if the Redis
+            tier is disabled.
+
+    """
+    global _redis
+
+    url = current_app.config['DISTANCE_REDIS_URL']
+    if url is None:
+        return None
+
+    with _lock:
+        if _redis is None:
+            _redis = redis.StrictRedis.from_url(url)
+
+    return _redis
+
+
+def redis_key(mode, key):
+    """Redis key for an (origin_key, destination_key) pair."""
+    return f"distance:{mode}:{key[0]}|{key[1]}"
+
+
+class DistanceCache(ResourceMixin, db.Model):
+    __tablename__ = 'distance_cache'
+    __table_args__ = (
+        db.UniqueConstraint('origin_key', 'destination_key', 'mode',
+                            name='uq_distance_cache_route'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Normalised place keys, see lib.util_places, and the route category.
+    origin_key = db.Column(db.String(100), nullable=False)
+    destination_key = db.Column(db.String(100), nullable=False)
+    mode = db.Column(db.String(10), nullable=False)
+
+    # One way distance in km.
+    distance = db.Column(db.Float())
+    provider = db.Column(db.String(50))
+    status = db.Column(db.String(50))
+    fetched_at = db.Column(AwareDateTime(), default=tzware_datetime)
+
+    def __init__(self, **kwargs):
+        # Call Flask-SQLAlchemy's constructor.
+        super(DistanceCache, self).__init__(**kwargs)
+
+    @staticmethod
+    def lookup(keys, mode, ttl=None, chunksize=10000):
+        """Get cached distances for origin/destination key pairs.
+
+        Each tier is only asked for the pairs the tiers above it missed.
+
+        Args:
+            keys (iterable): (origin_key, destination_key) tuples.
+            mode (str): route category, 'ground' or 'air'.
+            ttl (datetime.timedelta): ignore table entries fetched longer ago
+                than this, DISTANCE_CACHE_TTL if None.
+            chunksize (int): number of pairs looked up per query.
+
+        Returns:
+            dict: distance in km for each pair that is cached.
+
+        """
+        keys = list({k for k in keys if None not in k})
+        memory = get_memory_cache()
+
+        found = memory.get_many([(mode, *k) for k in keys])
+        cached = {k[1:]: dist for k, dist in found.items()}
+        missing = [k for k in keys if k not in cached]
+        stats.record('memory', len(cached), len(missing))
+
+        if missing:
+            shared = DistanceCache.lookup_redis(missing, mode)
+            memory.set_many({(mode, *k): d for k, d in shared.items()})
+            cached.update(shared)
+            missing = [k for k in missing if k not in shared]
+
+        if missing:
+            stored = DistanceCache.lookup_database(missing, mode, ttl=ttl,
+                                                   chunksize=chunksize)
+            stats.record('database', len(stored),
+                         len(missing) - len(stored))
+            memory.set_many({(mode, *k): d for k, d in stored.items()})
+            DistanceCache.store_redis(stored, mode)
+            cached.update(stored)
+
+        return cached
+
+    @staticmethod
+    def lookup_redis(keys, mode, chunksize=1000):
+        """Get distances for pairs from the shared Redis tier.
+
+        Redis being unavailable is treated as every pair missing.
+
+        Args:
+            keys (list): (origin_key, destination_key) tuples.
+            mode (str): route category, 'ground' or 'air'.
+            chunksize (int): number of pairs fetched per MGET.
+
+        Returns:
+            dict: distance in km for each pair found.
+
+        """
+        client = get_redis()
+        if client is None:
+            return {}
+
+        found = {}
+        try:
+            for start in range(0, len(keys), chunksize):
+                chunk = keys[start:start + chunksize]
+                values = client.mget([redis_key(mode, k) for k in chunk])
+                found.update((k, float(v)) for k, v in zip(chunk, values)
+                             if v is not None)
+        except redis.exceptions.RedisError as e:
+            print(f"Distance cache Redis lookup failed: {e}")
+
+        stats.record('redis', len(found), len(keys) - len(found))
+
+        return found
+
+    @staticmethod
+    def store_redis(distances, mode):
+        """Write distances to the shared Redis tier.
+
+        Args:
+            distances (dict): distance in km for each
+                (origin_key, destination_key) pair.
+            mode (str): route category, 'ground' or 'air'.
+
+        """
+        client = get_redis()
+        if client is None or not distances:
+            return
+
+        ttl = current_app.config['DISTANCE_REDIS_TTL']
+        try:
+            pipe = client.pipeline(transaction=False)
+            for key, dist in distances.items():
+                pipe.set(redis_key(mode, key), dist, ex=ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print(f"Distance cache Redis write failed: {e}")
+
+    @staticmethod
+    def lookup_database(keys, mode, ttl=None, chunksize=10000):
+        """Get distances for pairs from the `distance_cache` table.
+
+        Args:
+            keys (list): (origin_key, destination_key) tuples.
+            mode (str): route category, 'ground' or 'air'.
+            ttl (datetime.timedelta): ignore entries fetched longer ago than
+                this, DISTANCE_CACHE_TTL if None.
+            chunksize (int): number of pairs looked up per query.
+
+        Returns:
+            dict: distance in km for each pair found.
+
+        """
+        if ttl is None:
+            ttl = current_app.config['DISTANCE_CACHE_TTL']
+
+        cached = {}
+
+        pair = tuple_(DistanceCache.origin_key, DistanceCache.destination_key)
+        for start in range(0, len(keys), chunksize):
+            query = db.session.query(DistanceCache.origin_key,
+                                     DistanceCache.destination_key,
+                                     DistanceCache.distance) \
+                .filter(DistanceCache.mode == mode) \
+                .filter(DistanceCache.status == 'OK') \
+                .filter(pair.in_(keys[start:start + chunksize]))
+
+            if ttl:
+                query = query.filter(
+                    DistanceCache.fetched_at >= tzware_datetime() - ttl)
+
+            cached.update(((o, d), dist) for o, d, dist in query)
+
+        return cached
+
+    @staticmethod
+    def store(distances, mode, provider, commit=True):
+        """Write distances to every tier, replacing any stale entries.
+
+        Args:
+            distances (dict): distance in km for each
+                (origin_key, destination_key) pair.
+            mode (str): route category, 'ground' or 'air'.
+            provider (str): where the distances came from.
+            commit (bool): commit the session once written.
+
+        Returns:
+            int: number of entries written.
+
+        """
+        now = tzware_datetime()
+        rows = [{'origin_key': o, 'destination_key': d, 'mode': mode,
+                 'distance': dist, 'provider': provider, 'status': 'OK',
+                 'fetched_at': now}
+                for (o, d), dist in distances.items()
+                if None not in (o, d) and not pd.isnull(dist)]
+
+        written = DistanceCache.bulk_upsert(
+            rows, ['origin_key', 'destination_key', 'mode'], commit=commit)
+
+        found = {(r['origin_key'], r['destination_key']): r['distance']
+                 for r in rows}
+        get_memory_cache().set_many({(mode, *k): d for k, d in found.items()})
+        DistanceCache.store_redis(found, mode)
+
+        return written
+
+    @staticmethod
+    def warm_from_routes(batch_size=1000):
+        """Fill the cache from distances already calculated for routes.
+
+        Return trips are halved back to one way. Where a pair has several
+        routes, the most recently updated one is used.
+
+        Args:
+            batch_size (int): entries written per statement.
+
+        Returns:
+            int: number of entries written.
+
+        """
+        # Prevent circular import.
+        from canopact.blueprints.carbon.models.route import Route
+
+        routes = db.session.query(Route.origin,
+                                  Route.destination,
+                                  Route.route_category,
+                                  Route.return_type,
+                                  Route.distance,
+                                  Route.updated_on) \
+            .filter(Route.route_category.in_(['ground', 'air'])) \
+            .filter(Route.distance.isnot(None))
+
+        df = DistanceCache.frame_from_query(routes)
+        if len(df) == 0:
+            return 0
+
+        returns = df['return_type'].astype(str).str.contains('r', case=False)
+        df['distance'] = df['distance'].where(~returns, df['distance'] / 2)
+        df['origin_key'] = place_keys(df['origin'])
+        df['destination_key'] = place_keys(df['destination'])
+
+        df = df.dropna(subset=['origin_key', 'destination_key']) \
+            .sort_values('updated_on', ascending=False) \
+            .drop_duplicates(['origin_key', 'destination_key',
+                              'route_category'])
+
+        df = df.rename(columns={'route_category': 'mode',
+                                'updated_on': 'fetched_at'})
+        df['provider'] = 'routes'
+        df['status'] = 'OK'
+
+        rows = df[['origin_key', 'destination_key', 'mode', 'distance',
+                   'provider', 'status', 'fetched_at']].to_dict('records')
+
+        return DistanceCache.bulk_upsert(
+            rows, ['origin_key', 'destination_key', 'mode'],
+            batch_size=batch_size)
@@ -0,0 +1,183 @@
+"""Models for the distance retry queue
+
+Origin/destination pairs whose distance lookup failed for a transient
+reason, e.g. a timeout, OVER_QUERY_LIMIT or a 5xx response. Rather than
+their routes being marked invalid, the pairs wait here and are retried by
+the `retry_distances` task with exponential backoff. A pair that fails
+permanently, or fails transiently too many times, has its routes marked
+invalid for the cleaner.
+
+"""
+
+import datetime
+
+from flask import current_app
+from canopact.extensions import db
+from sqlalchemy import tuple_
+from lib.util_datetime import tzware_datetime
+from lib.util_sqlalchemy import ResourceMixin, AwareDateTime
+
+
+class DistanceRetry(ResourceMixin, db.Model):
+    __tablename__ = 'distance_retries'
+    __table_args__ = (
+        db.UniqueConstraint('origin_key', 'destination_key', 'mode',
+                            name='uq_distance_retries_route'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Normalised place keys, see lib.util_places, and the route category.
+    origin_key = db.Column(db.String(100), nullable=False)
+    destination_key = db.Column(db.String(100), nullable=False)
+    mode = db.Column(db.String(10), nullable=False)
+
+    # Spelling of the pair that is requested.
+    origin = db.Column(db.String(100))
+    destination = db.Column(db.String(100))
+
+    # Status of the last failed attempt, how many attempts have failed and
+    # when the next one is due.
+    status = db.Column(db.String(50))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    retry_on = db.Column(AwareDateTime(), index=True, nullable=False)
+
+    def __init__(self, **kwargs):
+        # Call Flask-SQLAlchemy's constructor.
+        super(DistanceRetry, self).__init__(**kwargs)
+
+    @staticmethod
+    def backoff(attempts):
+        """Seconds to wait after a pair's `attempts`th failed attempt.
+
+        Doubles from DISTANCE_RETRY_MIN_INTERVAL with each attempt, up to
+        DISTANCE_RETRY_MAX_INTERVAL.
+
+        Args:
+            attempts (int): number of failed attempts so far.
+
+        Returns:
+            int: seconds until the next attempt.
+
+        """
+        min_interval = current_app.config['DISTANCE_RETRY_MIN_INTERVAL']
+        max_interval = current_app.config['DISTANCE_RETRY_MAX_INTERVAL']
+
+        return min(min_interval * 2 ** (attempts - 1), max_interval)
+
+    @staticmethod
+    def enqueue(failures, mode, commit=True):
+        """Add pairs whose first lookup failed transiently to the queue.
+
+        Args:
+            failures (dict): (origin, destination, status) for each
+                (origin_key, destination_key) pair.
+            mode (str): route category, 'ground' or 'air'.
+            commit (bool): commit the session once written.
+
+        Returns:
+            int: number of pairs queued.
+
+        """
+        retry_on = tzware_datetime() + datetime.timedelta(
+            seconds=DistanceRetry.backoff(1))
+
+        rows = [{'origin_key': ok, 'destination_key': dk, 'mode': mode,
+                 'origin': o, 'destination': d, 'status': status,
+                 'attempts': 1, 'retry_on': retry_on}
+                for (ok, dk), (o, d, status) in failures.items()]
+
+        return DistanceRetry.bulk_upsert(
+            rows, ['origin_key', 'destination_key', 'mode'], commit=commit)
+
+    @staticmethod
+    def queued(keys, mode, chunksize=10000):
+        """Find which pairs are waiting in the queue, due or not.
+
+        Args:
+            keys (list): (origin_key, destination_key) tuples.
+            mode (str): route category, 'ground' or 'air'.
+            chunksize (int): number of pairs looked up per query.
+
+        Returns:
+            set: the pairs that are queued.
+
+        """
+        queued = set()
+
+        pair = tuple_(DistanceRetry.origin_key, DistanceRetry.destination_key)
+        for start in range(0, len(keys), chunksize):
+            query = db.session.query(DistanceRetry.origin_key,
+                                     DistanceRetry.destination_key) \
+                .filter(DistanceRetry.mode == mode) \
+                .filter(pair.in_(keys[start:start + chunksize]))
+
+            queued.update((o, d) for o, d in query)
+
+        return queued
+
+    @staticmethod
+    def due(mode, limit=None):
+        """Get the queued pairs whose next attempt is due, oldest first.
+
+        Args:
+            mode (str): route category, 'ground' or 'air'.
+            limit (int): maximum number of pairs to return.
+
+        Returns:
+            list: DistanceRetry instances.
+
+        """
+        query = DistanceRetry.query \
+            .filter(DistanceRetry.mode == mode) \
+            .filter(DistanceRetry.retry_on <= tzware_datetime()) \
+            .order_by(DistanceRetry.retry_on)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query.all()
+
+    def reschedule(self, status):
+        """Record another failed attempt and back off before the next one.
+
+        Does not commit.
+
+        Args:
+            status (str): status of the failed attempt.
+
+        """
+        self.attempts += 1
+        self.status = status
+        self.retry_on = tzware_datetime() + datetime.timedelta(
+            seconds=DistanceRetry.backoff(self.attempts))
+
+    @staticmethod
+    def invalidate_routes(keys, mode, chunksize=10000):
+        """Mark the routes without a distance for pairs as invalid.
+
+        Does not commit.
+
+        Args:
+            keys (list): (origin_key, destination_key) tuples.
+            mode (str): route category, 'ground' or 'air'.
+            chunksize (int): number of pairs updated per statement.
+
+        Returns:
+            int: number of routes marked invalid.
+
+        """
+        # Prevent circular import.
+        from canopact.blueprints.carbon.models.route import Route
+
+        updated = 0
+
+        pair = tuple_(Route.origin_key, Route.destination_key)
+        for start in range(0, len(keys), chunksize):
+            updated += Route.query \
+                .filter(Route.route_category == mode) \
+                .filter(Route.distance.is_(None)) \
+                .filter(pair.in_(keys[start:start + chunksize])) \
+                .update({'invalid': 1}, synchronize_session=False)
+
+        return updated
@@ -0,0 +1,127 @@
+"""Models for distance API usage
+
+One row per provider for each run of a task that calls the distance APIs,
+recording the calls made, their estimated cost and the state of the
+provider's circuit breaker. The rows of the current day are also what the
+daily call budgets are checked against.
+
+Examples:
+    started_on = DistanceRun.start()
+    ...
+    DistanceRun.finish('calculate_carbon', started_on)
+
+"""
+
+from flask import current_app
+from canopact.extensions import db
+from sqlalchemy import func
+from lib.util_datetime import tzware_datetime
+from lib.util_sqlalchemy import ResourceMixin, AwareDateTime
+from vendors import distance as distance_api
+
+
+class DistanceRun(ResourceMixin, db.Model):
+    __tablename__ = 'distance_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Task that made the calls, e.g. 'calculate_carbon', and when it ran.
+    task = db.Column(db.String(50), nullable=False)
+    provider = db.Column(db.String(50), nullable=False, index=True)
+    started_on = db.Column(AwareDateTime(), nullable=False, index=True)
+    finished_on = db.Column(AwareDateTime())
+
+    # Calls made, the elements billed for them, and calls that failed or
+    # were deferred by the call budgets or circuit breaker.
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    elements = db.Column(db.Integer, nullable=False, default=0)
+    failures = db.Column(db.Integer, nullable=False, default=0)
+    deferred = db.Column(db.Integer, nullable=False, default=0)
+    cost = db.Column(db.Float())
+    breaker = db.Column(db.String(10))
+    budget_spent = db.Column(db.Boolean())
+
+    def __init__(self, **kwargs):
+        # Call Flask-SQLAlchemy's constructor.
+        super(DistanceRun, self).__init__(**kwargs)
+
+    @staticmethod
+    def calls_today(provider, now=None):
+        """Count the calls made to a provider by runs started today (UTC).
+
+        Args:
+            provider (str): name of the distance API, e.g. 'google'.
+            now (datetime.datetime): current time, now if None.
+
+        Returns:
+            int: number of calls.
+
+        """
+        if now is None:
+            now = tzware_datetime()
+
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        calls = db.session.query(func.sum(DistanceRun.calls)) \
+            .filter(DistanceRun.provider == provider) \
+            .filter(DistanceRun.started_on >= midnight) \
+            .scalar()
+
+        return int(calls or 0)
+
+    @staticmethod
+    def start():
+        """Start a run, resetting the call counts and circuit breakers.
+
+        Each provider's run budget comes from DISTANCE_RUN_BUDGETS and its
+        daily budget from DISTANCE_DAILY_BUDGETS, less the calls already
+        made today.
+
+        Returns:
+            datetime.datetime: when the run started, to pass to `finish`.
+
+        """
+        config = current_app.config
+        run_budgets = config['DISTANCE_RUN_BUDGETS']
+        daily_budgets = config['DISTANCE_DAILY_BUDGETS']
+        costs = config['DISTANCE_COSTS']
+
+        providers = set(run_budgets) | set(daily_budgets) | set(costs)
+        distance_api.start_run({
+            p: {'run_budget': run_budgets.get(p),
+                'daily_budget': daily_budgets.get(p),
+                'used_today': DistanceRun.calls_today(p),
+                'threshold': config['DISTANCE_BREAKER_THRESHOLD'],
+                'cost': costs.get(p, 0.0)}
+            for p in providers
+        })
+
+        return tzware_datetime()
+
+    @staticmethod
+    def finish(task, started_on, commit=True):
+        """Record the usage of each provider called during the run.
+
+        Args:
+            task (str): name of the task that made the calls.
+            started_on (datetime.datetime): returned by `start`.
+            commit (bool): commit the session once recorded.
+
+        Returns:
+            dict: `vendors.distance.usage_summary()` for the run.
+
+        """
+        summary = distance_api.usage_summary()
+        finished_on = tzware_datetime()
+
+        for provider, usage in summary.items():
+            if not usage['calls'] and not usage['deferred']:
+                continue
+            db.session.add(DistanceRun(task=task, provider=provider,
+                                       started_on=started_on,
+                                       finished_on=finished_on, **usage))
+
+        if commit:
+            db.session.commit()
+
+        return summary
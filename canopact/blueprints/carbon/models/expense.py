@@ -9,10 +9,10 @@ Examples:
 
 """
 from canopact.extensions import db
+from flask import current_app
 from canopact.blueprints.carbon.models.carbon import Carbon
 from canopact.blueprints.carbon.models.route import Route
 from sqlalchemy import exists
-import pandas as pd
 from lib.util_sqlalchemy import ResourceMixin
 
 
@@ -53,97 +53,73 @@ class Expense(ResourceMixin, db.Model):
     expense_unit_unit = db.Column(db.String(10))
     travel_expense = db.Column(db.Integer())
 
+    # Fingerprint of the ingested fields, used to skip unchanged rows.
+    content_hash = db.Column(db.String(32))
+
     def __init__(self, **kwargs):
         # Call Flask-SQLAlchemy's constructor.
         super(Expense, self).__init__(**kwargs)
         self.travel_expense = self.is_travel_expense()
 
     @staticmethod
-    def parse_expenses_from_list(reports, r_num, user_id=None):
-        """Parse and return the expenses fields from a report.
+    def parse_expenses_from_frame(df, user_id=None):
+        """Parse and return the expense fields from a frame of expenses.
 
         Args:
-            report (list): list of reports
-            r_num (int): positonal index of report to parse.
+            df (pandas.DataFrame): expenses from `Expensify.expenses_frame()`.
             user_id (int): id of user.
 
         Returns:
-            dict: keys value pairs of expense fields / information.
+            pandas.DataFrame: expense fields, with a `user_id` column.
 
         """
-        report = reports[r_num]
-        data = report['report_expenses']
-        report_id = report['report_id']
-
-        # Get the length of the id value.
-        num_expenses = len(data['expense_id'])
-        user_ids = [user_id] * num_expenses
-        report_ids = [report_id] * num_expenses
-
-        expenses = {
-            'expense_id': data['expense_id'],
-            'user_id': user_ids,
-            'report_id': report_ids,
-            'expense_type': data['expense_type'],
-            'expense_category': data['expense_category'],
-            'expense_amount': data['expense_amount'],
-            'expense_currency': data['expense_currency'],
-            'expense_comment': data['expense_comment'],
-            'expense_converted_amount': data['expense_converted_amount'],
-            'expense_created_date': data['expense_created_date'],
-            'expense_inserted_date': data['expense_inserted_date'],
-            'expense_merchant': data['expense_merchant'],
-            'expense_modified_amount': data['expense_modified_amount'],
-            'expense_modified_created_date':
-                data['expense_modified_created_date'],
-            'expense_modified_merchant': data['expense_modified_merchant'],
-            'expense_unit_count': data['expense_unit_count'],
-            'expense_unit_rate': data['expense_unit_rate'],
-            'expense_unit_unit': data['expense_unit_unit']
-        }
-
-        return expenses
+        return df.assign(user_id=user_id)
 
     @staticmethod
-    def parse_expense_from_report(expenses, e_num):
-        """Parse a single expense from a dictionary of multiple expenses.
+    def prepare_expenses(df, categories=None):
+        """Convert a frame of multiple expenses into rows for the db.
+
+        Expects the output of `Expense.parse_expenses_from_frame()`.
+
+        Amounts are converted from pence into pounds and each expense is
+        flagged as a travel expense or not, a column at a time.
 
         Args:
-            expenses (dict): Dictionary of multiple expenses.
-            e_num (int): positional index of expense in expenses.
+            df (pandas.DataFrame): frame of multiple expenses.
+            categories (list): valid travel expense categories. Defaults to
+                the `EXPENSE_TRAVEL_CATEGORIES` setting.
 
         Returns:
-            dict: single expense.
+            list: dictionaries of expense fields, one per expense.
 
         """
-        # Sist of tuples for each key value of the expense with index:`exp_num`
-        indexed_pairs = [(k, v[e_num]) for (k, v) in expenses.items()]
-        # Convert into a dictionary.
-        dict_pairs = dict(indexed_pairs)
-
-        # Replace empty values with None.
-        for k, v in dict_pairs.items():
-            if v == '':
-                dict_pairs[k] = None
-
-        return dict_pairs
-
-    def is_travel_expense(self, categories=[
-                                    'Car, Van and Travel Expenses: Air',
-                                    'Car, Van and Travel Expenses: Bus',
-                                    'Car, Van and Travel Expenses: Car Hire',
-                                    'Car, Van and Travel Expenses: Fuel',
-                                    'Car, Van and Travel Expenses: Taxi',
-                                    'Car, Van and Travel Expenses: Train']):
+        if categories is None:
+            categories = current_app.config['EXPENSE_TRAVEL_CATEGORIES']
+
+        df = df.assign(
+            expense_amount=df['expense_amount'] / 100,
+            travel_expense=df['expense_category'].isin(categories).astype(int)
+        )
+
+        # Convert NaNs, NaTs and NAs to nulls to be compatible with the db.
+        df = df.astype(object).where(df.notnull(), None)
+
+        return df.to_dict('records')
+
+    def is_travel_expense(self, categories=None):
         """Checks whether expense is in one of the required `categories`.
 
         Args:
-            categories (list): valid travel expense categories.
+            categories (list): valid travel expense categories. Defaults to
+                the `EXPENSE_TRAVEL_CATEGORIES` setting.
 
         Returns:
             travel_expense (int): 1 if a travel expense, 0 otherwise.
 
         """
+        if categories is None:
+            categories = current_app.config['EXPENSE_TRAVEL_CATEGORIES']
+
         if self.expense_category in categories:
             travel_expense = 1
         else:
@@ -152,39 +128,51 @@ class Expense(ResourceMixin, db.Model):
         return travel_expense
 
     @staticmethod
-    def get_new_expenses():
+    def get_new_expenses(chunksize=None, limit=None, after_id=None):
         """Retrieve expenses that do not yet have carbon calculated.
 
-        Checks to see if expense id exists in the carbon table.
+        Checks to see if expense id exists in the carbon table. Expenses
+        whose route is marked invalid are left until it is ammended in the
+        cleaner. Only the columns needed for routes are selected and loaded
+        in one query.
+
+        Args:
+            chunksize (int): if set, return the expenses in frames of up to
+                `chunksize` rows instead.
+            limit (int): maximum number of expenses to return, in order of
+                expense_id.
+            after_id (int): only return expenses with a greater expense_id,
+                to page through the expenses with `limit`.
 
         Returns:
-            ids (list): expense ids which are not in the carbon table.
+            df (pandas.DataFrame): expenses which are not in the carbon
+                table, None if there are none. An iterator of frames if
+                `chunksize` is set.
 
         """
         # Get expenses that are travel expenses but not already in
         # the `carbon` table.
-        expenses = db.session.query(Expense) \
+        expenses = db.session.query(Expense.expense_id,
+                                    Expense.expense_type,
+                                    Expense.expense_category,
+                                    Expense.expense_comment,
+                                    Expense.expense_unit_count,
+                                    Expense.expense_unit_unit) \
                      .filter(Expense.travel_expense == 1) \
                      .filter(~exists().where(
-                         Carbon.expense_id == Expense.expense_id))
-
-        df = pd.DataFrame(columns=['expense_id', 'expense_type',
-                                   'expense_category', 'expense_comment',
-                                   'expense_unit_count', 'expense_unit_unit'])
+                         Carbon.expense_id == Expense.expense_id)) \
+                     .filter(~exists().where(
+                         (Route.expense_id == Expense.expense_id) &
+                         (Route.invalid == 1)))
 
-        for expense in expenses:
-            row = {
-                'expense_id': expense.expense_id,
-                'expense_type': expense.expense_type,
-                'expense_category': expense.expense_category,
-                'expense_comment': expense.expense_comment,
-                'expense_unit_count': expense.expense_unit_count,
-                'expense_unit_unit': expense.expense_unit_unit
-            }
+        if after_id is not None:
+            expenses = expenses.filter(Expense.expense_id > after_id)
+        if limit is not None:
+            expenses = expenses.order_by(Expense.expense_id).limit(limit)
 
-            df = df.append(row, ignore_index=True)
+        df = Expense.frame_from_query(expenses, chunksize=chunksize)
 
-        if len(df) == 0:
+        if chunksize is None and len(df) == 0:
             df = None
 
         return df
@@ -10,10 +10,11 @@ Examples:
     e = Expense()
 
 """
+from flask import current_app
 from canopact.extensions import db
 from lib.util_sqlalchemy import ResourceMixin
 from canopact.blueprints.carbon.models.expense import Expense
-from vendors import expensify
+from vendors import expensify, freemarker_templates
 
 
 class Report(ResourceMixin, db.Model):
@@ -29,6 +30,9 @@ class Report(ResourceMixin, db.Model):
     # Columns.
     report_name = db.Column(db.String(100))
 
+    # Fingerprint of the ingested fields, used to skip unchanged rows.
+    content_hash = db.Column(db.String(32))
+
     expenses = db.relationship(Expense, backref="parent",
                                passive_deletes=True)
 
@@ -37,34 +41,85 @@ class Report(ResourceMixin, db.Model):
         super(Report, self).__init__(**kwargs)
 
     @staticmethod
-    def fetch_expensify_reports(User, user_ids):
-        """Fetch Expensify reports.
+    def fetch_expensify_reports(User, user_ids, max_workers=None,
+                                full_resync=False, overlap=None):
+        """Fetch Expensify reports for each user concurrently.
+
+        Requests are made on a bounded pool of threads so that the Expensify
+        round trips of different users overlap, with each partnerUserID
+        limited to `EXPENSIFY_RATE_LIMIT` requests per second. Each user
+        succeeds or fails on their own: users without credentials are
+        skipped and a failed request does not stop the remaining users from
+        being fetched.
+
+        Only reports created or updated since a user's last successful sync,
+        less `overlap`, are requested. Users that have never been synced get
+        the full default window from `Expensify.reports()`.
 
         Args:
+            User (db.Model): User model.
             user_ids (list): list of user ids.
-
-        Returns:
-            dict: user_id and report list as key value pairs.
+            max_workers (int): maximum number of users fetched at once.
+                Defaults to the `EXPENSIFY_FETCH_CONCURRENCY` setting.
+            full_resync (bool): if True, ignore the sync cursors and fetch
+                the full default window for every user.
+            overlap (datetime.timedelta): margin subtracted from each cursor.
+                Defaults to the `EXPENSIFY_SYNC_OVERLAP` setting.
+
+        Yields:
+            tuple: user_id and a generator of their reports, in the order
+                fetches complete. Reports are parsed as the generator is
+                consumed.
 
         """
-        user_reports = {}
-        for uid in user_ids:
-            user = User.query.get(uid)
-
-            # Get user Expensify API credentials.
-            partnerUserID = user.expensify_id
-            partnerUserSecret = user.expensify_secret
+        if max_workers is None:
+            max_workers = current_app.config['EXPENSIFY_FETCH_CONCURRENCY']
+        if overlap is None:
+            overlap = current_app.config['EXPENSIFY_SYNC_OVERLAP']
+
+        client_settings = {
+            'timeout': current_app.config['EXPENSIFY_TIMEOUT'],
+            'max_retries': current_app.config['EXPENSIFY_MAX_RETRIES'],
+            'backoff': current_app.config['EXPENSIFY_RETRY_BACKOFF']
+        }
 
-            if partnerUserID is not None or partnerUserSecret is not None:
-                # Get all reports from Expensify Integration Server.
-                report_list = expensify.main(partnerUserID, partnerUserSecret)
+        if current_app.config['EXPENSIFY_TRAVEL_ONLY']:
+            # Have Expensify filter out the expenses carbon isn't tracked for.
+            client_settings['template'] = freemarker_templates.travel_template(
+                current_app.config['EXPENSE_TRAVEL_CATEGORIES'])
+
+        # Get user Expensify API credentials and sync cursors.
+        credentials = db.session.query(User.id, User.expensify_id,
+                                       User.expensify_secret,
+                                       User.expensify_synced_on) \
+                                .filter(User.id.in_(user_ids))
+
+        jobs = {}
+        for uid, partnerUserID, partnerUserSecret, synced_on in credentials:
+            if not partnerUserID or not partnerUserSecret:
+                print(f'User {uid} has no Expensify credentials, skipping.')
+                continue
+
+            if synced_on is None or full_resync:
+                start_timestamp = None
             else:
-                break
+                start_timestamp = (synced_on - overlap).timestamp()
+
+            jobs[uid] = (partnerUserID, partnerUserSecret, start_timestamp)
+
+        # Get new reports from Expensify Integration Server.
+        results = expensify.iter_main(
+            jobs, concurrency=max_workers,
+            rate=current_app.config['EXPENSIFY_RATE_LIMIT'],
+            **client_settings)
 
-            # Append id as key and report list as value in dict.
-            user_reports[uid] = report_list
+        for uid, reports in results:
+            if isinstance(reports, Exception):
+                print(f'Failed to fetch Expensify reports for user {uid}: '
+                      f'{reports}')
+                continue
 
-        return user_reports
+            yield uid, reports
 
     @staticmethod
     def parse_report_from_list(reports, r_num, user_id=None):
@@ -9,14 +9,34 @@ from flask import current_app
 from canopact.extensions import db
 import pandas as pd
 import numpy as np
-import requests
-import sqlalchemy
-from sqlalchemy import or_
+from urllib.parse import quote
+from collections import Counter
+from itertools import compress
+from sqlalchemy import or_, tuple_
+from canopact.blueprints.carbon.gazetteer import get_gazetteer
+from canopact.blueprints.carbon.models.distance_cache import DistanceCache
+from canopact.blueprints.carbon.models.distance_retry import DistanceRetry
+from canopact.blueprints.carbon.place_index import get_place_index
+from lib.util_geo import haversine
+from lib.util_places import place_keys
 from lib.util_sqlalchemy import ResourceMixin
+from vendors import distance as distance_api
+
+
+AIR_CATEGORIES = ['Car, Van and Travel Expenses: Air']
+GROUND_CATEGORIES = ['Car, Van and Travel Expenses: Bus',
+                     'Car, Van and Travel Expenses: Car Hire',
+                     'Car, Van and Travel Expenses: Fuel',
+                     'Car, Van and Travel Expenses: Taxi',
+                     'Car, Van and Travel Expenses: Train']
 
 
 class Route(ResourceMixin, db.Model):
     __tablename__ = 'routes'
+    __table_args__ = (
+        db.Index('ix_routes_origin_key_destination_key',
+                 'origin_key', 'destination_key'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -31,6 +51,9 @@ class Route(ResourceMixin, db.Model):
     route_category = db.Column(db.String(100))
     origin = db.Column(db.String(100))
     destination = db.Column(db.String(100))
+    # Canonical forms of origin and destination, see lib.util_places.
+    origin_key = db.Column(db.String(100))
+    destination_key = db.Column(db.String(100))
     return_type = db.Column(db.String(10))
     invalid = db.Column(db.Integer())
     distance = db.Column(db.Float())
@@ -69,42 +92,74 @@ class Route(ResourceMixin, db.Model):
         return org, dst, type
 
     @staticmethod
-    def check_route_exists(orig, dest):
-        """Check if combination of origin/destination alreasy exists
+    def split_orig_dest_column(descriptions):
+        """Splits a column of descriptions into origin, destination and type.
+
+        Vectorised equivalent of `split_orig_dest`: a description is only
+        split if it is a string containing exactly two ';'. Anything else
+        gets None for all three fields instead of raising.
 
         Args:
-            orig (str): origin address.
-            dest (str): destination address.
+            descriptions (pandas.Series): description lines from expenses.
 
         Returns:
-            bool: True if route already exists, False otherwise.
+            df (pandas.DataFrame): columns origin, destination and
+                return_type, with the same index as `descriptions`.
 
         """
-        try:
-            routes = db.session.query(Route.id) \
-                    .filter(Route.origin == orig) \
-                    .filter(Route.destination == dest)
-            ids = [u[0] for u in routes]
-        except sqlalchemy.exc.ProgrammingError:
-            db.session.rollback()
-            print('routes have not been initialised yet')
-            # routes table has not been initialised yet.
-            return False
-
-        if len(ids) > 0:
-            return True
+        cols = ['origin', 'destination', 'return_type']
+        values = {c: np.full(len(descriptions), None, dtype=object)
+                  for c in cols}
+
+        is_str = descriptions.map(lambda d: isinstance(d, str)).to_numpy(bool)
+        valid = is_str.copy()
+        valid[is_str] = descriptions[is_str].str.count(';').to_numpy() == 2
+
+        if valid.any():
+            parts = descriptions[valid].str.split(';', expand=True)
+            for i, col in enumerate(cols):
+                values[col][valid] = parts[i].to_numpy()
+
+        return pd.DataFrame(values, index=descriptions.index)
+
+    @staticmethod
+    def get_existing_routes(pairs, chunksize=10000, keys=False):
+        """Find which origin/destination pairs already exist as routes.
+
+        Pairs are looked up with one query per `chunksize` unique pairs,
+        rather than a query for each pair.
+
+        Args:
+            pairs (iterable): (origin, destination) tuples.
+            chunksize (int): number of pairs looked up per query.
+            keys (bool): if True, `pairs` are normalised place keys and are
+                matched against origin_key and destination_key.
+
+        Returns:
+            set: (origin, destination) pairs which already exist.
+
+        """
+        pairs = list({(o, d) for o, d in pairs
+                      if isinstance(o, str) and isinstance(d, str)})
+        known = set()
+
+        if keys:
+            orig, dest = Route.origin_key, Route.destination_key
         else:
-            return False
+            orig, dest = Route.origin, Route.destination
+
+        for start in range(0, len(pairs), chunksize):
+            chunk = pairs[start:start + chunksize]
+            routes = db.session.query(orig, dest) \
+                .filter(tuple_(orig, dest).in_(chunk)) \
+                .distinct()
+            known.update((o, d) for o, d in routes)
+
+        return known
 
     @staticmethod
-    def get_route_type(category, air_cats=[
-                        'Car, Van and Travel Expenses: Air'],
-                       ground_cats=[
-                                    'Car, Van and Travel Expenses: Bus',
-                                    'Car, Van and Travel Expenses: Car Hire',
-                                    'Car, Van and Travel Expenses: Fuel',
-                                    'Car, Van and Travel Expenses: Taxi',
-                                    'Car, Van and Travel Expenses: Train']):
+    def get_route_type(category, air_cats=AIR_CATEGORIES,
+                       ground_cats=GROUND_CATEGORIES):
         """Categorises expense category into 'air' or 'ground' modes of travel.
 
         Args:
@@ -126,39 +181,122 @@ class Route(ResourceMixin, db.Model):
             raise ValueError(f"{category} not in {air_cats} or {ground_cats}")
 
     @staticmethod
-    def get_ammended_routes():
+    def update_place_keys(batch_size=1000):
+        """Fill in origin_key and destination_key for routes without them.
+
+        Args:
+            batch_size (int): number of routes updated per commit.
+
+        Returns:
+            int: number of routes updated.
+
+        """
+        missing = db.session.query(Route.id, Route.origin, Route.destination) \
+            .filter(Route.origin.isnot(None)) \
+            .filter(Route.destination.isnot(None)) \
+            .filter(or_(Route.origin_key.is_(None),
+                        Route.destination_key.is_(None))) \
+            .order_by(Route.id)
+
+        df = Route.frame_from_query(missing)
+        df['origin_key'] = place_keys(df['origin'])
+        df['destination_key'] = place_keys(df['destination'])
+
+        rows = df[['id', 'origin_key', 'destination_key']].to_dict('records')
+        for start in range(0, len(rows), batch_size):
+            db.session.bulk_update_mappings(Route,
+                                            rows[start:start + batch_size])
+            db.session.commit()
+
+        return len(rows)
+
+    @staticmethod
+    def get_route_types(categories, air_cats=AIR_CATEGORIES,
+                        ground_cats=GROUND_CATEGORIES):
+        """Categorises a column of expense categories into modes of travel.
+
+        Vectorised equivalent of `get_route_type`, using a dictionary lookup
+        over the whole column.
+
+        Args:
+            categories (pandas.Series): expense categories.
+            air_cats (list): categories for air modes of travel.
+            ground_cats (list): categories for ground modes of travel.
+
+        Raises:
+            ValueError: if any category not in `air_cats` or `ground_cats`.
+
+        Returns:
+            pandas.Series: air or ground depending on each category.
+
+        """
+        # Air is checked first by get_route_type, so it wins any overlap.
+        lookup = {**{c: 'ground' for c in ground_cats},
+                  **{c: 'air' for c in air_cats}}
+        route_types = categories.map(lookup)
+
+        unknown = route_types.isnull()
+        if unknown.any():
+            # Raise the same error the scalar lookup would.
+            Route.get_route_type(categories[unknown].iloc[0], air_cats,
+                                 ground_cats)
+
+        return route_types.astype(object)
+
+    @staticmethod
+    def get_ammended_routes(chunksize=None, limit=None, after_id=None):
         """Get routes that have had their origin/destination updated.
 
         These routes still need to have a distance calculated for them.
+        Routes marked invalid are left for the cleaner, which clears the
+        flag when it ammends them. Only the columns needed are selected and
+        loaded in one query, and the place keys are recomputed from the
+        ammended origin/destination.
+
+        Args:
+            chunksize (int): if set, return the routes in frames of up to
+                `chunksize` rows instead.
+            limit (int): maximum number of routes to return, in order of id.
+            after_id (int): only return routes with a greater id, to page
+                through the routes with `limit`.
+
+        Returns:
+            df (pandas.DataFrame): ammended routes, None if there are none.
+                An iterator of frames if `chunksize` is set.
 
         """
-        routes = db.session.query(Route) \
+        routes = db.session.query(Route.id,
+                                  Route.expense_id,
+                                  Route.expense_category,
+                                  Route.route_category,
+                                  Route.origin,
+                                  Route.destination,
+                                  Route.return_type) \
                    .filter(Route.origin.isnot(None)) \
                    .filter(Route.destination.isnot(None)) \
-                   .filter(Route.distance.is_(None))
-
-        df = pd.DataFrame(columns=['id', 'expense_id', 'expense_category'
-                                   'route_category', 'origin', 'destination',
-                                   'return_type', 'exists'])
-
-        for route in routes:
-            row = {
-                'id': route.id,
-                'expense_id': route.expense_id,
-                'expense_category': route.expense_category,
-                'route_category': route.route_category,
-                'origin': route.origin,
-                'destination': route.destination,
-                'return_type': route.return_type,
-                'exists': False
-            }
-
-            df = df.append(row, ignore_index=True)
+                   .filter(Route.distance.is_(None)) \
+                   .filter(or_(Route.invalid.is_(None), Route.invalid != 1))
+
+        if after_id is not None:
+            routes = routes.filter(Route.id > after_id)
+        if limit is not None:
+            routes = routes.order_by(Route.id).limit(limit)
+
+        df = Route.frame_from_query(routes, chunksize=chunksize)
+
+        def assign_keys(chunk):
+            return chunk.assign(origin_key=place_keys(chunk['origin']),
+                                destination_key=place_keys(
+                                    chunk['destination']),
+                                exists=False)
+
+        if chunksize is not None:
+            return (assign_keys(chunk) for chunk in df)
 
         if len(df) == 0:
-            df = None
+            return None
 
-        return df
+        return assign_keys(df)
 
     @staticmethod
     def create_routes(df=None, comment_col='expense_comment',
@@ -174,38 +312,43 @@ class Route(ResourceMixin, db.Model):
 
         Returns:
             df (pandas.DataFrame): dataframe containing new columns: origin,
-                destination, exists and route category.
+                destination, their place keys, exists and route category.
 
         """
-
-        def apply_route_methods(row):
-            """Helper function to apply methods from Routes to the `new` DataFrame.
-
-            Returns
-                row (pd.DataFrame): row containing updated route fields.
-            """
-            row['id'] = None
-
-            if row[type_col] != 'expense':
-                row['route_category'] = 'unit'
-            else:
-                try:
-                    org, dst, type = Route.split_orig_dest(row[comment_col])
-                except(ValueError, TypeError):
-                    org, dst, type = None, None, None
-
-                row['origin'] = org
-                row['destination'] = dst
-                row['return_type'] = type
-                exists = Route.check_route_exists(org, dst)
-                row['exists'] = exists
-                row['route_category'] = Route.get_route_type(row[category_col])
-                row['distance'] = None
-
-            return row
-
         if df is not None:
-            df = df.apply(lambda row: apply_route_methods(row), axis=1)
+            df = df.copy()
+            df['id'] = None
+
+            # Unit expenses only get a route category, so every other route
+            # column is left null for them.
+            expense_rows = (df[type_col] == 'expense').to_numpy()
+            cols = {c: np.full(len(df), np.nan, dtype=object)
+                    for c in ['origin', 'destination', 'origin_key',
+                              'destination_key', 'return_type', 'exists',
+                              'route_category', 'distance']}
+            cols['route_category'][~expense_rows] = 'unit'
+
+            if expense_rows.any():
+                expenses = df[expense_rows]
+                parts = Route.split_orig_dest_column(expenses[comment_col])
+                parts['origin_key'] = place_keys(parts['origin'])
+                parts['destination_key'] = place_keys(parts['destination'])
+                for col in parts:
+                    cols[col][expense_rows] = parts[col].to_numpy()
+
+                # Look up every origin/destination pair in one go, matching
+                # on place keys so spelling variants count as the same route.
+                pairs = list(zip(parts['origin_key'],
+                                 parts['destination_key']))
+                known = Route.get_existing_routes(pairs, keys=True)
+                cols['exists'][expense_rows] = [p in known for p in pairs]
+
+                route_types = Route.get_route_types(expenses[category_col])
+                cols['route_category'][expense_rows] = route_types.to_numpy()
+                cols['distance'][expense_rows] = None
+
+            for col, values in cols.items():
+                df[col] = values
 
         if ammend:
             # Append on the ammended routes to the new routes.
@@ -252,98 +395,261 @@ class Distance():
     """Contains related methods for distance calculations."""
 
     @staticmethod
-    def get_ground_urls(df, orig_col='origin', dest_col='destination',
-                        unit='metric', mode='driving', url=None,  key=None):
-        """ Create urls for distance matrix api requests.
+    def request_settings(provider):
+        """Concurrency, timeout and rate limit for requests to a provider.
 
-        Checks if origin/destination pairing is new and builds url if new.
+        Args:
+            provider (str): name of the distance API, e.g. 'google'.
+
+        Returns:
+            dict: keyword arguments for `vendors.distance.fetch_json`.
+
+        """
+        return {
+            'max_in_flight': current_app.config['DISTANCE_MAX_IN_FLIGHT'],
+            'timeout': current_app.config['DISTANCE_TIMEOUT'],
+            'rate': current_app.config['DISTANCE_RATE_LIMITS'].get(provider)
+        }
+
+    @staticmethod
+    def print_failures(message, statuses):
+        """Prints each failure status once, with how often it occurred.
 
         Args:
-            df (pandas.DataFrame): contains origin and destination addresses
-                to have urls built for them.
-            orig_col (str): name of origin column in df.
-            dest_col (str): name of destination column in df.
-            unit (str): unit of distance to include in url.
-            mode (str): travel mode: can be 'driving' or 'transit'.
-            url (str): base url for api.
-            key (str): api key.
+            message (str): start of the message, followed by the status.
+            statuses (numpy.ndarray): status of each failed request.
+
+        """
+        for status, count in Counter(statuses).items():
+            print(f"{message}{status} ({count} requests)")
+
+    @staticmethod
+    def parse_elements(elements):
+        """Parses elements of Distance Matrix API responses, as arrays.
+
+        Args:
+            elements (list): entries of `rows[i]['elements']`, None where
+                there is no element.
 
         Returns:
-            df (pandas.DataFrame): with new column `url`.
+            tuple: arrays of the distance in km for each element, NaN where
+                there is no element or it has no route, and of its status.
 
         """
-        if url is None:
-            url = current_app.config['DISTANCE_URL']
-        if key is None:
-            key = current_app.config['DISTANCE_KEY']
+        status = np.array([e['status'] if e is not None else None
+                           for e in elements], dtype=object)
+        ok = status == 'OK'
 
-        def build_url(row):
-            """Helper function to build urls."""
+        metres = np.array([e['distance']['value'] if o else np.nan
+                           for e, o in zip(elements, ok)], dtype=float)
 
-            if row[orig_col] is None or row[dest_col] is None:
-                request = None
-            else:
-                request = ''.join([url, f'units={unit}', f'&mode={mode}',
-                                   f'&origins={row[orig_col]}',
-                                   f'&destinations={row[dest_col]}',
-                                   f'&key={key}'])
+        Distance.print_failures(
+            "Distance Matrix API request failed with status code:",
+            status[~ok & pd.notnull(status)])
 
-            return request
+        # Convert from metres into km.
+        return metres / 1000, status
 
-        df['url'] = df.apply(lambda row: build_url(row), axis=1)
+    @staticmethod
+    def parse_air_jsons(jsons):
+        """Parses distance24 API responses, as arrays.
 
-        return df
+        Args:
+            jsons (list): decoded responses, None where there was no request.
+
+        Returns:
+            tuple: Series of the distance for each response, None where there
+                was no request or it failed, and an array of statuses:
+                'OK', 'INVALID_STOPS' or the status of a failed request.
+
+        """
+        raw = np.array([j.get('distance') if j is not None else None
+                        for j in jsons], dtype=object)
+        received = pd.notnull(raw)
+
+        valid = received.copy()
+        valid[received] = (raw[received] > 0).astype(bool)
+
+        invalid = (received & ~valid).sum()
+        if invalid:
+            print(f"Distance24 API request failed with status: "
+                  f"invalid stops. ({invalid} requests)")
+
+        status = np.array([None if j is None else j.get('status')
+                           for j in jsons], dtype=object)
+        status[received] = np.where(valid[received], 'OK', 'INVALID_STOPS')
+
+        # Built from a list so the dtype is inferred as it was per row.
+        return pd.Series(np.where(valid, raw, None).tolist()), status
 
     @staticmethod
-    def calculate_ground_distance(df, url_col='url'):
-        """Calculates distance for ground modes of Travel.
+    def plan_matrix_requests(pairs, max_elements=100, max_places=25,
+                             max_length=8192):
+        """Packs origin/destination pairs into Distance Matrix requests.
 
-        Distance calculation is made by the Google Maps Distance Matrix API.
+        The place with the most outstanding pairs is repeatedly requested
+        against all of its partners, as one origin and many destinations or
+        many origins and one destination. This means no element is requested
+        that isn't needed, while routes sharing a home or office share a
+        request.
 
-        Notes:
-            Requires each url to only request one element.
+        Pairs that share neither their origin nor their destination with
+        another pair are left unbatched, one element per request. Packing
+        them into an origins x destinations block would bill an element for
+        every combination, almost all of which aren't wanted.
 
         Args:
-            df (pandas.DataFrame): dataframe for making requests on.
-            url_col (str): column name that contains urls for api request.
+            pairs (iterable): unique (origin, destination) tuples.
+            max_elements (int): most elements allowed per request.
+            max_places (int): most origins or destinations per request.
+            max_length (int): characters available for the url encoded
+                origins and destinations of each request.
 
         Returns:
-            df (pandas.DataFrame): with new column `distance`.
+            list: (origins, destinations) lists for each request.
 
         """
-        urls = df[url_col].tolist()
-        responses = [requests.get(u) if u is not None else None for u in urls]
-        jsons = [r.json() if r is not None else None for r in responses]
-        df['json'] = np.array(jsons)
-
-        def parse_json(row):
-            """Parses responses from the distance matrix api"""
+        by_orig = {}
+        by_dest = {}
+        for orig, dest in dict.fromkeys(pairs):
+            by_orig.setdefault(orig, []).append(dest)
+            by_dest.setdefault(dest, []).append(orig)
 
-            json = row['json']
+        limit = min(max_elements, max_places)
+        plan = []
 
-            if json is None:
-                return None
+        while by_orig:
+            orig = max(by_orig, key=lambda o: len(by_orig[o]))
+            dest = max(by_dest, key=lambda d: len(by_dest[d]))
 
-            if json['status'] == 'OK':
-                element = json['rows'][0]['elements'][0]
-            else:
-                print(f"Distance Matrix API request failed with status code:"
-                      f"{json['status']}")
-                return None
-
-            if element['status'] == 'OK':
-                distance = element['distance']['value']
-                # Convert from metres into km.
-                distance = distance / 1000
+            if len(by_orig[orig]) >= len(by_dest[dest]):
+                hub, partners, from_orig = orig, by_orig.pop(orig), True
             else:
-                print(f"Distance Matrix API request failed with status code:"
-                      f"{element['status']}")
-                distance = None
+                hub, partners, from_orig = dest, by_dest.pop(dest), False
+
+            # Split the partners so each request fits the limits.
+            chunks = [[]]
+            length = len(quote(hub))
+            for partner in partners:
+                size = len(quote(partner)) + len(quote('|'))
+                if len(chunks[-1]) == limit or \
+                        length + size > max_length and chunks[-1]:
+                    chunks.append([])
+                    length = len(quote(hub))
+                chunks[-1].append(partner)
+                length += size
+
+            for chunk in chunks:
+                if from_orig:
+                    plan.append(([hub], chunk))
+                else:
+                    plan.append((chunk, [hub]))
+
+            # Remove the requested pairs from the other side's index.
+            other = by_dest if from_orig else by_orig
+            for partner in partners:
+                other[partner].remove(hub)
+                if not other[partner]:
+                    del other[partner]
 
-            return distance
+        return plan
 
-        df['distance'] = df.apply(lambda row: parse_json(row), axis=1)
+    @staticmethod
+    def calculate_ground_matrix(df, orig_col='origin', dest_col='destination',
+                                unit='metric', mode='driving', url=None,
+                                key=None, max_elements=None, max_places=None,
+                                max_url_length=None):
+        """Calculates ground distances with multi-element matrix requests.
+
+        Unique pairs are packed into as few Distance Matrix requests as the
+        API's limits allow by `plan_matrix_requests`, and each
+        `rows[i].elements[j]` of the responses is unpacked back to its pair,
+        along with its status.
+
+        Args:
+            df (pandas.DataFrame): contains origin and destination addresses.
+            orig_col (str): name of origin column in df.
+            dest_col (str): name of destination column in df.
+            unit (str): unit of distance to include in url.
+            mode (str): travel mode: can be 'driving' or 'transit'.
+            url (str): base url for api.
+            key (str): api key.
+            max_elements (int): most elements per request.
+            max_places (int): most origins or destinations per request.
+            max_url_length (int): longest url allowed.
+
+        Returns:
+            df (pandas.DataFrame): with new columns `distance` and `status`.
+
+        """
+        config = current_app.config
+        if url is None:
+            url = config['DISTANCE_URL']
+        if key is None:
+            key = config['DISTANCE_KEY']
+        if max_elements is None:
+            max_elements = config['DISTANCE_MATRIX_MAX_ELEMENTS']
+        if max_places is None:
+            max_places = config['DISTANCE_MATRIX_MAX_PLACES']
+        if max_url_length is None:
+            max_url_length = config['DISTANCE_MATRIX_MAX_URL_LENGTH']
+
+        base = ''.join([url, f'units={unit}', f'&mode={mode}', '&origins=',
+                        '&destinations=', f'&key={key}'])
+
+        pairs = list(zip(df[orig_col], df[dest_col]))
+        wanted = [p for p in pairs if p[0] is not None and p[1] is not None]
+        plan = Distance.plan_matrix_requests(
+            wanted, max_elements=max_elements, max_places=max_places,
+            max_length=max_url_length - len(quote(base, safe=':/?&=')))
+
+        urls = [''.join([url, f'units={unit}', f'&mode={mode}',
+                         f'&origins={"|".join(origins)}',
+                         f'&destinations={"|".join(destinations)}',
+                         f'&key={key}'])
+                for origins, destinations in plan]
+
+        print(f"{len(wanted)} ground routes packed into {len(urls)} "
+              f"Distance Matrix requests.")
+
+        settings = Distance.request_settings('google')
+        jsons = distance_api.fetch_json(
+            urls, 'google', elements=[len(o) * len(d) for o, d in plan],
+            **settings)
+
+        status = np.array([j['status'] if j is not None else None
+                           for j in jsons], dtype=object)
+        ok = status == 'OK'
+
+        Distance.print_failures(
+            "Distance Matrix API request failed with status code:",
+            status[~ok & pd.notnull(status)])
+
+        # Flatten rows[i].elements[j] of each response into one list. Pairs
+        # of a failed request get no element and the request's status, which
+        # is never one of PERMANENT_STATUSES, so they aren't made invalid.
+        requested = []
+        elements = []
+        failed = []
+        for (origins, destinations), json, s in zip(plan, jsons, status):
+            for i, orig in enumerate(origins):
+                row = json['rows'][i]['elements'] if s == 'OK' else None
+                for j, dest in enumerate(destinations):
+                    requested.append((orig, dest))
+                    elements.append(row[j] if row is not None else None)
+                    failed.append(s != 'OK')
+
+        km, element_status = Distance.parse_elements(elements)
+        request_status = np.repeat(
+            status, [len(o) * len(d) for o, d in plan]).astype(object)
+        statuses = np.where(failed, request_status, element_status)
+
+        distances = dict(zip(requested, km))
+        statuses = dict(zip(requested, statuses))
+
+        df['distance'] = [distances.get(p) for p in pairs]
         df['distance'] = df['distance'].replace(0, np.NaN)
+        df['status'] = [statuses.get(p) for p in pairs]
 
         return df
 
@@ -388,32 +694,86 @@ class Distance():
             url_col (str): column name that contains urls for api request.
 
         Returns:
-            df (pandas.DataFrame): with new column `distance`.
+            df (pandas.DataFrame): with new columns `distance` and `status`.
 
         """
         urls = df[url_col].tolist()
-        responses = [requests.get(u) if u is not None else None for u in urls]
-        jsons = [r.json() if r is not None else None for r in responses]
+        settings = Distance.request_settings('distance24')
+        jsons = distance_api.fetch_json(urls, 'distance24', **settings)
         df['json'] = np.array(jsons)
 
-        def parse_json(row):
-            """Parses responses from the distance24 api"""
+        distances, df['status'] = Distance.parse_air_jsons(jsons)
+        distances.index = df.index
+        df['distance'] = distances
 
-            json = row['json']
+        return df
 
-            if json is None:
-                return None
+    @staticmethod
+    def resolve_coordinates(places):
+        """Resolve places to coordinates in bulk, without any network calls.
 
-            if json['distance'] > 0:
-                distance = json['distance']
-            else:
-                print(f"Distance24 API request failed with status: "
-                      f"invalid stops.")
-                distance = None
+        IATA codes and airport or city names in the airport gazetteer are
+        resolved first, then anything left from the place index if one is
+        configured.
 
-            return distance
+        Args:
+            places (pandas.Series): free text place names or IATA codes.
 
-        df['distance'] = df.apply(lambda row: parse_json(row), axis=1)
+        Returns:
+            tuple: latitude and longitude arrays, NaN where unresolved.
+
+        """
+        lat, lon = get_gazetteer().coordinates(places)
+
+        index = get_place_index()
+        missing = np.isnan(lat)
+        if index is not None and missing.any():
+            lat[missing], lon[missing] = index.coordinates(places[missing])
+
+        return lat, lon
+
+    @staticmethod
+    def calculate_air_gazetteer(df, orig_col='origin', dest_col='destination',
+                                fallback=True):
+        """Calculates flight distances offline from the airport gazetteer.
+
+        Origins and destinations are resolved to coordinates by
+        `resolve_coordinates` and their great-circle distance is calculated
+        for the whole batch at once. Only the routes that can't be resolved
+        are requested from distance24.org.
+
+        Args:
+            df (pandas.DataFrame): contains origin and destination addresses.
+            orig_col (str): name of origin column in df.
+            dest_col (str): name of destination column in df.
+            fallback (bool): if True, request unresolved routes from
+                distance24.org.
+
+        Returns:
+            df (pandas.DataFrame): with new columns `distance`, `provider`
+                and `status`.
+
+        """
+        km = haversine(*Distance.resolve_coordinates(df[orig_col]),
+                       *Distance.resolve_coordinates(df[dest_col]))
+        unresolved = np.isnan(km)
+
+        df['distance'] = np.round(km, 1)
+        df['provider'] = np.where(unresolved, None, 'gazetteer')
+        df['status'] = np.where(unresolved, None, 'OK')
+
+        print(f"{(~unresolved).sum()} of {len(df)} air routes resolved by "
+              f"the gazetteer.")
+
+        if fallback and unresolved.any():
+            rest = df.loc[unresolved, [orig_col, dest_col]].copy()
+            rest = Distance.calculate_air_distance(Distance.get_air_urls(rest))
+            df.loc[unresolved, 'distance'] = rest['distance'].to_numpy()
+            df.loc[unresolved, 'provider'] = 'distance24'
+            df.loc[unresolved, 'status'] = rest['status'].to_numpy()
+
+        # Same origin and destination, as distance24 treats it.
+        df['distance'] = df['distance'].replace(0, np.NaN)
 
         return df
 
@@ -422,6 +782,8 @@ class Distance():
                           unit_col='expense_unit_unit'):
         """Retrieve the distance from 'distance' expense reports.
 
+        Distances in miles are converted to km.
+
         Args:
             df (pandas.DataFrame): contains distance expense reports.
             distance_col (str): name of column that contains distance amount.
@@ -432,16 +794,10 @@ class Distance():
 
         """
 
-        def convert_distance(row):
-            """Helper function to convert distance into correct unit."""
-            if row[unit_col] == 'mi':
-                distance = row[distance_col] * 1.609
-            else:
-                distance = row[distance_col]
-
-            return distance
+        distance = df[distance_col]
+        miles = (df[unit_col] == 'mi').to_numpy()
 
-        df['distance'] = df.apply(lambda row: convert_distance(row), axis=1)
+        df['distance'] = distance.where(~miles, distance * 1.609)
 
         return df
 
@@ -459,32 +815,123 @@ class Distance():
 
         """
 
-        def double(row):
-            """Helper function to double distance if route is a  return trip.
+        # Any return_type containing an 'r', e.g. 'R' or 'return', is a
+        # return trip. Nulls are compared as 'None' and 'nan' so never match.
+        types = df[type_col].astype(str)
+        returns = (types.str.contains('r', regex=False) |
+                   types.str.contains('R', regex=False)).to_numpy()
 
-            First checks is return_type col is null.
+        distance = pd.to_numeric(df[distance_col], errors='coerce')
+        df[distance_col] = distance.where(~returns, distance * 2)
 
-            """
-            type = row[type_col]
+        return df
 
-            if type is not None or type != np.NaN:
-                type = str(type)
-                if 'r' in type or 'R' in type:
-                    try:
-                        distance = row[distance_col] * 2
-                    except TypeError:
-                        distance = row[distance_col]
-                else:
-                    distance = row[distance_col]
-            else:
-                distance = row[distance_col]
+    @staticmethod
+    def distance_per_pair(df, lookup, mode=None, provider=None,
+                          orig_col='origin', dest_col='destination'):
+        """Looks up the distance once for each unique origin/destination.
+
+        Routes often share the same origin and destination, so routes are
+        collapsed to their normalised place keys and the distances are then
+        broadcast back to every route with that pair. If `mode` is given,
+        the distance cache is consulted first and only the misses are looked
+        up, with the new distances written back to the cache.
+
+        Pairs already waiting in the retry queue aren't looked up and get
+        the status DEFERRED. Misses whose lookup fails transiently are added
+        to the queue, see `DistanceRetry`. Misses deferred by a provider's
+        call budget or circuit breaker are left for the next run.
+
+        Args:
+            df (pandas.DataFrame): routes of a single route category.
+            lookup (callable): takes a DataFrame of unique origin and
+                destination pairs and returns it with a `distance` column,
+                and optionally `provider` and `status` columns naming its
+                source and the status of its request.
+            mode (str): route category of the routes, to use the cache.
+            provider (str): name of the api `lookup` calls, if it doesn't
+                return a `provider` column.
+            orig_col (str): name of origin column in df.
+            dest_col (str): name of destination column in df.
 
-            return distance
+        Returns:
+            df (pandas.DataFrame): with new columns `distance` and `status`.
 
-        df[distance_col] = df.apply(lambda row: double(row), axis=1)
+        """
+        keys = list(zip(place_keys(df[orig_col]), place_keys(df[dest_col])))
+
+        # The first spelling of each pair is the one looked up.
+        unique = {}
+        for key, orig, dest in zip(keys, df[orig_col], df[dest_col]):
+            if None not in key and key not in unique:
+                unique[key] = (orig, dest)
+
+        distances = {}
+        statuses = {}
+        if mode is not None:
+            distances = DistanceCache.lookup(unique, mode)
+            queued = DistanceRetry.queued(
+                [k for k in unique if k not in distances], mode)
+            statuses.update(dict.fromkeys(queued, distance_api.DEFERRED))
+
+        misses = [k for k in unique
+                  if k not in distances and k not in statuses]
+
+        print(f"{len(unique)} unique origin/destination pairs for "
+              f"{len(df)} routes, {len(distances)} cached and "
+              f"{len(statuses)} awaiting retry.")
+
+        if misses:
+            pairs = pd.DataFrame([unique[k] for k in misses],
+                                 columns=[orig_col, dest_col], dtype=object)
+            pairs = lookup(pairs)
+            found = dict(zip(misses, pairs['distance']))
+
+            if 'status' in pairs:
+                statuses.update(zip(misses, pairs['status']))
+
+            if mode is not None and 'status' in pairs:
+                failures = {k: (*unique[k], s)
+                            for k, s in zip(misses, pairs['status'])
+                            if s in distance_api.TRANSIENT_STATUSES}
+                DistanceRetry.enqueue(failures, mode)
+
+            if mode is not None and 'provider' in pairs:
+                # The lookup used more than one provider.
+                for name in pairs['provider'].dropna().unique():
+                    used = set(compress(misses, pairs['provider'] == name))
+                    DistanceCache.store(
+                        {k: v for k, v in found.items() if k in used},
+                        mode, name)
+            elif mode is not None:
+                DistanceCache.store(found, mode, provider)
+
+            distances.update(found)
+
+        df = df.copy()
+        df['distance'] = [distances.get(k) for k in keys]
+        df['status'] = [statuses.get(k, 'OK' if k in distances else None)
+                        for k in keys]
 
         return df
 
+    @staticmethod
+    def lookup_for(mode):
+        """Lookup used by `distance_per_pair` for a route category.
+
+        Args:
+            mode (str): route category, 'ground' or 'air'.
+
+        Returns:
+            tuple: the lookup function and the provider it calls, None if it
+                returns a `provider` column.
+
+        """
+        lookups = {'ground': (Distance.calculate_ground_matrix, 'google'),
+                   'air': (Distance.calculate_air_gazetteer, None)}
+
+        return lookups[mode]
+
     @staticmethod
     def calculate_distance(df, category_col="route_category"):
         """Wrapper function to calculate distance for routes.
@@ -513,20 +960,16 @@ class Distance():
             unit_distance = pd.DataFrame(columns=cols, index=[0])
 
         if len(grnd) > 0:
-            urls = Distance.get_ground_urls(grnd)
-            ground_distance = Distance.calculate_ground_distance(urls)
-            # Remove unrequired columns.
-            ground_distance.drop(['url', 'json'], axis=1, errors='ignore',
-                                 inplace=True)
+            lookup, provider = Distance.lookup_for('ground')
+            ground_distance = Distance.distance_per_pair(
+                grnd, lookup, mode='ground', provider=provider)
         else:
             ground_distance = pd.DataFrame(columns=cols, index=[0])
 
         if len(air) > 0:
-            air_urls = Distance.get_air_urls(air)
-            air_distance = Distance.calculate_air_distance(air_urls)
-            # Remove unrequired columns.
-            air_distance.drop(['url', 'json'], axis=1, errors='ignore',
-                              inplace=True)
+            lookup, provider = Distance.lookup_for('air')
+            air_distance = Distance.distance_per_pair(
+                air, lookup, mode='air', provider=provider)
         else:
             air_distance = pd.DataFrame(columns=cols, index=[0])
 
@@ -535,8 +978,18 @@ class Distance():
         # Double the distances for return trips.
         distances = Distance.return_distance(distances)
 
-        # Add the invalid marker for any routes that don't have a distance.
-        distances.loc[distances['distance'].isnull(), 'invalid'] = 1
+        # Add the invalid marker for routes without a distance only if there
+        # was nothing to look up, or the lookup found no route between the
+        # places. Any other failure, e.g. a transient error, a request-level
+        # error like REQUEST_DENIED or a deferred call, is retried by the
+        # `retry_distances` task or the next run.
+        if 'status' not in distances:
+            distances['status'] = None
+        status = distances['status']
+        deferred = (status.notnull() & (status != 'OK') &
+                    ~status.isin(distance_api.PERMANENT_STATUSES))
+        distances.loc[distances['distance'].isnull() & ~deferred,
+                      'invalid'] = 1
 
         # Remove any rows that contain a null id.
         distances = distances[distances[category_col].notna()]
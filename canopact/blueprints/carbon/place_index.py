@@ -0,0 +1,241 @@
+"""Local index for resolving place names to coordinates.
+
+The index is built from a GeoNames cities file (e.g. cities15000.txt from
+https://download.geonames.org/export/dump/) plus the bundled airports, and
+saved as one numpy structured array sorted by normalised place key. Workers
+memory-map the file, so it is shared between processes and only the pages
+touched by lookups are read.
+
+The sorted keys serve as both the hash map and the prefix trie: exact keys
+are found by binary search, and every key starting with a prefix sits in one
+contiguous range of the array.
+
+Examples:
+    PlaceIndex.build('cities15000.txt', 'places.npy')
+    index = PlaceIndex.load('places.npy')
+    lat, lon = index.coordinates(pd.Series(['Harrow, London']))
+"""
+
+import threading
+
+from flask import current_app
+import numpy as np
+import pandas as pd
+
+from canopact.blueprints.carbon.gazetteer import AIRPORTS_PATH
+from lib.util_places import place_keys
+
+# Longest key stored, in utf-8 bytes. Longer names are left out.
+KEY_BYTES = 64
+
+DTYPE = np.dtype([('key', f'S{KEY_BYTES}'),
+                  ('latitude', 'f4'),
+                  ('longitude', 'f4'),
+                  ('population', 'i8')])
+
+# Population given to airports so they win over any city with the same key.
+AIRPORT_POPULATION = 10 ** 12
+
+# Columns of a GeoNames dump used for the index.
+GEONAMES_COLUMNS = {1: 'name', 2: 'asciiname', 4: 'latitude',
+                    5: 'longitude', 8: 'country', 14: 'population'}
+
+_index = None
+_lock = threading.Lock()
+
+
+class PlaceIndex():
+    """Resolves place names to coordinates from a sorted key array.
+
+    Args:
+        data (numpy.ndarray): array of DTYPE sorted by key, usually memory
+            mapped.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.keys = data['key']
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def build(source, output):
+        """Build an index file from a GeoNames dump and the airports csv.
+
+        Each place is keyed by its name, its ascii name and both with the
+        country code. Where a key is shared the most populous place wins,
+        and airports always win over cities.
+
+        Args:
+            source (str): path to a tab separated GeoNames dump.
+            output (str): path to write the index to.
+
+        Returns:
+            int: number of keys in the index.
+
+        """
+        cities = pd.read_csv(source, sep='\t', header=None, quoting=3,
+                             usecols=list(GEONAMES_COLUMNS),
+                             keep_default_na=False, low_memory=False) \
+            .rename(columns=GEONAMES_COLUMNS)
+        cities['population'] = pd.to_numeric(cities['population'],
+                                             errors='coerce').fillna(0)
+
+        names = [cities['name'], cities['asciiname'],
+                 cities['name'] + ', ' + cities['country'],
+                 cities['asciiname'] + ', ' + cities['country']]
+        frames = [cities[['latitude', 'longitude', 'population']]
+                  .assign(key=place_keys(n)) for n in names]
+
+        airports = pd.read_csv(AIRPORTS_PATH, keep_default_na=False)
+        for name in [airports['iata'], airports['name'] + ' airport',
+                     airports['city'] + ' ' + airports['name']]:
+            frames.append(airports[['latitude', 'longitude']]
+                          .assign(key=place_keys(name),
+                                  population=AIRPORT_POPULATION))
+
+        df = pd.concat(frames, ignore_index=True).dropna(subset=['key'])
+        df['key'] = df['key'].str.encode('utf-8')
+        df = df[df['key'].str.len() <= KEY_BYTES] \
+            .sort_values(['key', 'population'], ascending=[True, False]) \
+            .drop_duplicates('key')
+
+        data = np.empty(len(df), dtype=DTYPE)
+        for col in DTYPE.names:
+            data[col] = df[col].to_numpy()
+
+        np.save(output, data, allow_pickle=False)
+
+        return len(data)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map an index file.
+
+        Args:
+            path (str): index file written by `build`.
+
+        Returns:
+            PlaceIndex: the index.
+
+        """
+        return cls(np.load(path, mmap_mode='r', allow_pickle=False))
+
+    def lookup(self, keys):
+        """Find the exact position of each key.
+
+        Args:
+            keys (pandas.Series): normalised place keys, None for no key.
+
+        Returns:
+            numpy.ndarray: position of each key, -1 where it isn't indexed.
+
+        """
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+
+        encoded = np.array([k.encode('utf-8') if isinstance(k, str) else b''
+                            for k in keys], dtype=self.keys.dtype)
+
+        positions = np.searchsorted(self.keys, encoded)
+        clipped = np.minimum(positions, len(self.keys) - 1)
+        found = (encoded != b'') & (self.keys[clipped] == encoded)
+
+        return np.where(found, clipped, -1)
+
+    def lookup_prefix(self, key):
+        """Find the most populous place whose key starts with `key`.
+
+        Only whole words match, so "york" finds "york uk" but not
+        "yorktown".
+
+        Args:
+            key (str): normalised place key.
+
+        Returns:
+            int: position of the place, -1 if there is none.
+
+        """
+        prefix = (key + ' ').encode('utf-8')
+        if len(prefix) > KEY_BYTES:
+            return -1
+
+        lo = np.searchsorted(self.keys, prefix, side='left')
+        hi = np.searchsorted(self.keys, prefix + b'\xff', side='left')
+        if hi <= lo:
+            return -1
+
+        return lo + int(np.argmax(self.data['population'][lo:hi]))
+
+    def resolve(self, places):
+        """Find the indexed place for each place name.
+
+        Tries the whole name, then the part before the first comma, then a
+        whole word prefix of the name.
+
+        Args:
+            places (pandas.Series): free text place names.
+
+        Returns:
+            numpy.ndarray: position of each place, -1 where unresolved.
+
+        """
+        keys = place_keys(places)
+        positions = self.lookup(keys)
+
+        missing = positions < 0
+        if missing.any():
+            first = places[missing].map(
+                lambda p: p.split(',')[0] if isinstance(p, str) else None)
+            positions[missing] = self.lookup(place_keys(first))
+
+        for i in np.flatnonzero(positions < 0):
+            if keys.iloc[i] is not None:
+                positions[i] = self.lookup_prefix(keys.iloc[i])
+
+        return positions
+
+    def coordinates(self, places):
+        """Resolve place names to coordinates in bulk.
+
+        Args:
+            places (pandas.Series): free text place names.
+
+        Returns:
+            tuple: latitude and longitude arrays, NaN where unresolved.
+
+        """
+        positions = self.resolve(places)
+        found = positions >= 0
+
+        lat = np.full(len(positions), np.nan)
+        lon = np.full(len(positions), np.nan)
+        lat[found] = self.data['latitude'][positions[found]]
+        lon[found] = self.data['longitude'][positions[found]]
+
+        return lat, lon
+
+
+def get_place_index(path=None):
+    """Get the process's place index, memory-mapping it on first use.
+
+    Args:
+        path (str): index file, PLACE_INDEX_PATH if None.
+
+    Returns:
+        PlaceIndex: the index, None if no index is configured.
+
+    """
+    global _index
+
+    if path is None:
+        path = current_app.config['PLACE_INDEX_PATH']
+    if path is None:
+        return None
+
+    with _lock:
+        if _index is None:
+            _index = PlaceIndex.load(path)
+
+    return _index
@@ -15,66 +15,153 @@ Notes:
             }
         }
 """
+from celery.signals import worker_process_init
+from itertools import islice
+from flask import current_app
 from canopact.app import create_celery_app
+from canopact.blueprints.carbon.models import distance_cache
+from canopact.blueprints.carbon.models.distance_cache import DistanceCache
+from canopact.blueprints.carbon.models.distance_retry import DistanceRetry
+from canopact.blueprints.carbon.models.distance_run import DistanceRun
 from canopact.blueprints.carbon.models.activity import Activity
 from canopact.blueprints.carbon.models.expense import Carbon
 from canopact.blueprints.carbon.models.expense import Expense
 from canopact.blueprints.carbon.models.report import Report
 from canopact.blueprints.carbon.models.route import Route, Distance
+from canopact.blueprints.carbon.place_index import get_place_index
 from canopact.blueprints.user.models import User
 from canopact.extensions import db
+from lib.util_datetime import tzware_datetime
+from vendors import distance as distance_api
+from vendors import expensify
 import pandas as pd
 
 
 celery = create_celery_app()
 
 
+@worker_process_init.connect
+def load_place_index(**kwargs):
+    """Memory-maps the place index as each worker process starts."""
+    path = celery.conf.get('PLACE_INDEX_PATH')
+    if path is not None:
+        get_place_index(path)
+
+
 def setattrs(_self, **kwargs):
     """Helper function to set multiple attributes to Activity class"""
     for k, v in kwargs.items():
         setattr(_self, k, v)
 
 
+def save_user_reports(uid, reports, batch_size=None, skip_unchanged=None):
+    """Save a user's Expensify reports and their expenses to the db.
+
+    Reports are taken from `reports` in batches as they are parsed, so only
+    one batch is held in memory at a time. Each batch is written with a bulk
+    upsert, followed by the expenses belonging to it, and committed as a
+    single transaction.
+
+    Args:
+        uid (int): id of the user the reports belong to.
+        reports (iterable): reports yielded by `expensify.main()`.
+        batch_size (int): number of reports written per transaction.
+            Defaults to the `EXPENSIFY_INGEST_BATCH_SIZE` setting.
+        skip_unchanged (bool): only write rows whose content hash differs
+            from the stored one. Defaults to the `EXPENSIFY_SKIP_UNCHANGED`
+            setting.
+
+    Returns:
+        int: number of report and expense rows written.
+
+    """
+    if batch_size is None:
+        batch_size = current_app.config['EXPENSIFY_INGEST_BATCH_SIZE']
+    if skip_unchanged is None:
+        skip_unchanged = current_app.config['EXPENSIFY_SKIP_UNCHANGED']
+
+    written = 0
+    reports = iter(reports)
+
+    while True:
+        batch = list(islice(reports, batch_size))
+        if not batch:
+            break
+
+        # Get the required report fields for the whole batch.
+        report_rows = [Report.parse_report_from_list(batch, i, uid)
+                       for i in range(len(batch))]
+
+        # Normalise the expenses of every report in the batch at once.
+        expenses = expensify.Expensify.expenses_frame(batch)
+        expenses = Expense.parse_expenses_from_frame(expenses, uid)
+        expense_rows = Expense.prepare_expenses(expenses)
+
+        # Reports must be written first to satisfy the expense foreign key.
+        written += Report.bulk_upsert(report_rows, ['report_id'], batch_size,
+                                      commit=False,
+                                      skip_unchanged=skip_unchanged)
+        written += Expense.bulk_upsert(expense_rows, ['expense_id'],
+                                       batch_size, commit=False,
+                                       skip_unchanged=skip_unchanged)
+        db.session.commit()
+
+    return written
+
+
 @celery.task()
-def fetch_reports():
+def fetch_reports(full_resync=False):
     """Fetch expense reports from Expensify Integration Server.
 
-    Data on expenses is also parsed from these reports.
+    Data on expenses is also parsed from these reports. Users are fetched
+    concurrently, up to `EXPENSIFY_FETCH_CONCURRENCY` at a time, and each
+    user's reports are saved in batches while their file is parsed. A
+    failure for one user, including a download that breaks off part way
+    through, does not affect the others.
+
+    Each successfully saved user has their sync cursor moved to the start of
+    this run, so the next run only requests reports changed since then.
 
-    TODO:
-        * add handling for if a user does not have their expensify creds.
-        * Ammend user_ids definition to only include active customers.
-        * Replace nested for loops with parralelised workers.
+    Only users whose next poll is due are fetched. Users with new or changed
+    expenses are polled again after `EXPENSIFY_POLL_MIN_INTERVAL` and quiet
+    users back off exponentially, see `User.schedule_expensify_poll()`.
+
+    Args:
+        full_resync (bool): if True, ignore the sync cursors and poll
+            schedule and fetch the full default window for every user.
     """
-    # Get a list of the currently active user ids.
-    user_ids = [u[0] for u in db.session.query(User.id).distinct()]
-    # Get a list of all Expensify reports currently belonging to these users.
-    user_reports = Report.fetch_expensify_reports(User, user_ids)
-
-    # Loop over each user's reports.
-    for uid, report_list in user_reports.items():
-        # Loop through each of the reports belonging to the user.
-        for i in range(len(report_list)):
-            # Get the required fields and save into a dict.
-            r_dict = Report.parse_report_from_list(report_list, i, uid)
-            # Instantiate the report using the dict.
-            r = Report(**r_dict)
-            r.update_and_save(Report, report_id=r.report_id)
-
-            # Retrieve report expenses by using the same positional index.
-            r_expenses = Expense.parse_expenses_from_list(report_list, i, uid)
-            # Iterate over the expenses in each report.
-            for j in range(len(r_expenses['expense_id'])):
-                # Get the required fields and save into a dict.
-                e_dict = Expense.parse_expense_from_report(r_expenses, j)
-                # Instantiate the expense using the dict.
-                e = Expense(**e_dict)
-
-                e.expense_amount = e.expense_amount / 100
-                # Save expense into db table.
-                e.update_and_save(Expense, expense_id=e.expense_id)
-
-    print('Fetch reports complete.')
+    # Record the start of the run to use as the next sync cursor.
+    started_on = tzware_datetime()
+
+    if full_resync:
+        user_ids = [u[0] for u in db.session.query(User.id).distinct()]
+    else:
+        # Get the ids of active users who are due to be polled.
+        user_ids = User.expensify_poll_due(started_on)
+
+    expensify.metrics.reset()
+    # Fetch the Expensify reports currently belonging to these users.
+    user_reports = Report.fetch_expensify_reports(User, user_ids,
+                                                  full_resync=full_resync)
+
+    failed = []
+    # Save each user's reports as their fetch completes.
+    for uid, reports in user_reports:
+        try:
+            written = save_user_reports(uid, reports)
+            user = User.query.get(uid)
+            user.expensify_synced_on = started_on
+            user.schedule_expensify_poll(active=written > 0,
+                                         polled_on=started_on)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            failed.append(uid)
+            print(f'Failed to save Expensify reports for user {uid}: {e}')
+
+    print(f'Expensify API latency: {expensify.metrics.summary()}')
+    print(f'Fetch reports complete. {len(user_ids)} users due, '
+          f'{len(failed)} failed.')
 
 
 @celery.task()
@@ -98,73 +185,293 @@ def fetch_activities():
     print('fetch_activities complete')
 
 
-@celery.task()
-def calculate_carbon():
-    """Calculates carbon for new travel expense reports.
+def route_batches(batch_size):
+    """Yields batches of routes which need carbon calculating.
+
+    Ammended routes come first, then routes created from new expenses, so
+    routes invalidated during this run aren't retried until the next one.
+    Each batch is loaded with its own query, paging on id, so that batches
+    can be committed in between. Expenses whose ammended or deferred route
+    was in the first pass are skipped in the second, so they aren't
+    processed twice in a run.
+
+    Args:
+        batch_size (int): maximum number of routes per batch.
 
-    Saves records to `routes` and `carbon` tables.
+    Yields:
+        pandas.DataFrame: routes with their route columns formatted.
 
-    TODO:
-        * Use distance for routes that already exist instead of
-          calculating distance again.
     """
-    # Get new expense reports that do not have carbon calculates.
-    new = Expense.get_new_expenses()
+    handled = set()
+
+    after_id = None
+    while True:
+        routes = Route.get_ammended_routes(limit=batch_size,
+                                           after_id=after_id)
+        if routes is None:
+            break
+        after_id = int(routes['id'].iloc[-1])
+        handled.update(routes['expense_id'].tolist())
+        yield routes
+
+    after_id = None
+    while True:
+        new = Expense.get_new_expenses(limit=batch_size, after_id=after_id)
+        if new is None:
+            break
+        after_id = int(new['expense_id'].iloc[-1])
+
+        # A route deferred above leaves its expense without carbon.
+        new = new[~new['expense_id'].isin(handled)].reset_index(drop=True)
+        if len(new):
+            yield Route.create_routes(new, ammend=False)
+
+
+def distance_batches(batches):
+    """Calculates distances for each batch of routes.
+
+    Args:
+        batches (iterable): batches of routes from `route_batches`.
+
+    Yields:
+        pandas.DataFrame: routes with distances, NaNs converted to None.
+
+    """
+    for routes in batches:
+        distances = Distance.calculate_distance(routes)
+
+        # Convert NaNs to nulls to be compaitible to SQL db.
+        yield distances.where(pd.notnull(distances), None)
+
+
+def save_routes(distances):
+    """Adds a batch of routes to the session, without committing.
 
-    # Format and create additional route columns required.
-    new = Route.create_routes(new)
+    Routes from new expenses update the route already saved for their
+    expense, if there is one. Ammended routes are updated by id.
 
-    # If no new routes from expenses or ammended routes.
-    if new is None:
-        return None
+    Args:
+        distances (pandas.DataFrame): routes with distances.
 
-    # Calculate distances against routes.
-    distances = Distance.calculate_distance(new)
+    Returns:
+        int: number of routes saved.
 
-    # Convert NaNs to nulls to be compaitible to SQL db.
-    distances = distances.where(pd.notnull(distances), None)
+    """
+    rows = distances[['id', 'expense_id', 'expense_category',
+                      'route_category', 'origin', 'destination',
+                      'origin_key', 'destination_key', 'return_type',
+                      'invalid', 'distance']].to_dict('records')
 
-    # Reduce route cols down to cols of interest and convert to a dictionary.
-    route_df = distances[['id', 'expense_id', 'expense_category',
-                          'route_category', 'origin', 'destination',
-                          'return_type', 'invalid', 'distance']]
+    new = [d for d in rows if d['id'] is None]
+    ammended = {d['id']: d for d in rows if d['id'] is not None}
 
-    route_dict = route_df.to_dict('records')
+    if ammended:
+        for r in Route.query.filter(Route.id.in_(list(ammended))):
+            setattrs(r, **ammended[r.id])
 
-    # Reduce carbon cols down to cols of interest and convert to a dictionary.
-    carbon_df = distances[['expense_id', 'origin', 'destination',
-                           'expense_category', 'distance']]
-    carbon_df = carbon_df[carbon_df['distance'].notnull()]
-    carbon_dict = carbon_df.to_dict('records')
+    if new:
+        expense_ids = [d['expense_id'] for d in new]
+        existing = {r.expense_id: r for r in
+                    Route.query.filter(Route.expense_id.in_(expense_ids))}
 
-    # Save route records to db.
-    for d in route_dict:
-        # from Expense.get_new_expenses().
-        if d['id'] is None:
+        for d in new:
             d.pop('id')
-            expense_id = d['expense_id']
-            existing_route = \
-                Route.query.filter_by(expense_id=expense_id).first()
+            r = existing.get(d['expense_id'])
             # Completely new expense being written for the first time.
-            if existing_route is None:
-                r = Route(**d)
-                r.save()
+            if r is None:
+                db.session.add(Route(**d))
             # Existing expense being updated in each task run.
             else:
-                id = existing_route.id
-                r = Route.query.get(id)
                 setattrs(r, **d)
-                r.update_and_save(Route, id=r.id, expense_id=r.expense_id)
-        # from Route.get_ammended_routes().
-        else:
-            id = d['id']
-            r = Route.query.get(id)
-            setattrs(r, **d)
-            r.update_and_save(Route, id=r.id, expense_id=r.expense_id)
 
-    # Convert distances to carbon and save records to db.
-    for d in carbon_dict:
+    return len(rows)
+
+
+def save_carbon(distances):
+    """Converts a batch of distances to carbon and adds it to the session.
+
+    Does not commit. Carbon already saved for an expense is updated.
+
+    Args:
+        distances (pandas.DataFrame): routes with distances.
+
+    Returns:
+        int: number of carbon records saved.
+
+    """
+    rows = distances.loc[distances['distance'].notnull(),
+                         ['expense_id', 'origin', 'destination',
+                          'expense_category', 'distance']].to_dict('records')
+
+    if not rows:
+        return 0
+
+    existing = {}
+    expense_ids = [d['expense_id'] for d in rows]
+    for c in Carbon.query.filter(Carbon.expense_id.in_(expense_ids)):
+        existing.setdefault(c.expense_id, []).append(c)
+
+    cols = [c for c in Carbon.__table__.columns.keys()
+            if c not in ('id', 'created_on', 'updated_on')]
+
+    for d in rows:
         c = Carbon.emissions(**d)
-        c.update_and_save(Carbon, expense_id=d['expense_id'])
+        if d['expense_id'] in existing:
+            values = {k: getattr(c, k) for k in cols}
+            for saved in existing[d['expense_id']]:
+                setattrs(saved, **values)
+        else:
+            db.session.add(c)
 
-    print('Calculate Carbon complete.')
+    return len(rows)
+
+
+@celery.task()
+def calculate_carbon(batch_size=None):
+    """Calculates carbon for new travel expense reports.
+
+    Saves records to `routes` and `carbon` tables. Routes are streamed
+    through load, distance, emissions and save stages in batches of
+    `batch_size`, committing each batch before loading the next, so memory
+    use is bounded by the batch size rather than the backlog.
+
+    Distances already calculated are reused from the distance cache. Calls
+    to the distance APIs are limited by per run and per day budgets and a
+    circuit breaker for each provider, and recorded in `distance_runs`.
+
+    Args:
+        batch_size (int): routes per batch, CARBON_BATCH_SIZE if None.
+    """
+    if batch_size is None:
+        batch_size = current_app.config['CARBON_BATCH_SIZE']
+
+    total_routes = 0
+    total_carbon = 0
+    distance_cache.stats.reset()
+    started_on = DistanceRun.start()
+
+    try:
+        batches = distance_batches(route_batches(batch_size))
+        for i, distances in enumerate(batches, 1):
+            try:
+                routes_saved = save_routes(distances)
+                carbon_saved = save_carbon(distances)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            total_routes += routes_saved
+            total_carbon += carbon_saved
+            print(f'Calculate Carbon batch {i}: {routes_saved} routes and '
+                  f'{carbon_saved} carbon records saved.')
+    finally:
+        usage = DistanceRun.finish('calculate_carbon', started_on)
+        print(f'Distance API usage: {usage}')
+
+    print(f'Distance cache: {distance_cache.stats.summary()}')
+    print(f'Calculate Carbon complete. {total_routes} routes and '
+          f'{total_carbon} carbon records saved.')
+
+
+def retry_pairs(mode, limit=None, max_attempts=None):
+    """Looks up the due pairs of one route category in the retry queue.
+
+    Found distances are written to the distance cache and their pairs leave
+    the queue, so the next `calculate_carbon` run picks the distances up for
+    the waiting routes. Pairs that fail transiently again are rescheduled
+    with a longer backoff, until `max_attempts` is reached. Pairs that fail
+    permanently, or run out of attempts, leave the queue and have their
+    routes marked invalid. Pairs deferred by a call budget or circuit
+    breaker, or whose request was refused, e.g. REQUEST_DENIED, are left as
+    they are. Does not commit.
+
+    Args:
+        mode (str): route category, 'ground' or 'air'.
+        limit (int): maximum number of pairs to look up.
+        max_attempts (int): attempts before giving up on a pair,
+            DISTANCE_RETRY_MAX_ATTEMPTS if None.
+
+    Returns:
+        tuple: numbers of pairs found, rescheduled and invalidated.
+
+    """
+    if max_attempts is None:
+        max_attempts = current_app.config['DISTANCE_RETRY_MAX_ATTEMPTS']
+
+    entries = DistanceRetry.due(mode, limit=limit)
+    if not entries:
+        return 0, 0, 0
+
+    lookup, provider = Distance.lookup_for(mode)
+    pairs = pd.DataFrame({'origin': [e.origin for e in entries],
+                          'destination': [e.destination for e in entries]},
+                         dtype=object)
+    pairs = lookup(pairs)
+
+    if 'provider' not in pairs:
+        pairs['provider'] = provider
+
+    found = {}
+    rescheduled = 0
+    invalid = []
+    for e, dist, name, status in zip(entries, pairs['distance'],
+                                     pairs['provider'], pairs['status']):
+        key = (e.origin_key, e.destination_key)
+
+        if pd.notnull(dist):
+            found.setdefault(name, {})[key] = dist
+        elif status in distance_api.TRANSIENT_STATUSES:
+            if e.attempts + 1 < max_attempts:
+                e.reschedule(status)
+                rescheduled += 1
+                continue
+            invalid.append(key)
+        elif status == 'OK' or status in distance_api.PERMANENT_STATUSES:
+            invalid.append(key)
+        else:
+            # Deferred, or refused for a reason that isn't the route's, e.g.
+            # REQUEST_DENIED, so it stays due for the next drain.
+            continue
+
+        db.session.delete(e)
+
+    for name, distances in found.items():
+        DistanceCache.store(distances, mode, name, commit=False)
+
+    DistanceRetry.invalidate_routes(invalid, mode)
+
+    return sum(len(d) for d in found.values()), rescheduled, len(invalid)
+
+
+@celery.task()
+def retry_distances(batch_size=None):
+    """Retries distance lookups that failed transiently.
+
+    Drains the pairs of the distance retry queue whose backoff has passed,
+    up to `batch_size` per route category, committing each category.
+
+    Args:
+        batch_size (int): most pairs retried per route category,
+            DISTANCE_RETRY_BATCH_SIZE if None.
+    """
+    if batch_size is None:
+        batch_size = current_app.config['DISTANCE_RETRY_BATCH_SIZE']
+
+    started_on = DistanceRun.start()
+
+    try:
+        for mode in ['ground', 'air']:
+            try:
+                found, rescheduled, invalid = retry_pairs(mode,
+                                                          limit=batch_size)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            print(f'Retry {mode} distances: {found} found, {rescheduled} '
+                  f'rescheduled and {invalid} invalid.')
+    finally:
+        usage = DistanceRun.finish('retry_distances', started_on)
+        print(f'Distance API usage: {usage}')
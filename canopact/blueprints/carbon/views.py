@@ -35,6 +35,7 @@ from flask import (
 )
 from flask_login import current_user, login_required
 from sqlalchemy import text
+from lib.util_places import place_key
 
 carbon = Blueprint('carbon', __name__, template_folder='templates')
 
@@ -229,6 +230,8 @@ def routes_edit():
             if all(v is not None for v in [origin, destination]):
                 r.origin = origin
                 r.destination = destination
+                r.origin_key = place_key(origin)
+                r.destination_key = place_key(destination)
                 r.return_type = return_type
                 r.invalid = 0  # Change the invalid flag.
                 r.update_and_save(Route, id=id)
@@ -85,6 +85,9 @@ class User(UserMixin, ResourceMixin, db.Model):
     # Expensify.
     expensify_id = db.Column(db.String(128))
     expensify_secret = db.Column(db.String(128))
+    expensify_synced_on = db.Column(AwareDateTime())
+    expensify_poll_on = db.Column(AwareDateTime(), index=True)
+    expensify_poll_interval = db.Column(db.Integer)
 
     def __init__(self, **kwargs):
         # Call Flask-SQLAlchemy's constructor.
@@ -244,6 +247,39 @@ class User(UserMixin, ResourceMixin, db.Model):
 
         return False
 
+    @classmethod
+    def expensify_poll_due(cls, compare_datetime=None):
+        """
+        Get the ids of users whose Expensify reports are due to be fetched.
+
+        Users without Expensify credentials, or whose company's trial has
+        expired without it subscribing, are never due. Users without a
+        company are polled as usual.
+
+        :param compare_datetime: Time to compare next poll times with
+        :type compare_datetime: datetime
+        :return: list
+        """
+        # This prevents circular imports.
+        from canopact.blueprints.company.models import Company
+
+        if compare_datetime is None:
+            compare_datetime = tzware_datetime()
+
+        users = db.session.query(User.id) \
+            .outerjoin(Company, User.company_id == Company.id) \
+            .filter(User.expensify_id.isnot(None)) \
+            .filter(User.expensify_id != '') \
+            .filter(User.expensify_secret.isnot(None)) \
+            .filter(User.expensify_secret != '') \
+            .filter(or_(Company.id.is_(None),
+                        Company.trial_active.is_(True),
+                        Company.payment_id.isnot(None))) \
+            .filter(or_(User.expensify_poll_on.is_(None),
+                        User.expensify_poll_on <= compare_datetime))
+
+        return [u[0] for u in users]
+
     @classmethod
     def bulk_delete(cls, ids):
         """
@@ -353,6 +389,35 @@ class User(UserMixin, ResourceMixin, db.Model):
 
         return self.save()
 
+    def schedule_expensify_poll(self, active, polled_on=None):
+        """
+        Set when the user's Expensify reports should next be fetched. Active
+        users are polled at the minimum interval and each quiet poll doubles
+        the interval, up to the maximum. Does not commit.
+
+        :param active: Whether the last poll found new or changed expenses
+        :type active: bool
+        :param polled_on: Time of the last poll
+        :type polled_on: datetime
+        :return: None
+        """
+        if polled_on is None:
+            polled_on = tzware_datetime()
+
+        min_interval = current_app.config['EXPENSIFY_POLL_MIN_INTERVAL']
+        max_interval = current_app.config['EXPENSIFY_POLL_MAX_INTERVAL']
+
+        if active or self.expensify_poll_interval is None:
+            interval = min_interval
+        else:
+            interval = min(self.expensify_poll_interval * 2, max_interval)
+
+        self.expensify_poll_interval = interval
+        self.expensify_poll_on = polled_on + datetime.timedelta(
+            seconds=interval)
+
+        return None
+
     def update_salesforce_token(self):
         """
         Updates the sf access token for a new session. Saves to self.
@@ -1,12 +1,396 @@
 """Tests for carbon models"""
 
+import datetime
+import json
+
+from canopact.blueprints.carbon.gazetteer import get_gazetteer
+from canopact.blueprints.carbon.place_index import PlaceIndex
 from canopact.blueprints.carbon.models.carbon import Carbon
+from canopact.blueprints.carbon.models import distance_cache
+from canopact.blueprints.carbon.models.distance_cache import DistanceCache
+from canopact.blueprints.carbon.models.distance_retry import DistanceRetry
+from canopact.blueprints.carbon.models.distance_run import DistanceRun
 from canopact.blueprints.carbon.models.expense import Expense
+from canopact.blueprints.carbon.models.report import Report
 from canopact.blueprints.carbon.models.route import Route
 from canopact.blueprints.carbon.models.route import Distance
+from canopact.blueprints.user.models import User
+from lib.util_cache import LRUCache
+from lib.util_places import place_key, place_keys
+from vendors import distance, expensify
 from pandas.testing import assert_frame_equal, assert_series_equal
+import numpy as np
 import pandas as pd
 import pytest
+import requests
+import threading
+import time
+
+
+class TestReport():
+    def test_fetch_expensify_reports(self, monkeypatch, users):
+        """Test for Report.fetch_expensify_reports().
+
+        A failed fetch for one user should not stop the other users.
+
+        Args:
+            users (pytest.fixture): fixture for users using test db.
+
+        """
+        def mock_main(userid, secret, **kwargs):
+            if userid == 'broken_id':
+                raise RuntimeError('Failed to generate Expensify report')
+            return [{'report_id': 1}]
+
+        monkeypatch.setattr('vendors.expensify.main', mock_main)
+
+        broken = User.query.get(1)
+        broken.expensify_id = 'broken_id'
+        broken.expensify_secret = 'broken_secret'
+        working = User.query.get(2)
+        working.expensify_id = 'working_id'
+        working.expensify_secret = 'working_secret'
+        users.session.commit()
+
+        user_reports = Report.fetch_expensify_reports(User, [1, 2],
+                                                      max_workers=2)
+
+        assert dict(user_reports) == {2: [{'report_id': 1}]}
+
+    def test_fetch_expensify_reports_cursor(self, app, monkeypatch, users):
+        """Test for the sync cursors of Report.fetch_expensify_reports().
+
+        Synced users are fetched from their cursor less the overlap, users
+        never synced and full resyncs get the full default window.
+
+        Args:
+            users (pytest.fixture): fixture for users using test db.
+
+        """
+        start_timestamps = {}
+
+        def mock_main(userid, secret, start_timestamp=None, **kwargs):
+            start_timestamps[userid] = start_timestamp
+            return []
+
+        monkeypatch.setattr('vendors.expensify.main', mock_main)
+
+        synced_on = datetime.datetime(2020, 7, 1, tzinfo=datetime.timezone.utc)
+        synced = User.query.get(1)
+        synced.expensify_id = 'synced_id'
+        synced.expensify_secret = 'synced_secret'
+        synced.expensify_synced_on = synced_on
+        never_synced = User.query.get(2)
+        never_synced.expensify_id = 'never_synced_id'
+        never_synced.expensify_secret = 'never_synced_secret'
+        users.session.commit()
+
+        overlap = app.config['EXPENSIFY_SYNC_OVERLAP']
+        list(Report.fetch_expensify_reports(User, [1, 2]))
+
+        assert start_timestamps == {
+            'synced_id': (synced_on - overlap).timestamp(),
+            'never_synced_id': None
+        }
+
+        list(Report.fetch_expensify_reports(User, [1, 2], full_resync=True))
+
+        assert start_timestamps == {'synced_id': None,
+                                    'never_synced_id': None}
+
+    def test_bulk_upsert(self, reports):
+        """Test for Report.bulk_upsert().
+
+        Args:
+            reports (pytest.fixture): fixture for reports using test db.
+
+        """
+        rows = [
+            {'report_id': 2, 'user_id': 1, 'report_name': 'Updated'},
+            {'report_id': 3, 'user_id': 1, 'report_name': 'New'}
+        ]
+
+        written = Report.bulk_upsert(rows, ['report_id'], batch_size=1)
+
+        assert written == 2
+        assert reports.session.query(Report).count() == 3
+        assert Report.query.get(2).report_name == 'Updated'
+
+    def test_bulk_upsert_skip_unchanged(self, reports):
+        """Test for Report.bulk_upsert() with skip_unchanged.
+
+        Args:
+            reports (pytest.fixture): fixture for reports using test db.
+
+        """
+        rows = [
+            {'report_id': 2, 'user_id': 1, 'report_name': 'Unchanged'},
+            {'report_id': 3, 'user_id': 1, 'report_name': 'New'}
+        ]
+        Report.bulk_upsert(rows, ['report_id'])
+
+        rows[1]['report_name'] = 'Changed'
+        written = Report.bulk_upsert(rows, ['report_id'], skip_unchanged=True)
+
+        assert written == 1
+        assert Report.query.get(3).report_name == 'Changed'
+
+
+class TestExpensify():
+    def test_iter_main(self, monkeypatch):
+        """Test for expensify.iter_main().
+
+        Users are yielded in the order they complete and an exception is
+        returned for the user it was raised for only. Every user shares one
+        rate limiter.
+
+        """
+        limiters = set()
+
+        def mock_main(userid, secret, start_timestamp=None, **kwargs):
+            limiters.add(kwargs['limiter'])
+            if userid == 'slow_id':
+                time.sleep(0.2)
+            if userid == 'broken_id':
+                raise RuntimeError('Failed to generate Expensify report')
+            return [{'report_id': userid}]
+
+        monkeypatch.setattr(expensify, 'main', mock_main)
+
+        jobs = {1: ('slow_id', 'secret', None),
+                2: ('fast_id', 'secret', None),
+                3: ('broken_id', 'secret', None)}
+
+        results = list(expensify.iter_main(jobs, concurrency=3))
+
+        assert [key for key, _ in results][-1] == 1
+        results = dict(results)
+        assert results[1] == [{'report_id': 'slow_id'}]
+        assert results[2] == [{'report_id': 'fast_id'}]
+        assert isinstance(results[3], RuntimeError)
+        assert len(limiters) == 1
+        adapter = expensify.get_session().get_adapter(
+            'https://integrations.expensify.com')
+        assert adapter._pool_maxsize == 3
+
+    def test_iter_main_open_streams(self, monkeypatch):
+        """Test for the downloads of expensify.iter_main().
+
+        Each download is read into a file on the worker and its response
+        closed, so no more than `concurrency` streams are open at once, even
+        before the caller parses any reports.
+
+        """
+        lock = threading.Lock()
+        streams = {'open': 0, 'max': 0}
+
+        class MockResponse():
+            status_code = 200
+            content = b'expense_report.json'
+
+            def __init__(self, stream):
+                self.stream = stream
+                if stream:
+                    with lock:
+                        streams['open'] += 1
+                        streams['max'] = max(streams['max'], streams['open'])
+
+            def iter_content(self, **kwargs):
+                for i in range(3):
+                    time.sleep(0.01)
+                    yield json.dumps({'report_id': i}) + '\n'
+
+            def close(self):
+                if self.stream:
+                    with lock:
+                        streams['open'] -= 1
+                    self.stream = False
+
+        class MockSession():
+            def get(self, url, stream=False, **kwargs):
+                return MockResponse(stream)
+
+        session = MockSession()
+        monkeypatch.setattr(expensify, 'get_session', lambda: session)
+
+        jobs = {uid: (f'id_{uid}', 'secret', None) for uid in range(10)}
+        results = list(expensify.iter_main(jobs, concurrency=2))
+
+        assert streams['max'] <= 2
+        assert streams['open'] == 0
+        for _, reports in results:
+            assert [r['report_id'] for r in reports] == [0, 1, 2]
+
+    def test_request_retries(self, monkeypatch):
+        """Test for Expensify.request().
+
+        Timeouts, rate limiting and 5xx responses are retried until a
+        response succeeds.
+
+        """
+        class MockResponse():
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def close(self):
+                pass
+
+        class MockSession():
+            def __init__(self, outcomes):
+                self.outcomes = iter(outcomes)
+                self.calls = 0
+
+            def get(self, url, **kwargs):
+                self.calls += 1
+                outcome = next(self.outcomes)
+                if isinstance(outcome, Exception):
+                    raise outcome
+                return MockResponse(outcome)
+
+        ex = expensify.Expensify('userid', 'secret', 'template', backoff=0)
+
+        session = MockSession([503, 200])
+        monkeypatch.setattr(expensify, 'get_session', lambda: session)
+        assert ex.request({}, 'file').status_code == 200
+        assert session.calls == 2
+
+        session = MockSession([requests.Timeout(), 429, 200])
+        monkeypatch.setattr(expensify, 'get_session', lambda: session)
+        assert ex.request({}, 'file').status_code == 200
+        assert session.calls == 3
+
+    def test_request_limiter(self):
+        """Test for expensify.RequestLimiter.
+
+        Requests of each credential are spaced 1 / rate seconds apart,
+        independently of other credentials.
+
+        """
+        limiter = expensify.RequestLimiter(rate=2.0)
+
+        assert [limiter.reserve('a', now=0) for _ in range(3)] == \
+            [0, 0.5, 1.0]
+        assert limiter.reserve('b', now=0) == 0
+        assert limiter.reserve('a', now=0.75) == 0.75
+        assert limiter.reserve('a', now=5) == 0
+
+    def test_request_waits_on_limiter(self, monkeypatch):
+        """Test for Expensify.request() with a limiter.
+
+        Every attempt, retries included, waits on the user's credential.
+
+        """
+        waits = []
+
+        class MockLimiter():
+            def wait(self, key):
+                waits.append(key)
+
+        class MockResponse():
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def close(self):
+                pass
+
+        statuses = iter([503, 200])
+        monkeypatch.setattr(expensify.get_session(), 'get',
+                            lambda url, **kwargs: MockResponse(next(statuses)))
+
+        ex = expensify.Expensify('userid', 'secret', 'template', backoff=0,
+                                 limiter=MockLimiter())
+
+        assert ex.request({}, 'file').status_code == 200
+        assert waits == ['userid', 'userid']
+
+    def test_request_max_retries(self, app, monkeypatch):
+        """Test for Expensify.request() running out of retries.
+
+        Requests stop after `EXPENSIFY_MAX_RETRIES` retries, returning the
+        last response or raising the last error.
+
+        """
+        max_retries = app.config['EXPENSIFY_MAX_RETRIES']
+        calls = []
+
+        class MockResponse():
+            status_code = 503
+
+            def close(self):
+                pass
+
+        def unavailable(url, **kwargs):
+            calls.append(url)
+            return MockResponse()
+
+        def timeout(url, **kwargs):
+            calls.append(url)
+            raise requests.Timeout()
+
+        ex = expensify.Expensify('userid', 'secret', 'template',
+                                 max_retries=max_retries, backoff=0)
+
+        monkeypatch.setattr(expensify.get_session(), 'get', unavailable)
+        assert ex.request({}, 'file').status_code == 503
+        assert len(calls) == max_retries + 1
+
+        calls.clear()
+        monkeypatch.setattr(expensify.get_session(), 'get', timeout)
+        with pytest.raises(requests.Timeout):
+            ex.request({}, 'file')
+        assert len(calls) == max_retries + 1
+
+    def test_iter_json_objects(self):
+        """Test for expensify.iter_json_objects().
+
+        A JSON array and newline delimited JSON are parsed the same however
+        the document is split into chunks.
+
+        """
+        reports = [{'report_id': 1, 'report_name': 'Trip, [London]'},
+                   {'report_id': 2, 'report_name': 'Trip\n2'}]
+        array = json.dumps(reports)
+        ndjson = '\n'.join(json.dumps(r) for r in reports) + '\n'
+
+        for document in [array, ndjson]:
+            for size in [1, 7, len(document)]:
+                chunks = [document[i:i + size]
+                          for i in range(0, len(document), size)]
+
+                assert list(expensify.iter_json_objects(chunks)) == reports
+
+    def test_iter_json_objects_split(self):
+        """Test for expensify.iter_json_objects() with a large object.
+
+        An object spread over many chunks is yielded once complete, and the
+        objects before it as soon as they arrive.
+
+        """
+        large = {'report_id': 2, 'report_name': 'x' * 1000}
+        document = json.dumps(large)
+        chunks = ['{"report_id": 1}\n']
+        chunks += [document[i:i + 10] for i in range(0, len(document), 10)]
+
+        parsed = expensify.iter_json_objects(iter(chunks))
+
+        assert next(parsed) == {'report_id': 1}
+        assert list(parsed) == [large]
+
+    def test_iter_json_objects_invalid(self):
+        """Test for expensify.iter_json_objects() with a broken document.
+
+        Objects received before a truncation or garbage are still yielded.
+
+        """
+        truncated = ['[{"report_id": 1},', ' {"report_id": 2, "report_na']
+        garbage = ['{"report_id": 1}\n', '<html>Error</html>\n']
+
+        for chunks in [truncated, garbage]:
+            parsed = expensify.iter_json_objects(chunks)
+
+            assert next(parsed) == {'report_id': 1}
+            with pytest.raises(ValueError):
+                next(parsed)
 
 
 class TestExpense():
@@ -31,6 +415,78 @@ class TestExpense():
 
         assert non_travel_expense.travel_expense == 0
 
+    def test_parse_expenses_from_frame(self):
+        """Test for Expense.parse_expenses_from_frame()."""
+        reports = [
+            {
+                'report_id': 7,
+                'report_expenses': {
+                    'expense_id': ['1', '2'],
+                    'expense_amount': ['5000', ''],
+                    'expense_created_date': ['2020-06-29', ''],
+                    'expense_comment': ['', 'Lunch']
+                }
+            },
+            {
+                'report_id': 8,
+                'report_expenses': {
+                    'expense_id': ['3'],
+                    'expense_amount': ['120'],
+                    'expense_created_date': ['2020-07-01'],
+                    'expense_comment': ['Harrow; Wembley;']
+                }
+            }
+        ]
+
+        df = expensify.Expensify.expenses_frame(reports)
+        expenses = Expense.parse_expenses_from_frame(df, user_id=1)
+
+        assert expenses['user_id'].tolist() == [1, 1, 1]
+        assert_frame_equal(expenses.drop(columns='user_id'), df)
+
+    def test_prepare_expenses(self):
+        """Test for Expense.prepare_expenses()."""
+        reports = [
+            {
+                'report_id': 7,
+                'report_expenses': {
+                    'expense_id': ['1', '2'],
+                    'expense_category': ['Car, Van and Travel Expenses: Air',
+                                         'Food'],
+                    'expense_amount': ['5000', ''],
+                    'expense_created_date': ['2020-06-29', ''],
+                    'expense_comment': ['', 'Lunch']
+                }
+            }
+        ]
+
+        df = expensify.Expensify.expenses_frame(reports)
+        expenses = Expense.parse_expenses_from_frame(df, user_id=1)
+        rows = Expense.prepare_expenses(expenses)
+
+        assert rows == [
+            {
+                'user_id': 1,
+                'report_id': 7,
+                'expense_id': 1,
+                'expense_category': 'Car, Van and Travel Expenses: Air',
+                'expense_amount': 50.0,
+                'expense_created_date': datetime.date(2020, 6, 29),
+                'expense_comment': None,
+                'travel_expense': 1
+            },
+            {
+                'user_id': 1,
+                'report_id': 7,
+                'expense_id': 2,
+                'expense_category': 'Food',
+                'expense_amount': None,
+                'expense_created_date': None,
+                'expense_comment': 'Lunch',
+                'travel_expense': 0
+            }
+        ]
+
     def test_get_new_expenses(self, reports, expenses, carbons):
         """Test for Expense.get_new_expenses()
 
@@ -68,22 +524,66 @@ class TestRoute():
             Route.split_orig_dest(desc)
             assert err.type == ValueError
 
-    def test_check_route_exists(self, routes):
-        """Test for Route.check_route_exists()
+    def test_split_orig_dest_column(self):
+        """Test Route.split_orig_dest_column() matches split_orig_dest()"""
+        descriptions = pd.Series([
+            "Harrow, London; Old Trafford, Manchester;",
+            "Harrow, London; Wembley, London; R",
+            "Harrow, London to Old Trafford, Manchester;",
+            "Harrow; London; Wembley; London",
+            "",
+            None,
+            np.nan
+        ], index=[3, 3, 1, 0, 9, 8, 7])
+
+        actual = Route.split_orig_dest_column(descriptions)
+
+        for i, desc in enumerate(descriptions):
+            try:
+                expected = Route.split_orig_dest(desc)
+            except (ValueError, TypeError):
+                expected = (None, None, None)
+            assert tuple(actual.iloc[i]) == expected
+
+    def test_place_keys(self):
+        """Test for place_key() and place_keys()"""
+        places = pd.Series(["London, UK", "london,uk ", "London UK",
+                            "London, United Kingdom", "St. Albans, U.K.",
+                            " ,; ", None])
+
+        keys = place_keys(places)
+
+        assert keys.tolist() == ["london uk"] * 4 + ["st albans uk",
+                                                     None, None]
+        assert [place_key(p) for p in places] == keys.tolist()
+
+    def test_get_route_types(self):
+        """Test for Route.get_route_types()"""
+        categories = pd.Series(['Car, Van and Travel Expenses: Air',
+                                'Car, Van and Travel Expenses: Taxi'])
+        route_types = Route.get_route_types(categories)
+        assert route_types.tolist() == ['air', 'ground']
+
+        with pytest.raises(ValueError):
+            Route.get_route_types(pd.Series(['Meals and Entertainment']))
+
+    def test_get_existing_routes(self, routes):
+        """Test for Route.get_existing_routes()
 
         Args:
             routes (pytest.fixture): routes table using test db.
 
         """
-        orig = "Harrow, London"
-        dest = "Wembley, London"
-        exists = Route.check_route_exists(orig, dest)
-        assert exists is True
+        pairs = [
+            ("Harrow, London", "Wembley, London"),
+            ("Harrow, London", "Old Trafford, Manchester"),
+            ("Harrow, London", "Wembley, London"),
+            (None, None)
+        ]
+
+        known = Route.get_existing_routes(pairs, chunksize=1)
 
-        orig = "Harrow, London"
-        dest = "Old Trafford, Manchester"
-        exists = Route.check_route_exists(orig, dest)
-        assert exists is False
+        assert known == {("Harrow, London", "Wembley, London")}
 
     def test_create_routes(self, expenses, carbons):
         """Test for Route.create_routes().
@@ -119,25 +619,66 @@ class TestRoute():
 
 
 class TestDistance():
-    def test_get_ground_urls(self, distance_df):
-        """Test for Distance.get_distance_urls()."""
-        df = distance_df[['expense_id', 'origin', 'destination']]
-
-        df_urls = Distance.get_ground_urls(df, key="fake123")
-
-        assert_frame_equal(distance_df, df_urls)
-
     def test_calculate_ground_distance(self, monkeypatch, distance_df,
                                        mock_ground_api_response):
-        """Test for Distance.calculate_ground_disance()"""
-        monkeypatch.setattr("requests.get", mock_ground_api_response)
+        """Test for Distance.calculate_ground_matrix() with one element
+        requests."""
+        monkeypatch.setattr(distance.get_session(), "get",
+                            mock_ground_api_response)
 
-        df_distance = Distance.calculate_ground_distance(distance_df)
+        url = "https://maps.googleapis.com/maps/api/distancematrix/json?"
+        df_distance = Distance.calculate_ground_matrix(distance_df, url=url,
+                                                       key="fake123")
 
         expected_distances = pd.Series([5.611, 1934.3], name="distance")
 
         assert_series_equal(df_distance['distance'], expected_distances)
 
+    def test_plan_matrix_requests(self):
+        """Test for Distance.plan_matrix_requests()"""
+        pairs = [("Harrow", "Wembley"), ("Harrow", "Leeds"),
+                 ("Harrow", "York"), ("Leeds", "York"), ("Bath", "York")]
+
+        plan = Distance.plan_matrix_requests(pairs, max_places=2)
+
+        requested = [(o, d) for origins, destinations in plan
+                     for o in origins for d in destinations]
+        assert sorted(requested) == sorted(pairs)
+        assert all(len(o) <= 2 and len(d) <= 2 for o, d in plan)
+        assert len(plan) == 3
+
+    def test_calculate_ground_matrix(self, monkeypatch):
+        """Test for Distance.calculate_ground_matrix()"""
+
+        class MockMatrixResponse():
+            status_code = 200
+
+            def __init__(self, url, **kwargs):
+                self.url = url
+
+            def json(self):
+                origins = self.url.split('origins=')[1].split('&')[0]
+                dests = self.url.split('destinations=')[1].split('&')[0]
+                return {
+                    'status': 'OK',
+                    'rows': [{'elements': [
+                        {'status': 'OK',
+                         'distance': {'value': 1000 * (len(o) + len(d))}}
+                        for d in dests.split('|')]}
+                        for o in origins.split('|')]
+                }
+
+        monkeypatch.setattr(distance.get_session(), "get", MockMatrixResponse)
+
+        df = pd.DataFrame({'origin': ["Harrow", "Harrow", None],
+                           'destination': ["Leeds", "Bath", "York"]})
+
+        actual = Distance.calculate_ground_matrix(df, url='http://x?',
+                                                  key='fake123')
+
+        assert actual['distance'].tolist()[:2] == [11.0, 10.0]
+        assert pd.isnull(actual['distance'].iloc[2])
+
     def test_get_air_urls(self, air_df):
         """Test for Distance.get_distance_urls()."""
         df = air_df[['expense_id', 'origin', 'destination']]
@@ -155,8 +696,445 @@ class TestDistance():
 
         assert_series_equal(df_distance['distance'], expected_distances)
 
+    def test_gazetteer_resolve(self):
+        """Test for Gazetteer.resolve()"""
+        gazetteer = get_gazetteer()
+        places = pd.Series(["LHR", " jfk", "London Heathrow", "London, UK",
+                            "Heathrow Airport", "Atlantis", None])
+
+        codes = gazetteer.codes[gazetteer.resolve(places)[:5]]
+
+        assert codes.tolist() == ["LHR", "JFK", "LHR", "LHR", "LHR"]
+        assert gazetteer.resolve(places)[5:].tolist() == [-1, -1]
+
+    def test_calculate_air_gazetteer(self):
+        """Test for Distance.calculate_air_gazetteer()"""
+        df = pd.DataFrame({'origin': ["LHR", "Hamburg", "Atlantis", "LHR"],
+                           'destination': [" JFK", "Berlin", "LHR", "LHR"]})
+
+        actual = Distance.calculate_air_gazetteer(df, fallback=False)
+
+        assert actual['distance'].iloc[0] == pytest.approx(5540, abs=5)
+        assert actual['distance'].iloc[1] == pytest.approx(274, abs=5)
+        assert actual['distance'].iloc[2:].isnull().all()
+        assert actual['provider'].tolist()[:2] == ['gazetteer'] * 2
+
+    def test_place_index(self, tmpdir):
+        """Test for PlaceIndex.build() and PlaceIndex.coordinates()"""
+        rows = [
+            [1, 'Harrow', 'Harrow', '', 51.58, -0.34, 'P', 'PPL', 'GB', '',
+             '', '', '', '', 149000],
+            [2, 'York', 'York', '', 53.96, -1.08, 'P', 'PPL', 'GB', '',
+             '', '', '', '', 153000],
+            [3, 'Yorktown', 'Yorktown', '', 37.24, -76.51, 'P', 'PPL', 'US',
+             '', '', '', '', '', 200]
+        ]
+        source = tmpdir.join('cities.txt')
+        source.write('\n'.join('\t'.join(str(v) for v in r) for r in rows))
+        output = str(tmpdir.join('places.npy'))
+
+        PlaceIndex.build(str(source), output)
+        index = PlaceIndex.load(output)
+
+        places = pd.Series(['Harrow, London', 'york', 'LHR', 'Atlantis',
+                            None])
+        lat, lon = index.coordinates(places)
+
+        assert lat[:3] == pytest.approx([51.58, 53.96, 51.47], abs=0.01)
+        assert np.isnan(lat[3:]).all()
+
+    def test_distance_per_pair(self):
+        """Test for Distance.distance_per_pair()"""
+        df = pd.DataFrame({
+            'origin': ["Harrow, London", "harrow london", None, "Leeds"],
+            'destination': ["Wembley, London", "Wembley, London", None,
+                            "York"]
+        })
+        looked_up = []
+
+        def lookup(pairs):
+            looked_up.append(len(pairs))
+            pairs['distance'] = [5.0, None]
+            return pairs
+
+        actual = Distance.distance_per_pair(df, lookup)
+
+        assert looked_up == [2]
+        assert actual['distance'].tolist()[:2] == [5.0, 5.0]
+        assert pd.isnull(actual['distance'].iloc[2])
+        assert pd.isnull(actual['distance'].iloc[3])
+
+    def test_vectorised_matches_row_wise(self):
+        """Test the vectorised parsers and conversions against per row code.
+
+        Uses a large randomised frame, including nulls and failed responses.
+        """
+        rng = np.random.RandomState(42)
+        n = 5000
+
+        def convert_distance(row):
+            if row['expense_unit_unit'] == 'mi':
+                return row['expense_unit_count'] * 1.609
+            return row['expense_unit_count']
+
+        def double(row):
+            type = str(row['return_type'])
+            if 'r' in type or 'R' in type:
+                try:
+                    return row['distance'] * 2
+                except TypeError:
+                    return row['distance']
+            return row['distance']
+
+        def parse_element(element):
+            if element is None or element['status'] != 'OK':
+                return None
+            return element['distance']['value'] / 1000
+
+        def parse_air(json):
+            if json is None or not json['distance'] > 0:
+                return None
+            return json['distance']
+
+        counts = rng.uniform(0, 500, n)
+        counts[rng.rand(n) < 0.1] = np.nan
+        df = pd.DataFrame({
+            'expense_unit_count': counts,
+            'expense_unit_unit': rng.choice(['mi', 'km', None, np.nan], n),
+            'return_type': rng.choice([None, np.nan, 'R', ' r', 'return',
+                                       ' ', 'one way', 'x'], n)
+        })
+
+        expected = df.apply(convert_distance, axis=1)
+        df = Distance.get_unit_distance(df)
+        assert_series_equal(df['distance'], expected, check_names=False)
+
+        expected = df.apply(double, axis=1)
+        df = Distance.return_distance(df)
+        assert_series_equal(df['distance'], expected, check_names=False)
+
+        def element():
+            if rng.rand() < 0.1:
+                return None
+            return {'status': rng.choice(['OK', 'ZERO_RESULTS']),
+                    'distance': {'value': int(rng.randint(0, 10 ** 6))}}
+
+        elements = [element() for _ in range(n)]
+        expected = pd.Series([parse_element(e) for e in elements],
+                             dtype=float)
+        km, _ = Distance.parse_elements(elements)
+        assert_series_equal(pd.Series(km), expected)
+
+        jsons = [None if rng.rand() < 0.1 else
+                 {'distance': int(rng.randint(-1, 3000))} for _ in range(n)]
+        expected = pd.Series([parse_air(j) for j in jsons])
+        actual, _ = Distance.parse_air_jsons(jsons)
+        assert_series_equal(actual, expected)
+
+    def test_parse_statuses(self):
+        """Test the statuses given by the response parsers."""
+        elements = [{'status': 'OK', 'distance': {'value': 1000}},
+                    {'status': 'ZERO_RESULTS'}, None]
+
+        km, status = Distance.parse_elements(elements)
+
+        assert km[0] == 1.0
+        assert status.tolist() == ['OK', 'ZERO_RESULTS', None]
+
+        jsons = [{'distance': 40}, {'distance': 0},
+                 {'status': 'SERVER_ERROR', 'error': 'HTTP 503'}, None]
+
+        _, status = Distance.parse_air_jsons(jsons)
+
+        assert status.tolist() == ['OK', 'INVALID_STOPS', 'SERVER_ERROR',
+                                   None]
+
+    def test_get_json_failures(self, monkeypatch):
+        """Test vendors.distance.get_json() for failed requests."""
+
+        def timeout(url, **kwargs):
+            raise requests.exceptions.Timeout('timed out')
+
+        class MockUnavailable():
+            status_code = 503
+
+            def __init__(self, url, **kwargs):
+                pass
+
+        monkeypatch.setattr(distance.get_session(), "get", timeout)
+        assert distance.get_json('http://x', 'test', rate=100.0)['status'] \
+            == 'TIMEOUT'
+
+        monkeypatch.setattr(distance.get_session(), "get", MockUnavailable)
+        assert distance.get_json('http://x', 'test')['status'] == \
+            'SERVER_ERROR'
+
+        assert distance.get_json(None, 'test') is None
+
+        class MockList():
+            status_code = 200
+
+            def __init__(self, url, **kwargs):
+                pass
+
+            def json(self):
+                return ['not', 'an', 'object']
+
+        monkeypatch.setattr(distance.get_session(), "get", MockList)
+        assert distance.get_json('http://x', 'test')['status'] == \
+            'INVALID_RESPONSE'
+
+    def test_breaker_counts_refused_requests(self, monkeypatch):
+        """Test error statuses in a response open the circuit breaker."""
+
+        class MockDenied():
+            status_code = 200
+
+            def __init__(self, url, **kwargs):
+                pass
+
+            def json(self):
+                return {'status': 'REQUEST_DENIED', 'rows': []}
+
+        monkeypatch.setattr(distance.get_session(), "get", MockDenied)
+        distance.start_run({'denied': {'threshold': 2}})
+
+        statuses = [distance.get_json('http://x', 'denied',
+                                      rate=100.0)['status']
+                    for _ in range(3)]
+
+        assert statuses == ['REQUEST_DENIED', 'REQUEST_DENIED',
+                            distance.DEFERRED]
+        assert distance.usage_summary()['denied']['breaker'] == 'open'
+
+        distance.start_run({})
+
+    def test_budget_and_breaker(self, monkeypatch):
+        """Test the call budgets and circuit breaker of vendors.distance."""
+        requested = []
+
+        def timeout(url, **kwargs):
+            requested.append(url)
+            raise requests.exceptions.Timeout('timed out')
+
+        class MockResponse():
+            status_code = 200
+
+            def __init__(self, url, **kwargs):
+                requested.append(url)
+
+            def json(self):
+                return {'distance': 40}
+
+        monkeypatch.setattr(distance.get_session(), "get", timeout)
+        distance.start_run({'budget': {'run_budget': 10, 'threshold': 2}})
+
+        statuses = [distance.get_json('http://x', 'budget',
+                                      rate=100.0)['status']
+                    for _ in range(3)]
+
+        assert statuses == ['TIMEOUT', 'TIMEOUT', distance.DEFERRED]
+        assert len(requested) == 2
+        usage = distance.usage_summary()['budget']
+        assert usage['breaker'] == 'open'
+        assert (usage['calls'], usage['failures'], usage['deferred']) == \
+            (2, 2, 1)
+
+        # A new run closes the breaker, and the daily budget counts the
+        # calls of earlier runs.
+        monkeypatch.setattr(distance.get_session(), "get", MockResponse)
+        distance.start_run({'budget': {'daily_budget': 3, 'used_today': 2,
+                                       'cost': 0.005}})
+
+        jsons = distance.fetch_json(['http://x', 'http://y'], 'budget',
+                                    elements=[4, 4])
+
+        assert sorted(j.get('status', 'OK') for j in jsons) == \
+            ['DEFERRED', 'OK']
+        usage = distance.usage_summary()['budget']
+        assert usage['budget_spent']
+        assert usage['cost'] == pytest.approx(0.02)
+
+        distance.start_run({})
+
+    def test_calculate_distance_deferred(self, db, monkeypatch):
+        """Test transient failures are queued rather than made invalid."""
+        db.session.query(DistanceRetry).delete()
+        db.session.commit()
+
+        def lookup(pairs):
+            pairs['distance'] = [None] * len(pairs)
+            pairs['status'] = ['OVER_QUERY_LIMIT', 'NOT_FOUND',
+                               'REQUEST_DENIED'][:len(pairs)]
+            return pairs
+
+        monkeypatch.setattr(Distance, 'lookup_for',
+                            staticmethod(lambda mode: (lookup, 'google')))
+
+        df = pd.DataFrame({'route_category': ['ground'] * 3,
+                           'origin': ['Bradford', 'Atlantis', 'Goole'],
+                           'destination': ['Hull', 'Hull', 'Hull'],
+                           'return_type': [None] * 3})
+
+        actual = Distance.calculate_distance(df)
+
+        # Only the pair with no route is invalid, a refused request isn't.
+        assert pd.isnull(actual['invalid'].iloc[0])
+        assert actual['invalid'].iloc[1] == 1
+        assert pd.isnull(actual['invalid'].iloc[2])
+        queued = DistanceRetry.queued([('bradford', 'hull'),
+                                       ('atlantis', 'hull')], 'ground')
+        assert queued == {('bradford', 'hull')}
+
+        # Queued pairs aren't looked up again until they are retried.
+        actual = Distance.calculate_distance(df.iloc[:1])
+        assert actual['status'].tolist() == ['DEFERRED']
+        assert pd.isnull(actual['invalid'].iloc[0])
+
+
+class TestDistanceCache():
+    def test_store_and_lookup(self, db):
+        """Test for DistanceCache.store() and DistanceCache.lookup()
+
+        Args:
+            db (pytest.fixture): test db.
+
+        """
+        distances = {("harrow london", "wembley london"): 5.0,
+                     ("leeds", "york"): None}
+
+        written = DistanceCache.store(distances, 'ground', 'google')
+        cached = DistanceCache.lookup([("harrow london", "wembley london"),
+                                       ("leeds", "york")], 'ground')
+
+        assert written == 1
+        assert cached == {("harrow london", "wembley london"): 5.0}
+        assert DistanceCache.lookup(list(cached), 'air') == {}
+
+        # Only the table checks the ttl, so skip the in-memory tier.
+        distance_cache.get_memory_cache().clear()
+        expired = DistanceCache.lookup(list(cached), 'ground',
+                                       ttl=datetime.timedelta(seconds=-1))
+        assert expired == {}
+
+    def test_memory_tier(self, db):
+        """Test for the in-memory tier in front of the distance cache table.
+
+        Args:
+            db (pytest.fixture): test db.
+
+        """
+        key = ("leeds", "york")
+        DistanceCache.store({key: 40.0}, 'ground', 'google')
+        distance_cache.stats.reset()
+
+        assert DistanceCache.lookup([key], 'ground') == {key: 40.0}
+        assert distance_cache.stats.summary()['memory']['hits'] == 1
+        assert distance_cache.stats.summary()['database']['hits'] == 0
+
+    def test_lru_cache(self):
+        """Test for LRUCache eviction and expiry."""
+        lru = LRUCache(maxsize=2)
+        lru.set_many({'a': 1, 'b': 2})
+        lru.get_many(['a'])
+        lru.set_many({'c': 3})
+
+        assert lru.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+
+        lru = LRUCache(maxsize=2, ttl=-1)
+        lru.set_many({'a': 1})
+        assert lru.get_many(['a']) == {}
+
+
+class TestDistanceRetry():
+    def test_enqueue_and_reschedule(self, db):
+        """Test for DistanceRetry.enqueue() and DistanceRetry.reschedule()"""
+        db.session.query(DistanceRetry).delete()
+
+        DistanceRetry.enqueue({('leeds', 'york'): ('Leeds', 'York',
+                                                   'TIMEOUT')}, 'ground')
+
+        assert DistanceRetry.queued([('leeds', 'york')], 'ground') == \
+            {('leeds', 'york')}
+        assert DistanceRetry.queued([('leeds', 'york')], 'air') == set()
+        # Not due until the first backoff has passed.
+        assert DistanceRetry.due('ground') == []
+
+        retry = DistanceRetry.query.one()
+        first = retry.retry_on
+        retry.reschedule('OVER_QUERY_LIMIT')
+
+        assert retry.attempts == 2
+        assert retry.status == 'OVER_QUERY_LIMIT'
+        assert retry.retry_on > first
+
+    def test_backoff(self, app):
+        """Test for DistanceRetry.backoff()"""
+        min_interval = app.config['DISTANCE_RETRY_MIN_INTERVAL']
+        max_interval = app.config['DISTANCE_RETRY_MAX_INTERVAL']
+
+        assert DistanceRetry.backoff(1) == min_interval
+        assert DistanceRetry.backoff(2) == min_interval * 2
+        assert DistanceRetry.backoff(100) == max_interval
+
+
+class TestDistanceRun():
+    def test_start_and_finish(self, app, db, monkeypatch):
+        """Test for DistanceRun.start() and DistanceRun.finish()"""
+        db.session.query(DistanceRun).delete()
+        db.session.commit()
+
+        started_on = DistanceRun.start()
+        usage = distance.get_usage('google')
+        usage.acquire(elements=4)
+        usage.record(False)
+        DistanceRun.finish('test', started_on)
+
+        run = DistanceRun.query.one()
+        cost = app.config['DISTANCE_COSTS']['google']
+        assert (run.task, run.provider, run.calls, run.elements,
+                run.failures, run.breaker) == \
+            ('test', 'google', 1, 4, 1, 'closed')
+        assert run.cost == pytest.approx(4 * cost)
+        assert DistanceRun.calls_today('google') == 1
+
+        # The next run's daily budget counts the calls already made today.
+        monkeypatch.setitem(app.config, 'DISTANCE_DAILY_BUDGETS',
+                            {'google': 1})
+        DistanceRun.start()
+
+        assert not distance.get_usage('google').acquire()
+
+        distance.start_run({})
+
 
 class TestCarbon():
+    def test_group_and_count_routes(self, reports, expenses, routes):
+        """Test for Carbon.group_and_count_routes().
+
+        Routes without place keys, saved before they were backfilled, are
+        still grouped on their own origin and destination.
+
+        Args:
+            reports (pytest.fixture): fixture for reports using test db.
+            expenses (pytest.fixture): fixture for expenses using test db.
+            routes (pytest.fixture): fixture for routes using test db.
+
+        """
+        for expense in Expense.query.all():
+            expense.expense_created_date = datetime.date.today()
+        for route in Route.query.all():
+            route.route_category = 'ground'
+        routes.session.commit()
+
+        counts = Carbon.group_and_count_routes(User.query.get(1),
+                                               agg='employee', as_list=True)
+
+        assert sorted((o, d, c) for o, d, c, _ in counts) == [
+            ('Harrow, London', 'London Bridge, London', 1),
+            ('Harrow, London', 'Wembley, London', 1)
+        ]
+
     def test_convert(self):
         expected_ems = {
             'co2e': 94.27,
@@ -1,8 +1,18 @@
 """Tests for carbon tasks"""
 
-from canopact.blueprints.carbon.tasks import calculate_carbon
-from canopact.blueprints.carbon.models.expense import Carbon
-from canopact.blueprints.carbon.models.route import Route
+import datetime
+
+from canopact.blueprints.carbon.tasks import (calculate_carbon, fetch_reports,
+                                              retry_pairs, route_batches,
+                                              save_user_reports)
+from canopact.blueprints.carbon.models.distance_cache import DistanceCache
+from canopact.blueprints.carbon.models.distance_retry import DistanceRetry
+from canopact.blueprints.carbon.models.expense import Carbon, Expense
+from canopact.blueprints.carbon.models.report import Report
+from canopact.blueprints.carbon.models.route import Distance, Route
+from canopact.blueprints.user.models import User
+from lib.util_datetime import tzware_datetime
+import pytest
 
 
 def test_calculate_carbon(reports, expenses, carbons, routes):
@@ -25,3 +35,218 @@ def test_calculate_carbon(reports, expenses, carbons, routes):
 
     assert new_route_cnt == og_route_cnt + 1
     assert new_cbn_cnt == og_cbn_cnt + 1
+
+
+def test_save_user_reports(users):
+    """Test for save_user_reports()
+
+    Reports are saved as they are yielded, a batch at a time, so the batches
+    before a broken download are kept.
+
+    Args:
+        users (pytest.fixture): fixture for users using test db.
+
+    """
+    def reports():
+        for report_id in [101, 102]:
+            yield {'report_id': report_id,
+                   'report_name': f'Report {report_id}',
+                   'report_expenses': {
+                       'expense_id': [str(report_id)],
+                       'expense_category': ['Food'],
+                       'expense_amount': ['1000']}}
+        raise ValueError('Could not parse Expensify reports')
+
+    with pytest.raises(ValueError):
+        save_user_reports(1, reports(), batch_size=1)
+    users.session.rollback()
+
+    assert Report.query.get(101) is not None
+    assert Report.query.get(102) is not None
+    assert Expense.query.get(102).expense_amount == 10.0
+
+
+def test_fetch_reports_cursor(users, monkeypatch):
+    """Test for the sync cursors of fetch_reports()
+
+    A user's cursor only moves forward once their reports are saved, not
+    after a failed fetch or a download that breaks off.
+
+    Args:
+        users (pytest.fixture): fixture for users using test db.
+
+    """
+    def broken_download():
+        yield from []
+        raise ValueError('Could not parse Expensify reports')
+
+    outcomes = {'id_1': RuntimeError('Failed to generate Expensify report'),
+                'id_2': []}
+
+    def mock_main(userid, secret, **kwargs):
+        outcome = outcomes[userid]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr('vendors.expensify.main', mock_main)
+
+    synced_on = datetime.datetime(2020, 7, 1, tzinfo=datetime.timezone.utc)
+    for uid in [1, 2]:
+        user = User.query.get(uid)
+        user.expensify_id = f'id_{uid}'
+        user.expensify_secret = f'secret_{uid}'
+        user.expensify_synced_on = synced_on
+    users.session.commit()
+
+    fetch_reports(full_resync=True)
+
+    assert User.query.get(1).expensify_synced_on == synced_on
+    saved_on = User.query.get(2).expensify_synced_on
+    assert saved_on > synced_on
+
+    outcomes['id_2'] = broken_download()
+    fetch_reports(full_resync=True)
+
+    assert User.query.get(2).expensify_synced_on == saved_on
+
+
+def test_route_batches(reports, expenses, carbons, routes):
+    """Test for route_batches()
+
+    Ammended routes come first, then every new expense once in expense_id
+    order, even though carbon is saved and an expense is added between
+    batches.
+
+    Args:
+        reports (pytest.fixture): fixture for reports using test db.
+        expenses (pytest.fixture): fixture for reports using test db.
+        carbons (pytest.fixture): fixture for reports using test db.
+        routes (pytest.fixture): fixture for routes using test db.
+
+    """
+    db = expenses
+
+    def add_expense(expense_id):
+        db.session.add(Expense(
+            expense_id=expense_id, user_id=1, report_id=1,
+            expense_type='expense',
+            expense_category='Car, Van and Travel Expenses: Taxi',
+            expense_comment="Blackfriars, London; Shoreditch, London;"))
+
+    for expense_id in [4, 5, 6]:
+        add_expense(expense_id)
+    db.session.commit()
+
+    ammended = []
+    visited = []
+    for batch in route_batches(batch_size=2):
+        assert 0 < len(batch) <= 2
+
+        if batch['id'].notnull().all():
+            assert not visited
+            ammended.extend(batch['expense_id'].tolist())
+            continue
+
+        visited.extend(batch['expense_id'].tolist())
+
+        # Save carbon for the batch, as calculate_carbon does, which takes
+        # its expenses out of the new expenses being paged through.
+        for expense_id in batch['expense_id']:
+            db.session.add(Carbon(expense_id=int(expense_id)))
+        if visited == [3, 4]:
+            add_expense(7)
+        db.session.commit()
+
+    assert ammended == [1, 2]
+    assert visited == [3, 4, 5, 6, 7]
+
+
+def test_route_batches_deferred(reports, expenses, carbons, routes):
+    """Test for route_batches() with a deferred route.
+
+    An expense whose route was deferred has no carbon, but is only retried
+    with the ammended routes, not again with a new expense for the same pair.
+
+    Args:
+        reports (pytest.fixture): fixture for reports using test db.
+        expenses (pytest.fixture): fixture for reports using test db.
+        carbons (pytest.fixture): fixture for reports using test db.
+        routes (pytest.fixture): fixture for routes using test db.
+
+    """
+    db = routes
+    db.session.add(Route(expense_id=3, origin='Blackfriars, London',
+                         destination='Shoreditch, London'))
+    db.session.add(Expense(
+        expense_id=4, user_id=1, report_id=1, expense_type='expense',
+        expense_category='Car, Van and Travel Expenses: Taxi',
+        expense_comment="Blackfriars, London; Shoreditch, London;"))
+    db.session.commit()
+
+    ammended = []
+    new = []
+    for batch in route_batches(batch_size=10):
+        if batch['id'].notnull().all():
+            ammended.extend(batch['expense_id'].tolist())
+        else:
+            new.extend(batch['expense_id'].tolist())
+
+    assert ammended == [1, 2, 3]
+    assert new == [4]
+
+
+def test_retry_pairs(reports, expenses, monkeypatch):
+    """Test for retry_pairs()
+
+    Args:
+        reports (pytest.fixture): fixture for reports using test db.
+        expenses (pytest.fixture): fixture for expenses using test db.
+
+    """
+    db = expenses
+    db.session.query(DistanceRetry).delete()
+    db.session.query(Route).delete()
+
+    DistanceRetry.enqueue({
+        ('wakefield', 'hull'): ('Wakefield', 'Hull', 'TIMEOUT'),
+        ('bath', 'hull'): ('Bath', 'Hull', 'TIMEOUT'),
+        ('atlantis', 'hull'): ('Atlantis', 'Hull', 'TIMEOUT')
+    }, 'ground')
+    due = {'retry_on': tzware_datetime() - datetime.timedelta(seconds=1)}
+    DistanceRetry.query.update(due)
+    db.session.add(Route(expense_id=1, route_category='ground',
+                         origin='Atlantis', destination='Hull',
+                         origin_key='atlantis', destination_key='hull'))
+    db.session.commit()
+
+    results = {'Wakefield': (40.0, 'OK'),
+               'Bath': (None, 'OVER_QUERY_LIMIT'),
+               'Atlantis': (None, 'NOT_FOUND')}
+
+    def lookup(pairs):
+        pairs['distance'] = [results[o][0] for o in pairs['origin']]
+        pairs['status'] = [results[o][1] for o in pairs['origin']]
+        return pairs
+
+    monkeypatch.setattr(Distance, 'lookup_for',
+                        staticmethod(lambda mode: (lookup, 'google')))
+
+    assert retry_pairs('ground') == (1, 1, 1)
+    db.session.commit()
+
+    assert DistanceCache.lookup([('wakefield', 'hull')], 'ground') == \
+        {('wakefield', 'hull'): 40.0}
+    assert [r.origin_key for r in DistanceRetry.query] == ['bath']
+    assert Route.query.filter_by(origin_key='atlantis').one().invalid == 1
+
+    # Deferred by a call budget, or refused, so the pair is left as it was.
+    DistanceRetry.query.update(due)
+    for status in ['DEFERRED', 'REQUEST_DENIED']:
+        results['Bath'] = (None, status)
+        assert retry_pairs('ground', max_attempts=2) == (0, 0, 0)
+        assert DistanceRetry.query.one().attempts == 2
+
+    # Out of attempts, so the pair is given up on.
+    results['Bath'] = (None, 'OVER_QUERY_LIMIT')
+    assert retry_pairs('ground', max_attempts=2) == (0, 0, 1)
@@ -42,7 +42,8 @@ def app():
         'DEBUG': False,
         'TESTING': True,
         'WTF_CSRF_ENABLED': False,
-        'SQLALCHEMY_DATABASE_URI': db_uri
+        'SQLALCHEMY_DATABASE_URI': db_uri,
+        'DISTANCE_REDIS_URL': None
     }
 
     _app = create_app(settings_override=params)
@@ -400,19 +401,10 @@ def user_instance():
 @pytest.fixture
 def distance_df():
 
-    url1 = ("https://maps.googleapis.com/maps/api/distancematrix/"
-            "json?units=metric&mode=driving&origins=Harrow, London&"
-            "destinations=Wembley, London&key=fake123")
-
-    url2 = ("https://maps.googleapis.com/maps/api/distancematrix/"
-            "json?units=metric&mode=driving&origins=Nou Camp,"
-            " Barcelona&destinations=St James's Park, Newcastle&key=fake123")
-
     data = {
         'expense_id': [1, 2],
         'origin': ['Harrow, London', "Nou Camp, Barcelona"],
-        'destination': ['Wembley, London', "St James's Park, Newcastle"],
-        'url': [url1, url2]
+        'destination': ['Wembley, London', "St James's Park, Newcastle"]
     }
 
     return pd.DataFrame(data)
@@ -449,6 +441,8 @@ def mock_ground_api_response():
 
     class MockGoogleApiResponse():
         """Mock response for the Google Distance Matrix API"""
+        status_code = 200
+
         def __init__(self, *args, **kwargs):
             self.url = args[0]
 
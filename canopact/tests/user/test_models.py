@@ -1,5 +1,10 @@
+import datetime
+
+import pytz
+
 from canopact.blueprints.user.models import User
 from canopact.blueprints.billing.models.subscription import Subscription
+from canopact.blueprints.company.models import Company
 
 
 class TestUser(object):
@@ -16,3 +21,52 @@ class TestUser(object):
         """ Token de-serializer returns None when it's been tampered with. """
         user = User.deserialize_token('{0}1337'.format(token))
         assert user is None
+
+    def test_expensify_poll_due(self, users):
+        """ Only users with credentials and a due poll are returned. """
+        now = datetime.datetime(2020, 6, 1, tzinfo=pytz.utc)
+
+        due = User.query.get(1)
+        due.expensify_id = 'fake_id'
+        due.expensify_secret = 'fake_token'
+        not_due = User.query.get(2)
+        not_due.expensify_id = 'fake_id'
+        not_due.expensify_secret = 'fake_token'
+        not_due.expensify_poll_on = now + datetime.timedelta(hours=1)
+        users.session.commit()
+
+        assert User.expensify_poll_due(now) == [1]
+
+    def test_expensify_poll_due_subscribed(self, users):
+        """ Subscribed companies are still polled once their trial ends. """
+        now = datetime.datetime(2020, 6, 1, tzinfo=pytz.utc)
+
+        for user in User.query.all():
+            user.expensify_id = 'fake_id'
+            user.expensify_secret = 'fake_token'
+
+        subscribed = Company.query.get(2)
+        subscribed.trial_active = False
+        subscribed.payment_id = 'cus_000'
+        expired = Company.query.get(3)
+        expired.trial_active = False
+        users.session.commit()
+
+        assert User.expensify_poll_due(now) == [1]
+
+    def test_schedule_expensify_poll(self, app):
+        """ Quiet polls back off exponentially, active polls reset. """
+        now = datetime.datetime(2020, 6, 1, tzinfo=pytz.utc)
+        min_interval = app.config['EXPENSIFY_POLL_MIN_INTERVAL']
+        user = User()
+
+        user.schedule_expensify_poll(active=False, polled_on=now)
+        assert user.expensify_poll_interval == min_interval
+
+        user.schedule_expensify_poll(active=False, polled_on=now)
+        assert user.expensify_poll_interval == min_interval * 2
+        assert user.expensify_poll_on == now + datetime.timedelta(
+            seconds=min_interval * 2)
+
+        user.schedule_expensify_poll(active=True, polled_on=now)
+        assert user.expensify_poll_interval == min_interval
@@ -40,6 +40,12 @@ def init(with_testdb):
 
     """
     from canopact.blueprints.carbon.models.activity import Activity
+    from canopact.blueprints.carbon.models.distance_cache import \
+        DistanceCache
+    from canopact.blueprints.carbon.models.distance_retry import \
+        DistanceRetry
+    from canopact.blueprints.carbon.models.distance_run import \
+        DistanceRun
     from canopact.blueprints.carbon.models.route import Route
     from canopact.blueprints.company.models import Company
 
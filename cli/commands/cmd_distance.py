@@ -0,0 +1,36 @@
+import click
+
+from canopact.app import create_app
+from canopact.extensions import db
+
+# Create an app context for the database connection.
+app = create_app()
+db.app = app
+
+
+@click.group()
+def cli():
+    """ Manage the cache of route distances. """
+    pass
+
+
+@click.command()
+@click.option('--batch-size', default=1000,
+              help='Cache entries written per statement')
+def warm(batch_size):
+    """
+    Pre-warm the distance cache from distances already on routes.
+
+    :param batch_size: Cache entries written per statement
+    :return: None
+    """
+    from canopact.blueprints.carbon.models.distance_cache import \
+        DistanceCache
+
+    count = DistanceCache.warm_from_routes(batch_size=batch_size)
+    click.echo('Cached {0} distances from routes.'.format(count))
+
+    return None
+
+
+cli.add_command(warm)
@@ -0,0 +1,34 @@
+import click
+
+from canopact.app import create_app
+from canopact.extensions import db
+
+# Create an app context for the database connection.
+app = create_app()
+db.app = app
+
+
+@click.group()
+def cli():
+    """ Perform various tasks with Expensify's API. """
+    pass
+
+
+@click.command()
+@click.option('--full-resync/--no-full-resync', default=False,
+              help='Ignore sync cursors and refetch the full window?')
+def sync(full_resync):
+    """
+    Fetch Expensify reports for all users.
+
+    :param full_resync: Ignore each user's sync cursor
+    :return: None
+    """
+    from canopact.blueprints.carbon.tasks import fetch_reports
+
+    fetch_reports(full_resync=full_resync)
+
+    return None
+
+
+cli.add_command(sync)
@@ -0,0 +1,55 @@
+import click
+
+from canopact.app import create_app
+from canopact.extensions import db
+
+# Create an app context for the database connection.
+app = create_app()
+db.app = app
+
+
+@click.group()
+def cli():
+    """ Maintain normalised place keys and the place index. """
+    pass
+
+
+@click.command()
+@click.option('--batch-size', default=1000, help='Routes updated per commit')
+def normalise(batch_size):
+    """
+    Fill in the place keys for routes that don't have them yet.
+
+    :param batch_size: Routes updated per commit
+    :return: None
+    """
+    from canopact.blueprints.carbon.models.route import Route
+
+    count = Route.update_place_keys(batch_size=batch_size)
+    click.echo('Normalised place keys for {0} routes.'.format(count))
+
+    return None
+
+
+@click.command()
+@click.argument('source', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+def build_index(source, output):
+    """
+    Build the place index from a GeoNames dump, e.g. cities15000.txt from
+    https://download.geonames.org/export/dump/
+
+    :param source: Tab separated GeoNames file
+    :param output: Index file to write, set it as PLACE_INDEX_PATH
+    :return: None
+    """
+    from canopact.blueprints.carbon.place_index import PlaceIndex
+
+    count = PlaceIndex.build(source, output)
+    click.echo('Indexed {0} place names in {1}.'.format(count, output))
+
+    return None
+
+
+cli.add_command(normalise)
+cli.add_command(build_index)
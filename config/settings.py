@@ -70,12 +70,16 @@ CELERY_REDIS_MAX_CONNECTIONS = 5
 CELERYBEAT_SCHEDULE = {
     'fetch-expensify-reports': {
         'task': 'canopact.blueprints.carbon.tasks.fetch_reports',
-        'schedule': 3600
+        'schedule': 900
     },
     'calculate-carbon': {
         'task': 'canopact.blueprints.carbon.tasks.calculate_carbon',
         'schedule': 1800
     },
+    'retry-distances': {
+        'task': 'canopact.blueprints.carbon.tasks.retry_distances',
+        'schedule': 300
+    },
     'expire-free-trials': {
         'task': 'canopact.blueprints.company.tasks.expire_free_trials',
         'schedule': crontab(hour=0, minute=1)
@@ -100,6 +104,30 @@ SF_REDIRECT_URI = 'https://local.docker:8000/oauth2/callback'
 # Expensify.
 SEED_EXPENSIFY_ID = 'fake_id',
 SEED_EXPENSIFY_TOKEN = 'fake_token'
+EXPENSIFY_FETCH_CONCURRENCY = 8
+EXPENSIFY_SYNC_OVERLAP = timedelta(days=1)
+EXPENSIFY_INGEST_BATCH_SIZE = 500
+EXPENSIFY_SKIP_UNCHANGED = True
+EXPENSIFY_TIMEOUT = 60
+EXPENSIFY_MAX_RETRIES = 3
+EXPENSIFY_RETRY_BACKOFF = 0.5
+EXPENSIFY_RATE_LIMIT = 1.0  # Requests per second per partnerUserID.
+EXPENSIFY_POLL_MIN_INTERVAL = 900  # Seconds, matches the beat schedule.
+EXPENSIFY_POLL_MAX_INTERVAL = 86400
+EXPENSIFY_TRAVEL_ONLY = True
+
+# Expense categories that carbon is calculated for.
+EXPENSE_TRAVEL_CATEGORIES = [
+    'Car, Van and Travel Expenses: Air',
+    'Car, Van and Travel Expenses: Bus',
+    'Car, Van and Travel Expenses: Car Hire',
+    'Car, Van and Travel Expenses: Fuel',
+    'Car, Van and Travel Expenses: Taxi',
+    'Car, Van and Travel Expenses: Train'
+]
+
+# Routes calculated and committed per batch by calculate_carbon.
+CARBON_BATCH_SIZE = 500
 
 # User.
 SEED_ADMIN_EMAIL = 'dev@local.host'
@@ -115,6 +143,41 @@ DISTANCE_UNIT = 'metric'
 
 # Distance 24 API.
 DISTANCE_24_URL = 'https://www.distance24.org/route.json?'
+# Requests to the distance APIs run concurrently, rate limited per provider
+# in requests per second.
+DISTANCE_MAX_IN_FLIGHT = 8
+DISTANCE_TIMEOUT = 10
+DISTANCE_RATE_LIMITS = {'google': 50.0, 'distance24': 2.0}
+# Place index built by "canopact places build-index", memory-mapped by each
+# worker to resolve places to coordinates offline. None to go without.
+PLACE_INDEX_PATH = None
+# Limits for packing routes into multi-element Distance Matrix requests.
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+DISTANCE_MATRIX_MAX_PLACES = 25
+DISTANCE_MATRIX_MAX_URL_LENGTH = 8192
+# How long a cached distance is reused before it is looked up again.
+DISTANCE_CACHE_TTL = timedelta(days=90)
+# In-process and Redis tiers in front of the distance cache table. Set
+# DISTANCE_REDIS_URL to None to skip the Redis tier.
+DISTANCE_LRU_SIZE = 10000
+DISTANCE_LRU_TTL = 3600
+DISTANCE_REDIS_URL = CELERY_BROKER_URL
+DISTANCE_REDIS_TTL = timedelta(days=1)
+# Retry queue for distance lookups that failed transiently. The backoff
+# doubles from the min interval, in seconds, with each failed attempt.
+DISTANCE_RETRY_MIN_INTERVAL = 300
+DISTANCE_RETRY_MAX_INTERVAL = 21600
+DISTANCE_RETRY_MAX_ATTEMPTS = 8
+DISTANCE_RETRY_BATCH_SIZE = 500
+# Calls allowed to each distance API per task run and per UTC day, None for
+# no limit. Lookups over budget are deferred to a later run, as are the rest
+# of a run's lookups once a provider has failed DISTANCE_BREAKER_THRESHOLD
+# times in a row.
+DISTANCE_RUN_BUDGETS = {'google': 2000, 'distance24': 1000}
+DISTANCE_DAILY_BUDGETS = {'google': 20000, 'distance24': 10000}
+DISTANCE_BREAKER_THRESHOLD = 5
+# Estimated cost per billed element, in USD, recorded for each run.
+DISTANCE_COSTS = {'google': 0.005, 'distance24': 0.0}
 
 # DEFRA Emission Factors.
 EF_CO2E_CAR = 0.1714
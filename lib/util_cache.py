@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe, in-process least recently used cache whose entries also
+    expire after a time to live.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        """
+        :param maxsize: Most entries held before the least recently used
+            is evicted
+        :type maxsize: int
+        :param ttl: Seconds an entry lives for, forever if None
+        :type ttl: float
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        """
+        Get the values for the keys which are cached and haven't expired.
+
+        :param keys: Keys to look up
+        :type keys: iterable
+        :return: dict
+        """
+        now = time.monotonic()
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+
+                value, expires = entry
+                if expires is not None and expires <= now:
+                    del self._entries[key]
+                    continue
+
+                self._entries.move_to_end(key)
+                found[key] = value
+
+        return found
+
+    def set_many(self, values):
+        """
+        Cache values, evicting the least recently used entries if full.
+
+        :param values: Value for each key
+        :type values: dict
+        :return: None
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (value, expires)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TierCounters(object):
+    """
+    Hit and miss counts for each tier of a cache.
+    """
+
+    def __init__(self, *tiers):
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {t: {'hits': 0, 'misses': 0} for t in self.tiers}
+
+    def record(self, tier, hits, misses):
+        """
+        Add to the counts for a tier.
+
+        :param tier: Name of the tier
+        :type tier: str
+        :param hits: Keys found in the tier
+        :type hits: int
+        :param misses: Keys not found in the tier
+        :type misses: int
+        :return: None
+        """
+        with self._lock:
+            self.counts[tier]['hits'] += hits
+            self.counts[tier]['misses'] += misses
+
+    def summary(self):
+        """
+        Summarise the counts and hit rate of each tier.
+
+        :return: dict
+        """
+        with self._lock:
+            summary = {}
+            for tier, counts in self.counts.items():
+                total = counts['hits'] + counts['misses']
+                summary[tier] = {
+                    **counts,
+                    'hit_rate': round(counts['hits'] / total, 3)
+                    if total else None
+                }
+
+        return summary
@@ -0,0 +1,27 @@
+import numpy as np
+
+# Mean radius of the Earth in km.
+EARTH_RADIUS = 6371.0088
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between points, vectorised over arrays.
+
+    :param lat1: Latitudes of the start points in degrees
+    :type lat1: numpy.ndarray
+    :param lon1: Longitudes of the start points in degrees
+    :type lon1: numpy.ndarray
+    :param lat2: Latitudes of the end points in degrees
+    :type lat2: numpy.ndarray
+    :param lon2: Longitudes of the end points in degrees
+    :type lon2: numpy.ndarray
+    :return: numpy.ndarray of distances in km, NaN where a point is NaN
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float))
+                              for a in (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
@@ -0,0 +1,71 @@
+import threading
+
+import requests
+
+
+def make_session(pool_size=10, pool_connections=1, retries=0):
+    """
+    Create an HTTP session which keeps its connections alive in a pool, so
+    each request reuses one instead of making a new TCP and TLS handshake.
+
+    :param pool_size: Most connections kept alive to each host
+    :type pool_size: int
+    :param pool_connections: Number of hosts to keep a pool for
+    :type pool_connections: int
+    :param retries: Retry policy for the adapter, a number of retries or a
+        urllib3 Retry
+    :type retries: int or urllib3.util.retry.Retry
+    :return: requests.Session
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_size,
+                                            max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+class SharedSession(object):
+    """
+    An HTTP session shared by every thread in the process. The session is
+    created on first use, which is after any worker fork.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: Pool size and retry policy passed to make_session
+        :type kwargs: dict
+        """
+        self.kwargs = kwargs
+        self._session = None
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        """
+        Change how the session is made, e.g. its pool size. If anything
+        changed, a new session is made on next use and requests in flight
+        finish on the old one.
+
+        :param kwargs: Pool size and retry policy passed to make_session
+        :type kwargs: dict
+        :return: None
+        """
+        with self._lock:
+            kwargs = dict(self.kwargs, **kwargs)
+            if kwargs != self.kwargs:
+                self.kwargs = kwargs
+                self._session = None
+
+    def get(self):
+        """
+        Get the shared session, creating it if need be.
+
+        :return: requests.Session
+        """
+        with self._lock:
+            if self._session is None:
+                self._session = make_session(**self.kwargs)
+
+        return self._session
@@ -0,0 +1,91 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# Country suffixes that name the same country, mapped to one canonical form.
+# Aliases are matched after punctuation has been stripped.
+COUNTRY_ALIASES = {
+    'uk': 'uk',
+    'united kingdom': 'uk',
+    'great britain': 'uk',
+    'gb': 'uk',
+    'gbr': 'uk',
+    'us': 'usa',
+    'usa': 'usa',
+    'united states': 'usa',
+    'united states of america': 'usa',
+    'uae': 'uae',
+    'united arab emirates': 'uae',
+    'nl': 'netherlands',
+    'the netherlands': 'netherlands',
+    'holland': 'netherlands',
+    'deutschland': 'germany',
+    'espana': 'spain',
+    'españa': 'spain'
+}
+
+# Dropped outright so "U.K." and "St. Albans" don't gain a space.
+_DROPPED = re.compile(r"[.'’`]")
+_PUNCTUATION = re.compile(r'[^\w\s]|_')
+_WHITESPACE = re.compile(r'\s+')
+# Longest aliases first so "united states of america" wins over "us".
+_COUNTRY_SUFFIX = re.compile(
+    r'(^|\s)(' +
+    '|'.join(re.escape(a) for a in sorted(COUNTRY_ALIASES, key=len,
+                                          reverse=True)) +
+    r')$')
+
+
+def _canonical_country(match):
+    return match.group(1) + COUNTRY_ALIASES[match.group(2)]
+
+
+def place_key(place):
+    """
+    Return the canonical key for a place name.
+
+    Case, whitespace and punctuation are normalised and a trailing country
+    alias is replaced by its canonical form, so "London, UK", "london,uk "
+    and "London United Kingdom" all give "london uk".
+
+    :param place: Place name
+    :type place: str
+    :return: str, None if place is not a string or has no words in it
+    """
+    if not isinstance(place, str):
+        return None
+
+    key = _DROPPED.sub('', place.lower())
+    key = _PUNCTUATION.sub(' ', key)
+    key = _WHITESPACE.sub(' ', key).strip()
+    key = _COUNTRY_SUFFIX.sub(_canonical_country, key)
+
+    return key or None
+
+
+def place_keys(places):
+    """
+    Return the canonical key for each place name in a column.
+
+    Vectorised equivalent of place_key.
+
+    :param places: Place names
+    :type places: pandas.Series
+    :return: pandas.Series
+    """
+    is_str = places.map(lambda p: isinstance(p, str)).to_numpy(bool)
+    keys = np.full(len(places), None, dtype=object)
+
+    if is_str.any():
+        strings = places[is_str].str.lower()
+        strings = strings.str.replace(_DROPPED, '')
+        strings = strings.str.replace(_PUNCTUATION, ' ')
+        strings = strings.str.replace(_WHITESPACE, ' ').str.strip()
+        strings = strings.str.replace(_COUNTRY_SUFFIX, _canonical_country)
+
+        strings = strings.to_numpy(object)
+        strings[strings == ''] = None
+        keys[is_str] = strings
+
+    return pd.Series(keys, index=places.index)
@@ -1,7 +1,12 @@
 import datetime
+import json
+from collections import OrderedDict
+from hashlib import md5
 
+import pandas as pd
 import sqlalchemy
-from sqlalchemy import DateTime
+from sqlalchemy import DateTime, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.types import TypeDecorator
 
 from lib.util_datetime import tzware_datetime
@@ -100,6 +105,128 @@ class ResourceMixin(object):
 
         return delete_count
 
+    @staticmethod
+    def frame_from_query(query, chunksize=None):
+        """
+        Load the rows of a query straight into a DataFrame, without building
+        mapped objects. The query should select only the columns required.
+
+        When chunked, a server side cursor is used so that only `chunksize`
+        rows are held in memory at a time.
+
+        :param query: Query selecting the columns to load
+        :type query: sqlalchemy.orm.Query
+        :param chunksize: Rows per frame, load all rows at once if None
+        :type chunksize: int
+        :return: pandas.DataFrame, or an iterator of them if chunked
+        """
+        conn = db.session.connection()
+
+        if chunksize is not None:
+            conn = conn.execution_options(stream_results=True)
+
+        return pd.read_sql(query.statement, conn, chunksize=chunksize)
+
+    @staticmethod
+    def content_hash(row):
+        """
+        Create a stable fingerprint of a row's values. Keys are sorted so the
+        hash doesn't depend on the order columns were added in.
+
+        :param row: Column values of the row
+        :type row: dict
+        :return: str
+        """
+        payload = json.dumps(row, sort_keys=True, default=str)
+
+        return md5(payload.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def stored_hashes(cls, keys, index_elements):
+        """
+        Look up the stored content hashes of existing rows in one query.
+
+        :param keys: Values of `index_elements` for each row
+        :type keys: list
+        :param index_elements: Columns that identify a row
+        :type index_elements: list
+        :return: dict of key tuple to content hash
+        """
+        cols = [cls.__table__.c[k] for k in index_elements]
+        stored = db.session.query(*cols, cls.__table__.c.content_hash) \
+            .filter(tuple_(*cols).in_(keys))
+
+        return {tuple(s[:-1]): s[-1] for s in stored}
+
+    @classmethod
+    def bulk_upsert(cls, rows, index_elements, batch_size=None, commit=True,
+                    skip_unchanged=False):
+        """
+        Insert rows, updating any that already exist, using PostgreSQL's
+        INSERT ... ON CONFLICT DO UPDATE. One statement is executed per batch
+        of rows instead of a query and commit per row.
+
+        Only the columns present in the rows are updated on conflict and
+        `created_on` is left untouched for existing rows.
+
+        If the model has a `content_hash` column each row's hash is written
+        with it. With `skip_unchanged`, rows whose hash matches the stored
+        one are left alone, so their `updated_on` isn't bumped either.
+
+        :param rows: Column values for each row, all with the same keys
+        :type rows: list
+        :param index_elements: Columns of the unique constraint to upsert on
+        :type index_elements: list
+        :param batch_size: Rows per statement, all rows at once if None
+        :type batch_size: int
+        :param commit: Commit the session once all rows are written
+        :type commit: bool
+        :param skip_unchanged: Only write rows whose content has changed
+        :type skip_unchanged: bool
+        :return: Number of rows written
+        """
+        if not rows:
+            return 0
+
+        if batch_size is None:
+            batch_size = len(rows)
+
+        hashed = 'content_hash' in cls.__table__.columns
+        now = tzware_datetime()
+        written = 0
+
+        for start in range(0, len(rows), batch_size):
+            # A statement can't affect the same row twice, keep the last one.
+            batch = OrderedDict()
+            for row in rows[start:start + batch_size]:
+                key = tuple(row[k] for k in index_elements)
+                if hashed:
+                    row = {**row, 'content_hash': cls.content_hash(row)}
+                batch[key] = row
+
+            if hashed and skip_unchanged:
+                stored = cls.stored_hashes(list(batch), index_elements)
+                batch = OrderedDict((k, v) for k, v in batch.items()
+                                    if stored.get(k) != v['content_hash'])
+                if not batch:
+                    continue
+
+            values = [{'created_on': now, 'updated_on': now, **v}
+                      for v in batch.values()]
+
+            stmt = insert(cls.__table__).values(values)
+            update_cols = {k: stmt.excluded[k] for k in values[0]
+                           if k not in index_elements and k != 'created_on'}
+            stmt = stmt.on_conflict_do_update(index_elements=index_elements,
+                                              set_=update_cols)
+            db.session.execute(stmt)
+            written += len(values)
+
+        if commit:
+            db.session.commit()
+
+        return written
+
     def save(self):
         """
         Save a model instance.
@@ -0,0 +1,354 @@
+"""Concurrent requests to the distance APIs.
+
+Requests to the Google Distance Matrix API and distance24.org are made from
+a thread pool sharing one pooled session. Each provider has its own token
+bucket so bursts from the pool stay within its rate limit.
+
+Requests that fail in transit are returned as a response with a `status`
+from TRANSIENT_STATUSES, like the API's own error statuses, so callers can
+tell them apart from permanent failures and retry them later.
+
+Each provider's calls are counted against the budgets of the current run,
+see `start_run`, and a circuit breaker stops calling a provider after
+repeated failures. Requests that aren't made for either reason are returned
+with the status DEFERRED.
+
+Examples:
+    urls = ["https://www.distance24.org/route.json?stops=Leeds|York"]
+    jsons = fetch_json(urls, provider='distance24')
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import threading
+import time
+
+from lib.util_http import SharedSession
+
+# Defaults for requests made to the distance APIs.
+POOL_SIZE = 16
+MAX_IN_FLIGHT = 8
+TIMEOUT = 10
+RATE_LIMITS = {'google': 50.0, 'distance24': 2.0}
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Failures worth retrying later: the API's own rate limit and server errors,
+# plus the statuses given to requests that failed in transit.
+TRANSIENT_STATUSES = {'OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT', 'UNKNOWN_ERROR',
+                      'TIMEOUT', 'CONNECTION_ERROR', 'SERVER_ERROR',
+                      'INVALID_RESPONSE'}
+
+# Statuses meaning no route exists between the places, so the route needs
+# correcting by hand. Every other failure is retried or deferred.
+PERMANENT_STATUSES = {'NOT_FOUND', 'ZERO_RESULTS', 'INVALID_STOPS'}
+
+# Status of a request that wasn't made, because the provider's call budget
+# is spent or its circuit breaker is open.
+DEFERRED = 'DEFERRED'
+
+_session = SharedSession(pool_size=POOL_SIZE, pool_connections=2)
+_buckets = {}
+_usage = {}
+_lock = threading.Lock()
+
+
+def get_session():
+    """Get the HTTP session shared by every distance request in the process.
+
+    Returns:
+        requests.Session: the shared session.
+    """
+    return _session.get()
+
+
+class TokenBucket():
+    """Thread safe token bucket limiting the request rate to a provider.
+
+    Args:
+        rate (float): tokens added per second.
+        capacity (float): most tokens held, i.e. the largest burst allowed.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def get_bucket(provider, rate=None):
+    """Get the token bucket shared by every request to `provider`.
+
+    Args:
+        provider (str): name of the distance API, e.g. 'google'.
+        rate (float): requests per second, used when the bucket is created.
+            Defaults to the provider's entry in RATE_LIMITS.
+
+    Returns:
+        TokenBucket: the provider's bucket.
+    """
+    with _lock:
+        if provider not in _buckets:
+            if rate is None:
+                rate = RATE_LIMITS.get(provider, 1.0)
+            _buckets[provider] = TokenBucket(rate)
+
+    return _buckets[provider]
+
+
+class CircuitBreaker():
+    """Opens after `threshold` consecutive failed requests to a provider.
+
+    Once open it stays open until the next run, see `start_run`.
+
+    Args:
+        threshold (int): consecutive failures that open the breaker, None
+            for it never to open.
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.failures = 0
+        self.is_open = False
+
+    @property
+    def state(self):
+        return 'open' if self.is_open else 'closed'
+
+    def record(self, ok):
+        """Record the outcome of a request.
+
+        Args:
+            ok (bool): whether the request succeeded.
+        """
+        if ok:
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.threshold is not None and self.failures >= self.threshold:
+            self.is_open = True
+
+
+class ProviderUsage():
+    """Thread safe count of one run's calls to a provider, within budgets.
+
+    Args:
+        provider (str): name of the distance API, e.g. 'google'.
+        run_budget (int): most calls in the run, None for no limit.
+        daily_budget (int): most calls in the day, None for no limit.
+        used_today (int): calls already made today by earlier runs.
+        threshold (int): consecutive failures that open the breaker.
+        cost (float): estimated cost of each billed element of a call.
+    """
+
+    def __init__(self, provider, run_budget=None, daily_budget=None,
+                 used_today=0, threshold=None, cost=0.0):
+        self.provider = provider
+        self.run_budget = run_budget
+        self.daily_budget = daily_budget
+        self.used_today = used_today
+        self.cost = cost
+        self.breaker = CircuitBreaker(threshold)
+        self.calls = 0
+        self.elements = 0
+        self.failures = 0
+        self.deferred = 0
+        self._lock = threading.Lock()
+
+    def budget_spent(self):
+        """Whether either call budget has been used up."""
+        return ((self.run_budget is not None and
+                 self.calls >= self.run_budget) or
+                (self.daily_budget is not None and
+                 self.used_today + self.calls >= self.daily_budget))
+
+    def acquire(self, elements=1):
+        """Take a call from the budget, if it may be made.
+
+        Args:
+            elements (int): billed elements of the call.
+
+        Returns:
+            bool: False if the call should be deferred.
+        """
+        with self._lock:
+            if self.breaker.is_open or self.budget_spent():
+                self.deferred += 1
+                return False
+
+            self.calls += 1
+            self.elements += elements
+            return True
+
+    def record(self, ok):
+        """Record the outcome of a call for the circuit breaker.
+
+        Args:
+            ok (bool): whether the call succeeded.
+        """
+        with self._lock:
+            if not ok:
+                self.failures += 1
+            self.breaker.record(ok)
+
+    def summary(self):
+        """Calls made, failed and deferred, estimated cost and breaker state.
+
+        Returns:
+            dict: usage of the provider in this run.
+        """
+        with self._lock:
+            return {'calls': self.calls,
+                    'elements': self.elements,
+                    'failures': self.failures,
+                    'deferred': self.deferred,
+                    'cost': round(self.elements * self.cost, 4),
+                    'breaker': self.breaker.state,
+                    'budget_spent': self.budget_spent()}
+
+
+def start_run(providers):
+    """Start counting calls for a new run, resetting the circuit breakers.
+
+    Args:
+        providers (dict): keyword arguments of `ProviderUsage` for each
+            provider. Providers left out have no budgets or breaker.
+    """
+    global _usage
+
+    with _lock:
+        _usage = {name: ProviderUsage(name, **kwargs)
+                  for name, kwargs in providers.items()}
+
+
+def get_usage(provider):
+    """Get the current run's usage of `provider`.
+
+    Args:
+        provider (str): name of the distance API, e.g. 'google'.
+
+    Returns:
+        ProviderUsage: the provider's usage.
+    """
+    with _lock:
+        if provider not in _usage:
+            _usage[provider] = ProviderUsage(provider)
+
+    return _usage[provider]
+
+
+def usage_summary():
+    """Summarise the current run's usage of every provider called.
+
+    Returns:
+        dict: `ProviderUsage.summary()` for each provider.
+    """
+    with _lock:
+        usage = dict(_usage)
+
+    return {name: u.summary() for name, u in usage.items()}
+
+
+def get_json(url, provider, timeout=TIMEOUT, rate=None, elements=1):
+    """Make one rate limited request and decode its JSON response.
+
+    Args:
+        url (str): request url, None to skip the request.
+        provider (str): name of the distance API, for its rate limit.
+        timeout (float): seconds to wait for the connection and response.
+        rate (float): requests per second for the provider.
+        elements (int): billed elements of the request.
+
+    Returns:
+        dict: decoded response, None if `url` is None. A failed request
+            gives `{'status': <one of TRANSIENT_STATUSES>, 'error': <str>}`
+            and one that wasn't made gives `{'status': DEFERRED}`.
+    """
+    if url is None:
+        return None
+
+    usage = get_usage(provider)
+    if not usage.acquire(elements):
+        return {'status': DEFERRED}
+
+    get_bucket(provider, rate).acquire()
+
+    try:
+        response = get_session().get(url, timeout=timeout)
+        if response.status_code in RETRY_STATUS_CODES:
+            error = f"HTTP {response.status_code}"
+            if response.status_code == 429:
+                status = 'OVER_QUERY_LIMIT'
+            else:
+                status = 'SERVER_ERROR'
+        else:
+            decoded = response.json()
+            if not isinstance(decoded, dict):
+                raise ValueError(f"expected a JSON object, got "
+                                 f"{type(decoded).__name__}")
+
+            # Any status but OK, e.g. REQUEST_DENIED from a bad key, counts
+            # towards the circuit breaker. distance24 gives no status.
+            usage.record(decoded.get('status', 'OK') == 'OK')
+            return decoded
+    except requests.exceptions.Timeout as e:
+        status, error = 'TIMEOUT', str(e)
+    except requests.exceptions.RequestException as e:
+        status, error = 'CONNECTION_ERROR', str(e)
+    except ValueError as e:
+        status, error = 'INVALID_RESPONSE', str(e)
+
+    print(f"{provider} distance request failed: {error}")
+    usage.record(False)
+
+    return {'status': status, 'error': error}
+
+
+def fetch_json(urls, provider, max_in_flight=MAX_IN_FLIGHT, timeout=TIMEOUT,
+               rate=None, elements=None):
+    """Request every url concurrently, returning the responses in order.
+
+    Args:
+        urls (list): request urls, None for rows with nothing to request.
+        provider (str): name of the distance API, for its rate limit.
+        max_in_flight (int): most requests in flight at once.
+        timeout (float): seconds to wait for each request.
+        rate (float): requests per second for the provider.
+        elements (list): billed elements of each request, 1 each if None.
+
+    Returns:
+        list: decoded response for each url, None where there was no url.
+            Failed requests give a status response, see `get_json`.
+    """
+    if not urls:
+        return []
+
+    if elements is None:
+        elements = [1] * len(urls)
+
+    workers = max(1, min(max_in_flight, len(urls)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda u, e: get_json(u, provider, timeout=timeout, rate=rate,
+                                  elements=e),
+            urls, elements))
@@ -8,13 +8,140 @@ Examples:
     reports = ex.reports()
 """
 
-import ast
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
 import json
+import numpy as np
+import pandas as pd
+import random
+import re
 import requests
+import tempfile
+import threading
 import time
 
+from lib.util_http import SharedSession
 from vendors import freemarker_templates
 
+# Defaults for requests made to the Integration Server.
+CONCURRENCY = 8
+SPOOL_SIZE = 1024 * 1024
+RATE_LIMIT = 1.0
+TIMEOUT = 60
+MAX_RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = SharedSession(pool_size=CONCURRENCY)
+
+
+def get_session():
+    """Get the HTTP session shared by every Expensify request in the process.
+
+    Returns:
+        requests.Session: the shared session.
+    """
+    return _session.get()
+
+
+class LatencyMetrics():
+    """Thread safe latency totals for requests made to the Expensify API.
+
+    Attributes:
+        calls (dict): count, errors, total and max seconds for each job type.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def reset(self):
+        """Clear all recorded calls."""
+        with self._lock:
+            self.calls = {}
+
+    def record(self, name, seconds, status=None):
+        """Record the latency of a single call.
+
+        Args:
+            name (str): job type of the request, e.g. 'file' or 'download'.
+            seconds (float): time taken for the request.
+            status (int): HTTP status code, None if no response was received.
+        """
+        with self._lock:
+            call = self.calls.setdefault(name, {'count': 0, 'errors': 0,
+                                                'total': 0.0, 'max': 0.0})
+            call['count'] += 1
+            call['total'] += seconds
+            call['max'] = max(call['max'], seconds)
+            if status is None or status >= 400:
+                call['errors'] += 1
+
+    def summary(self):
+        """Summarise the recorded calls.
+
+        Returns:
+            dict: count, errors, mean and max seconds for each job type.
+        """
+        with self._lock:
+            return {name: {'count': c['count'],
+                           'errors': c['errors'],
+                           'mean': round(c['total'] / c['count'], 3),
+                           'max': round(c['max'], 3)}
+                    for name, c in self.calls.items()}
+
+
+metrics = LatencyMetrics()
+
+
+class RequestLimiter():
+    """Thread safe rate limit on the requests of each partnerUserID.
+
+    Shared by every user fetched in a run, so users sharing a credential
+    are limited together.
+
+    Args:
+        rate (float): maximum requests per second for each partnerUserID.
+
+    Attributes:
+        next_slot (dict): monotonic time each credential can next request.
+    """
+
+    def __init__(self, rate=RATE_LIMIT):
+        self._lock = threading.Lock()
+        self.interval = 1 / rate
+        self.next_slot = {}
+
+    def reserve(self, key, now=None):
+        """Reserve the next request slot of credential `key`.
+
+        Slots are reserved before waiting, so concurrent callers sharing a
+        credential are spaced `interval` seconds apart.
+
+        Args:
+            key (str): credential to rate limit on.
+            now (float): monotonic time, now if None.
+
+        Returns:
+            float: seconds to wait before making the request.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            slot = max(now, self.next_slot.get(key, now))
+            self.next_slot[key] = slot + self.interval
+
+        return slot - now
+
+    def wait(self, key):
+        """Wait until credential `key` is allowed to make another request.
+
+        Args:
+            key (str): credential to rate limit on.
+        """
+        time.sleep(self.reserve(key))
+
 
 class Expensify():
     """Methods for fetching data from the Expensify public API.
@@ -23,18 +150,67 @@ class Expensify():
         user_id (str): expensify api user id.
         secret (str): expensify api secret token.
         template (str): FreeMarker template for formatting request response.
+        timeout (float): seconds to wait for the API to respond.
+        max_retries (int): number of times to retry a failed request.
+        backoff (float): base number of seconds to back off between retries.
+        limiter (RequestLimiter): rate limit shared with other users, if any.
 
     Attributes:
         url (str): url for integration server for making api requests.
     """
 
-    def __init__(self, userid, secret, template):
+    def __init__(self, userid, secret, template, timeout=TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF, limiter=None):
         self.userid = userid
         self.secret = secret
         self.template = template
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = limiter
         self.url = ("https://integrations.expensify.com/Integration-Server/"
                     "ExpensifyIntegrations")
 
+    def request(self, params, job_type, stream=False):
+        """Make a request to the Integration Server on the shared session.
+
+        Connection errors, timeouts, rate limiting and 5xx responses are
+        retried up to `max_retries` times, sleeping a random time of up to
+        `backoff` * 2 ** attempt seconds between attempts. Every attempt
+        waits for a slot from `limiter`, if there is one.
+
+        Args:
+            params (dict): query parameters for the request.
+            job_type (str): job type of the request, used for metrics.
+            stream (bool): if True, don't download the body immediately.
+
+        Returns:
+            requests.Response: the final response.
+        """
+        session = get_session()
+
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.limiter.wait(self.userid)
+
+            start = time.monotonic()
+            try:
+                response = session.get(self.url, params=params,
+                                       timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.record(job_type, time.monotonic() - start)
+                if attempt == self.max_retries:
+                    raise
+            else:
+                metrics.record(job_type, time.monotonic() - start,
+                               response.status_code)
+                if (response.status_code not in RETRY_STATUSES or
+                        attempt == self.max_retries):
+                    return response
+                response.close()
+
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
     def reports(self, start_timestamp=None):
         """Wrapper function for requesting and fetching report file.
 
@@ -87,9 +263,7 @@ class Expensify():
                 }),
             "template": self.template
         }
-        requests.session().close()
-        response = requests.get(self.url, params=params)
-        requests.session().close()
+        response = self.request(params, "file")
         response_content = response.content
         return_response = response_content.decode('ascii')
 
@@ -99,14 +273,24 @@ class Expensify():
             raise RuntimeError(f"Failed to generate Expensify report, "
                                f"their API responded with {response.content}")
 
-    def fetch_file(self, filename):
+    def fetch_file(self, filename, chunk_size=64 * 1024,
+                   spool_size=SPOOL_SIZE):
         """Given a `filename`, fetch it from Expensify.
 
+        The file is downloaded in chunks of `chunk_size` bytes into a
+        temporary file, kept in memory up to `spool_size` bytes and on disk
+        beyond that, and the connection is released as soon as the download
+        completes. The reports are then parsed from the temporary file
+        incrementally, so only the report currently being parsed is held in
+        memory rather than the whole file.
+
         Args:
             filename (str): filename to fetch from Expensify.
+            chunk_size (int): number of bytes to download at a time.
+            spool_size (int): most bytes of the file held in memory.
 
         Returns:
-            return_response (JSON): object containing Expensify reports.
+            generator: Expensify reports, yielded one at a time.
         """
         params = {
             "requestJobDescription": json.dumps({
@@ -119,57 +303,35 @@ class Expensify():
                 })
             }
 
-        response = requests.get(self.url, params=params)
-        requests.session().close()
-        response_content = response.content
-        return_response = response_content.decode('utf-8')
-        return_response = ast.literal_eval(return_response)
+        response = self.request(params, "download", stream=True)
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_size, mode='w+',
+                                              encoding='utf-8')
 
-        if response.status_code == 200:
-            return return_response
-        else:
-            raise RuntimeError("Failed to fetch a file from Expensify, "
-                               "their API responded with: "
-                               "%s" % response.content)
+        try:
+            if response.status_code != 200:
+                raise RuntimeError("Failed to fetch a file from Expensify, "
+                                   "their API responded with: "
+                                   "%s" % response.content)
 
-    @classmethod
-    def convert_missing_to_null(cls, reports, expenses_col="report_expenses"):
-        """Converts all missing values in the Expensify report to None types.
+            response.encoding = 'utf-8'
+            for chunk in response.iter_content(chunk_size=chunk_size,
+                                               decode_unicode=True):
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            raise
+        finally:
+            response.close()
 
-        Args:
-            reports (list): list of report dictionaries.
-            expenses_col (str): key name in `reports` for the expenses values.
+        spool.seek(0)
 
-        Calls:
-            Expensify.count_expenses()
+        def stream_reports():
+            """Helper generator to close the file once parsed."""
+            with spool:
+                chunks = iter(lambda: spool.read(chunk_size), '')
+                yield from iter_json_objects(chunks)
 
-        Returns:
-            list: cleaned report dictionaries with None instead of ''.
-        """
-        cleaned_reports = []
-        missing = ['']
-        empty = []
-        null = [None]
-
-        for r in reports:
-            # Get the number of expenses in each report.
-            exp_count = Expensify.count_expenses(r)
-            # Expand `missing` and `null` to match the number of expenses.
-            missing_values = missing * exp_count
-            empty_values = empty * exp_count
-            null_values = null * exp_count
-
-            # Get the dict that contains expenses.
-            exp = r[expenses_col]
-            # Replace `missing_values` with `null_values`.
-            exp_cleaned = {k: null_values if (v == missing_values or
-                           v == empty_values) else v for k, v in exp.items()}
-            # Update the value for the `expenses_col` key.
-            r[expenses_col] = exp_cleaned
-            # Add cleaned report dict to the json list.
-            cleaned_reports.append(r)
-
-        return cleaned_reports
+        return stream_reports()
 
     @classmethod
     def count_expenses(cls, report, expenses_col="report_expenses",
@@ -190,55 +352,134 @@ class Expensify():
         return num_expenses
 
     @staticmethod
-    def convert_data_types(reports, expenses_col="report_expenses",
-                           float_cols=["expense_amount",
-                                       "expense_converted_amount",
-                                       "expense_modified_amount",
-                                       "expense_unit_rate"],
-                           int_cols=["expense_id",
-                                     "expense_unit_count"]):
-        """Converts values to the required datatype
+    def expenses_frame(reports, expenses_col="report_expenses",
+                       float_cols=["expense_amount",
+                                   "expense_converted_amount",
+                                   "expense_modified_amount",
+                                   "expense_unit_rate"],
+                       int_cols=["expense_id",
+                                 "expense_unit_count"],
+                       date_cols=["expense_created_date",
+                                  "expense_inserted_date",
+                                  "expense_modified_created_date"]):
+        """Normalise the expenses of all `reports` into a single DataFrame.
+
+        The column arrays of every report are joined and each column is
+        converted to its type in one pass. Missing values ('' or None) become
+        nulls: integers use the nullable Int64 type, floats NaN and dates NaT.
+
+        Calls:
+            Expensify.count_expenses()
 
         Args:
             reports (list): list of report dictionaries.
             expenses_col (str): key name in `reports` for the expenses values.
-            float_cols (list): keys to have values converted into floats.
-            int_cols (list): keys to have values converted into integers.
+            float_cols (list): columns to be converted into floats.
+            int_cols (list): columns to be converted into nullable integers.
+            date_cols (list): columns to be parsed into dates.
 
         Returns:
-            list: reports with values converted into the requires types.
-
-        TODO:
-            Filter out the NoneTypes.
+            pandas.DataFrame: one row per expense, with a `report_id` column.
         """
-        cleaned_reports = []
-        for r in reports:
-            # Convert the values of the report level keys.
-            r = {k: [int(x) if x is not None else x for x in v] if k in
-                 int_cols else v for k, v in r.items()}
+        counts = [Expensify.count_expenses(r, expenses_col) for r in reports]
+        report_ids = [r['report_id'] for r in reports]
+
+        if reports:
+            keys = list(reports[0][expenses_col])
+        else:
+            keys = []
+
+        columns = {'report_id': np.repeat(np.array(report_ids, dtype='int64'),
+                                          counts)}
 
-            r = {k: [float(x) if x is not None else x for x in v] if k in
-                 float_cols else v for k, v in r.items()}
+        for k in keys:
+            values = pd.Series(list(chain.from_iterable(
+                r[expenses_col][k] for r in reports)), dtype=object)
+            missing = values.isnull() | (values == '')
 
-            # Get the dict that contains expenses.
-            exp = r[expenses_col]
-            # Convert the values of the expense level keys.
-            exp = {k: [int(x) if x is not None else x for x in v] if k in
-                   int_cols else v for k, v in exp.items()}
+            if k in int_cols:
+                data = np.where(missing, '0', values).astype('int64')
+                columns[k] = pd.arrays.IntegerArray(data, missing.values)
+            elif k in float_cols:
+                columns[k] = pd.to_numeric(values.where(~missing),
+                                           errors='coerce')
+            elif k in date_cols:
+                columns[k] = pd.to_datetime(values.where(~missing),
+                                            errors='coerce').dt.date
+            else:
+                columns[k] = values.where(~missing, None)
 
-            exp = {k: [float(x) if x is not None else x for x in v] if k in
-                   float_cols else v for k, v in exp.items()}
+        return pd.DataFrame(columns, columns=['report_id'] + keys)
 
-            # Update the value for the `expenses_col` key.
-            r[expenses_col] = exp
 
-            # Add cleaned report dict to the list.
-            cleaned_reports.append(r)
+def iter_json_objects(chunks):
+    """Incrementally parse JSON objects from chunks of text.
 
-        return cleaned_reports
+    Accepts either a JSON array of objects or newline delimited JSON. Each
+    object is yielded as soon as it has been fully received.
+
+    Args:
+        chunks (iterable): strings making up the document, in order.
+
+    Raises:
+        ValueError: if the document ends part way through an object.
+
+    Yields:
+        dict: each parsed object.
+    """
+    decoder = json.JSONDecoder()
+    skip = re.compile(r'[ \t\r\n\[\],]*').match
 
+    def decode(buffer):
+        """Helper generator to yield each complete object in `buffer`.
 
-def main(userid, secret, template=None):
+        Returns the offset of the first incomplete object.
+        """
+        pos = 0
+        while True:
+            pos = skip(buffer, pos).end()
+            if pos == len(buffer):
+                return pos
+            try:
+                obj, pos_end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The object is incomplete, wait for more chunks.
+                return pos
+            yield obj
+            pos = pos_end
+
+    buffer = ''
+    pending = []
+    pending_size = 0
+    retry_size = 0
+
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+
+        # An incomplete object is only decoded again once the buffer has
+        # doubled, so an object spanning many chunks isn't re-parsed from
+        # the start for every one of them.
+        if len(buffer) + pending_size < retry_size:
+            continue
+
+        buffer += ''.join(pending)
+        pending = []
+        pending_size = 0
+
+        pos = yield from decode(buffer)
+        buffer = buffer[pos:]
+        retry_size = 2 * len(buffer)
+
+    buffer += ''.join(pending)
+    pos = yield from decode(buffer)
+
+    if pos < len(buffer):
+        raise ValueError(f"Could not parse Expensify reports, the file ended "
+                         f"with: {buffer[pos:pos + 100]}")
+
+
+def main(userid, secret, template=None, start_timestamp=None, **kwargs):
     """Instantiates Expensify class and fetches reports.
 
     Response format depends on `template`.
@@ -247,15 +488,59 @@ def main(userid, secret, template=None):
         user_id (str): expensify api user id.
         secret (str): expensify api secret token.
         template (str): FreeMarker template for formatting request response.
+        start_timestamp (float): unix time to fetch reports from. Defaults to
+            a year ago.
+        **kwargs: timeout, max_retries, backoff and limiter passed to
+            `Expensify`.
+
+    Notes:
+        Expense values are returned as sent by Expensify, use
+        `Expensify.expenses_frame()` to normalise them.
 
     Returns:
-        JSON: Expesnify reports. Output format depends on `template`.
+        generator: Expensify reports, parsed one at a time as the file
+            downloads. Output format depends on `template`.
     """
     if template is None:
-        template = freemarker_templates.json_template
-    ex = Expensify(userid, secret, template)
-    reports = ex.reports()
-    nullified_reports = Expensify.convert_missing_to_null(reports)
-    cleaned_reports = Expensify.convert_data_types(nullified_reports)
+        template = freemarker_templates.ndjson_template
+    ex = Expensify(userid, secret, template, **kwargs)
+    reports = ex.reports(start_timestamp)
+
+    return reports
 
-    return cleaned_reports
+
+def iter_main(jobs, concurrency=CONCURRENCY, rate=RATE_LIMIT, **kwargs):
+    """Run `main()` for many users on a bounded pool of threads.
+
+    Each user's report is generated and downloaded on the pool, so at most
+    `concurrency` connections are open at once, and the reports of the next
+    users are generated while earlier files download. The reports are
+    parsed from the downloaded file as the caller consumes them.
+
+    Args:
+        jobs (dict): key to (userid, secret, start_timestamp) for each user.
+        concurrency (int): maximum number of users fetched at once, also
+            the size of the session's connection pool.
+        rate (float): maximum requests per second for each partnerUserID.
+        **kwargs: passed to `main()`.
+
+    Yields:
+        tuple: key and a generator of the user's reports, or the exception
+            raised, in the order users complete.
+    """
+    # Keep a connection alive for each user fetched at once.
+    _session.configure(pool_size=concurrency)
+
+    limiter = RequestLimiter(rate)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(main, userid, secret,
+                                   start_timestamp=start_timestamp,
+                                   limiter=limiter, **kwargs): key
+                   for key, (userid, secret, start_timestamp) in jobs.items()}
+
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
@@ -1,4 +1,13 @@
-"""FreeMarker template for making requests to the Expensify API."""
+"""FreeMarker templates for making requests to the Expensify API.
+
+`json_template` returns every report in a single JSON array.
+`ndjson_template` returns one report per line so the file can be parsed a
+report at a time. Free text fields are escaped with `?json_string`, which
+keeps line breaks in comments from splitting a report over multiple lines.
+`travel_template()` builds an NDJSON template that only returns travel
+expenses, and only the fields stored for them.
+"""
+import json
 
 json_template = """
 [<#compress><#lt>
@@ -62,3 +71,127 @@ json_template = """
         }<#t>
         <#if report?has_next>,</#if><#t>
     </#list><#t></#compress>]"""
+
+
+ndjson_template = """<#list reports as report>
+{<#t>
+"report_id": ${report.reportID},<#t>
+"report_name": "${report.reportName?json_string}",<#t>
+"report_policy_id": "${report.policyID?json_string}",<#t>
+"report_expenses": {<#t>
+<#assign id_seq = []>
+<#assign type_seq = []>
+<#assign cat_seq = []>
+<#assign amt_seq = []>
+<#assign curr_seq = []>
+<#assign comm_seq = []>
+<#assign conv_amt_seq = []>
+<#assign created_seq = []>
+<#assign insrt_seq = []>
+<#assign merch_seq = []>
+<#assign mod_amt_seq = []>
+<#assign mod_created_seq = []>
+<#assign mod_merch_seq = []>
+<#assign unit_count_seq = []>
+<#assign unit_rate_seq = []>
+<#assign unit_unit_seq = []>
+<#list report.transactionList as expense>
+<#assign id_seq += [expense.transactionID]>
+<#assign type_seq += [expense.type]>
+<#assign cat_seq += [expense.category]>
+<#assign amt_seq += [expense.amount]>
+<#assign curr_seq += [expense.currency]>
+<#assign comm_seq += [expense.comment]>
+<#assign conv_amt_seq += [expense.convertedAmount]>
+<#assign created_seq += [expense.created]>
+<#assign insrt_seq += [expense.inserted]>
+<#assign merch_seq += [expense.merchant]>
+<#assign mod_amt_seq += [expense.modifiedAmount]>
+<#assign mod_created_seq += [expense.modifiedCreated]>
+<#assign mod_merch_seq += [expense.modifiedMerchant]>
+<#assign unit_count_seq += [expense.units.count]>
+<#assign unit_rate_seq += [expense.units.rate]>
+<#assign unit_unit_seq += [expense.units.unit]>
+</#list>
+"expense_id": [<#list id_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_type": [<#list type_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_category": [<#list cat_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_amount": [<#list amt_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_currency": [<#list curr_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_comment": [<#list comm_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_converted_amount": [<#list conv_amt_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_created_date": [<#list created_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_inserted_date": [<#list insrt_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_merchant": [<#list merch_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_modified_amount": [<#list mod_amt_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_modified_created_date": [<#list mod_created_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_modified_merchant": [<#list mod_merch_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_unit_count": [<#list unit_count_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_unit_rate": [<#list unit_rate_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_unit_unit": [<#list unit_unit_seq as i>"${i?json_string}"<#sep>, </#list>]<#t>
+}<#t>
+}
+</#list>"""
+
+
+def travel_template(categories):
+    """Build an NDJSON template that filters expenses by category.
+
+    Transactions whose category isn't in `categories` are dropped by
+    Expensify before the file is written, as are reports left with no
+    transactions. Fields that are never read downstream are left out.
+
+    Args:
+        categories (list): expense categories to return.
+
+    Returns:
+        str: FreeMarker template.
+    """
+    # A JSON array of strings is also a valid FreeMarker sequence literal.
+    category_seq = json.dumps(list(categories), ensure_ascii=False)
+
+    return """<#assign travel_categories = """ + category_seq + """>
+<#list reports as report>
+<#assign id_seq = []>
+<#assign type_seq = []>
+<#assign cat_seq = []>
+<#assign amt_seq = []>
+<#assign curr_seq = []>
+<#assign comm_seq = []>
+<#assign created_seq = []>
+<#assign merch_seq = []>
+<#assign unit_count_seq = []>
+<#assign unit_unit_seq = []>
+<#list report.transactionList as expense>
+<#if travel_categories?seq_contains(expense.category)>
+<#assign id_seq += [expense.transactionID]>
+<#assign type_seq += [expense.type]>
+<#assign cat_seq += [expense.category]>
+<#assign amt_seq += [expense.amount]>
+<#assign curr_seq += [expense.currency]>
+<#assign comm_seq += [expense.comment]>
+<#assign created_seq += [expense.created]>
+<#assign merch_seq += [expense.merchant]>
+<#assign unit_count_seq += [expense.units.count]>
+<#assign unit_unit_seq += [expense.units.unit]>
+</#if>
+</#list>
+<#if id_seq?has_content>
+{<#t>
+"report_id": ${report.reportID},<#t>
+"report_name": "${report.reportName?json_string}",<#t>
+"report_expenses": {<#t>
+"expense_id": [<#list id_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_type": [<#list type_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_category": [<#list cat_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_amount": [<#list amt_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_currency": [<#list curr_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_comment": [<#list comm_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_created_date": [<#list created_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_merchant": [<#list merch_seq as i>"${i?json_string}"<#sep>, </#list>],<#t>
+"expense_unit_count": [<#list unit_count_seq as i>"${i}"<#sep>, </#list>],<#t>
+"expense_unit_unit": [<#list unit_unit_seq as i>"${i?json_string}"<#sep>, </#list>]<#t>
+}<#t>
+}
+</#if>
+</#list>"""